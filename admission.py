@@ -0,0 +1,246 @@
+# -*- coding: utf-8 -*-
+"""
+文件名: admission.py
+功  能: 请求准入控制、按会话限流与过载分级降级 (app.py 的 /send_message 与 llm.py 的 /predict 各持有一个实例)。
+描  述:
+1. 全局并发上限：同时处理的请求数达到上限后，新请求进入有界等待队列；队列已满或等待超时则拒绝 (503 + Retry-After)。
+2. 按会话的令牌桶限流：每个会话以固定速率补充令牌，Judge 请求 (六次上游调用) 消耗更多令牌；
+   令牌不足时拒绝 (429 + Retry-After，按补足令牌所需时间计算)。
+3. 分级降级：按 (处理中 + 排队中) / (并发上限 + 队列长度) 计算负载，准入时确定降级等级：
+   - LEVEL_NO_JUDGE: 负载超过第一阈值，Judge 请求改由单个模型回答；
+   - LEVEL_REDUCED_K: 负载超过第二阈值，同时减少RAG检索的案例数；
+   - 队列已满：直接拒绝。
+4. 统计队列深度、排队等待时间、各类拒绝与降级次数，供 /admission_stats 查看。
+"""
+
+import math
+import threading
+import time
+from collections import OrderedDict
+
+LEVEL_NORMAL = 0
+LEVEL_NO_JUDGE = 1
+LEVEL_REDUCED_K = 2
+
+
+class AdmissionRejected(Exception):
+    """请求被拒绝 (限流或过载)"""
+
+    def __init__(self, reason, retry_after, status=503):
+        messages = {
+            "rate_limited": "请求过于频繁，请稍后再试",
+            "queue_full": "服务器繁忙，请稍后再试",
+            "queue_timeout": "服务器繁忙，排队超时，请稍后再试"
+        }
+        super().__init__(messages.get(reason, reason))
+        self.reason = reason
+        self.retry_after = max(1, int(math.ceil(retry_after)))
+        self.status = status
+
+    def payload(self):
+        """返回给客户端的JSON内容 (同时应设置 Retry-After 响应头)"""
+        return {"error": str(self), "reason": self.reason, "retry_after": self.retry_after}
+
+
+class TokenBucket:
+    """令牌桶：以 rate 个/秒补充，最多积累 burst 个"""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+
+    def take(self, cost=1, now=None):
+        """
+        尝试取出 cost 个令牌
+
+        返回:
+            float: 0 表示成功；否则为令牌补足所需的秒数
+        """
+        now = time.monotonic() if now is None else now
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        cost = min(cost, self.burst)
+        if self.tokens >= cost:
+            self.tokens -= cost
+            return 0.0
+        return (cost - self.tokens) / self.rate if self.rate > 0 else float("inf")
+
+    def refund(self, cost=1):
+        """退还已取出的令牌 (请求因过载未被处理时)"""
+        self.tokens = min(self.burst, self.tokens + min(cost, self.burst))
+
+
+class Ticket:
+    """已准入的请求，处理结束后必须 release() (可重复调用)"""
+
+    def __init__(self, controller, level, wait_ms):
+        self.level = level
+        self.wait_ms = wait_ms
+        self._controller = controller
+        self._released = False
+        self._lock = threading.Lock()
+
+    def release(self):
+        with self._lock:
+            if self._released:
+                return
+            self._released = True
+        self._controller._release()
+
+
+class AdmissionController:
+    """
+    全局并发上限 + 有界等待队列 + 按会话令牌桶 + 分级降级
+
+    参数:
+        max_concurrent: 同时处理的请求数上限
+        max_queue: 等待队列长度上限
+        queue_timeout: 排队最长等待秒数
+        session_rate / session_burst: 每个会话的令牌补充速率 (个/秒) 与桶容量，rate<=0 时不限流
+        heavy_cost: Judge 等重请求消耗的令牌数
+        degrade_judge_at / degrade_k_at: 进入各降级等级的负载比例 (None 表示不降级)
+        retry_after: 过载拒绝时建议的重试秒数
+        max_sessions: 最多保留的会话令牌桶数，超出时淘汰最久未使用的
+    """
+
+    def __init__(self, max_concurrent, max_queue, queue_timeout=10.0, session_rate=0.0, session_burst=5,
+                 heavy_cost=3, degrade_judge_at=None, degrade_k_at=None, retry_after=5, max_sessions=10000):
+        self.max_concurrent = max(1, max_concurrent)
+        self.max_queue = max(0, max_queue)
+        self.queue_timeout = queue_timeout
+        self.session_rate = session_rate
+        self.session_burst = session_burst
+        self.heavy_cost = heavy_cost
+        self.degrade_judge_at = degrade_judge_at
+        self.degrade_k_at = degrade_k_at
+        self.retry_after = retry_after
+        self.max_sessions = max_sessions
+
+        self._active = 0
+        self._queued = 0
+        self._buckets = OrderedDict()
+        self._cond = threading.Condition()
+        self._stats = {
+            "admitted": 0,
+            "queued_total": 0,
+            "wait_ms_total": 0.0,
+            "max_queue_depth": 0,
+            "shed_rate_limited": 0,
+            "shed_queue_full": 0,
+            "shed_queue_timeout": 0,
+            "degraded_judge": 0,
+            "degraded_k": 0
+        }
+
+    def _pressure(self):
+        return (self._active + self._queued) / (self.max_concurrent + self.max_queue)
+
+    def _level(self):
+        pressure = self._pressure()
+        if self.degrade_k_at is not None and pressure >= self.degrade_k_at:
+            return LEVEL_REDUCED_K
+        if self.degrade_judge_at is not None and pressure >= self.degrade_judge_at:
+            return LEVEL_NO_JUDGE
+        return LEVEL_NORMAL
+
+    def level(self):
+        """当前负载对应的降级等级"""
+        with self._cond:
+            return self._level()
+
+    def _take_session_tokens(self, session_key, cost):
+        if self.session_rate <= 0 or not session_key:
+            return 0.0
+        bucket = self._buckets.get(session_key)
+        if bucket is None:
+            bucket = self._buckets[session_key] = TokenBucket(self.session_rate, self.session_burst)
+            while len(self._buckets) > self.max_sessions:
+                self._buckets.popitem(last=False)
+        else:
+            self._buckets.move_to_end(session_key)
+        return bucket.take(cost)
+
+    def _refund_session_tokens(self, session_key, cost):
+        bucket = self._buckets.get(session_key) if self.session_rate > 0 and session_key else None
+        if bucket is not None:
+            bucket.refund(cost)
+
+    def acquire(self, session_key=None, heavy=False):
+        """
+        申请处理一个请求，必要时在队列中阻塞等待
+
+        参数:
+            session_key: 会话标识，用于按会话限流
+            heavy: 是否为 Judge 等多次上游调用的重请求 (降级后按普通请求计)
+
+        返回:
+            Ticket: 含本次请求的降级等级 level
+        异常:
+            AdmissionRejected: 限流 (429) 或过载 (503)
+        """
+        start = time.monotonic()
+        with self._cond:
+            # 负载按本请求到达时计算 (含本请求)
+            self._queued += 1
+            level = self._level()
+            self._queued -= 1
+
+            # 先检查队列容量：因过载被拒绝的请求不消耗会话的令牌
+            if self._active >= self.max_concurrent and self._queued >= self.max_queue:
+                self._stats["shed_queue_full"] += 1
+                raise AdmissionRejected("queue_full", self.retry_after)
+
+            cost = self.heavy_cost if heavy and level < LEVEL_NO_JUDGE else 1
+            wait = self._take_session_tokens(session_key, cost)
+            if wait > 0:
+                self._stats["shed_rate_limited"] += 1
+                raise AdmissionRejected("rate_limited", wait, status=429)
+
+            if self._active >= self.max_concurrent:
+                self._queued += 1
+                self._stats["queued_total"] += 1
+                self._stats["max_queue_depth"] = max(self._stats["max_queue_depth"], self._queued)
+                deadline = start + self.queue_timeout
+                try:
+                    while self._active >= self.max_concurrent:
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            self._stats["shed_queue_timeout"] += 1
+                            self._refund_session_tokens(session_key, cost)
+                            raise AdmissionRejected("queue_timeout", self.retry_after)
+                        self._cond.wait(remaining)
+                finally:
+                    self._queued -= 1
+
+            self._active += 1
+            wait_ms = (time.monotonic() - start) * 1000
+            self._stats["admitted"] += 1
+            self._stats["wait_ms_total"] += wait_ms
+            if heavy and level >= LEVEL_NO_JUDGE:
+                self._stats["degraded_judge"] += 1
+            if level >= LEVEL_REDUCED_K:
+                self._stats["degraded_k"] += 1
+        return Ticket(self, level, wait_ms)
+
+    def _release(self):
+        with self._cond:
+            self._active -= 1
+            self._cond.notify()
+
+    def stats(self):
+        with self._cond:
+            stats = dict(self._stats)
+            wait_total = stats.pop("wait_ms_total")
+            stats.update({
+                "active": self._active,
+                "queue_depth": self._queued,
+                "max_concurrent": self.max_concurrent,
+                "max_queue": self.max_queue,
+                "pressure": round(self._pressure(), 3),
+                "level": self._level(),
+                "avg_wait_ms": round(wait_total / stats["admitted"], 2) if stats["admitted"] else 0.0,
+                "tracked_sessions": len(self._buckets)
+            })
+            return stats
@@ -1,17 +1,37 @@
-from flask import Flask, render_template, request, jsonify, session, Response, stream_with_context
+from flask import Flask, render_template, request, jsonify, session, Response, stream_with_context, make_response
 from flask_session import Session
 from flask_sqlalchemy import SQLAlchemy
-import requests
 import json
 import re
-from pymilvus import MilvusClient
-from sentence_transformers import SentenceTransformer
-import torch
 import os
 import uuid
 import tempfile
+import threading
+import time
+import atexit
+import signal
+import sys
+import base64
+import hashlib
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from multimodal_handler import process_multimodal_file
+from sqlalchemy import event as sa_event, inspect, text
+from multimodal_handler import process_multimodal_file, is_recognition_failure, ocr_stats
+from semantic_cache import SemanticCache, make_case_signature
+from rag_prefetch import RagPrefetcher
+from admission import AdmissionController, AdmissionRejected, LEVEL_NORMAL, LEVEL_NO_JUDGE, LEVEL_REDUCED_K
+from cancellation import CancellationRegistry
+from prompt_budget import TokenCounter
+from transport import create_transport, TransportError, TransportTimeout
+from stream_coalescer import coalesce_events
+from write_behind import WriteBehindQueue
+from message_search import install_message_search, search_messages
+from session_store import create_session_interface
+from db_maintenance import MaintenanceScheduler, run_maintenance
+from media_cache import MediaResultCache
+from upload_jobs import UploadJobManager
+from retriever import LegalCaseRetriever
 import config
 
 
@@ -34,11 +54,37 @@ app.config['SESSION_KEY_PREFIX'] = config.SESSION_KEY_PREFIX
 app.config['SQLALCHEMY_DATABASE_URI'] = config.SQLALCHEMY_DATABASE_URI
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = config.SQLALCHEMY_TRACK_MODIFICATIONS
 
-# 初始化Flask-Session和SQLAlchemy
-Session(app)
+# 初始化会话存储和SQLAlchemy (memory/sqlite 使用 session_store.py，filesystem 使用 Flask-Session)
+if config.SESSION_TYPE in ('memory', 'sqlite'):
+    app.session_interface = create_session_interface(
+        config.SESSION_TYPE,
+        config.SESSION_SQLITE_PATH,
+        config.SESSION_TTL,
+        use_signer=config.SESSION_USE_SIGNER,
+        permanent=config.SESSION_PERMANENT,
+        sweep_interval=config.SESSION_SWEEP_INTERVAL,
+        memory_max_entries=config.SESSION_MEMORY_MAX_ENTRIES
+    )
+else:
+    Session(app)
 db = SQLAlchemy(app)
 
 
+def apply_sqlite_pragmas(dbapi_connection, connection_record):
+    """每个新的SQLite连接：WAL 日志模式、同步级别与锁等待超时；新建的库使用增量 auto_vacuum (已有的库不受影响)"""
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA auto_vacuum=INCREMENTAL")
+    cursor.execute(f"PRAGMA journal_mode={config.SQLITE_JOURNAL_MODE}")
+    cursor.execute(f"PRAGMA synchronous={config.SQLITE_SYNCHRONOUS}")
+    cursor.execute(f"PRAGMA busy_timeout={config.SQLITE_BUSY_TIMEOUT_MS}")
+    cursor.close()
+
+
+with app.app_context():
+    if db.engine.dialect.name == 'sqlite':
+        sa_event.listen(db.engine, 'connect', apply_sqlite_pragmas)
+
+
 # ============================================================================
 # 数据库模型定义
 # ============================================================================
@@ -49,22 +95,22 @@ class Conversation(db.Model):
     id = db.Column(db.String(36), primary_key=True)  # UUID
     session_id = db.Column(db.String(36), index=True, nullable=False)
     title = db.Column(db.String(200), default='新对话')
-    history = db.Column(db.Text, default='[]')  # JSON字符串存储对话历史
+    history = db.Column(db.Text, default='[]')  # 旧版本的整段JSON对话历史，迁移到 messages 表后清空
     rag_history = db.Column(db.Text, default='[]')  # JSON字符串存储RAG历史
+    summary = db.Column(db.Text, default='')  # 较早对话的滚动摘要
+    summary_upto = db.Column(db.Integer, default=0)  # 已并入摘要的历史消息条数 (history[:summary_upto])
+    message_count = db.Column(db.Integer, default=0)  # messages 表中本对话的消息条数 (即下一条消息的 seq)
     is_current = db.Column(db.Boolean, default=False)  # 是否为当前对话
     created_at = db.Column(db.DateTime, default=datetime.now)
     updated_at = db.Column(db.DateTime, default=datetime.now, onupdate=datetime.now)
 
-    def get_history(self):
-        """获取对话历史列表"""
-        try:
-            return json.loads(self.history) if self.history else []
-        except json.JSONDecodeError:
-            return []
+    # 对话列表按 updated_at 倒序分页
+    __table_args__ = (db.Index('ix_conversations_session_updated', 'session_id', 'updated_at'),)
 
-    def set_history(self, history_list):
-        """设置对话历史"""
-        self.history = json.dumps(history_list, ensure_ascii=False)
+    def get_history(self):
+        """获取对话历史列表 (按 seq 顺序读取 messages 表)"""
+        rows = Message.query.filter_by(conversation_id=self.id).order_by(Message.seq).all()
+        return [row.to_message() for row in rows]
 
     def get_rag_history(self):
         """获取RAG历史列表"""
@@ -89,15 +135,134 @@ class Conversation(db.Model):
             'is_current': self.is_current
         }
 
+
+
+class Message(db.Model):
+    """对话消息 - 每条消息一行，按 (conversation_id, seq) 排序；每轮只插入新增的消息"""
+    __tablename__ = 'messages'
+
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    conversation_id = db.Column(db.String(36), db.ForeignKey('conversations.id'), nullable=False)
+    seq = db.Column(db.Integer, nullable=False)  # 在对话中的序号，从0开始
+    role = db.Column(db.String(20), nullable=False)
+    content = db.Column(db.Text, default='')
+    extra = db.Column(db.Text, nullable=True)  # 其余字段 (附件、Judge数据等) 的JSON，没有时为空
+    created_at = db.Column(db.DateTime, default=datetime.now)
+
+    __table_args__ = (db.UniqueConstraint('conversation_id', 'seq', name='uq_messages_conversation_seq'),)
+
+    @classmethod
+    def from_message(cls, conversation_id, seq, message):
+        """由对话历史中的消息字典构造一行 (judge_payload 另存 judge_payloads 表，不进入本行)"""
+        extra = {key: value for key, value in message.items() if key not in ('role', 'content', 'judge_payload')}
+        return cls(
+            conversation_id=conversation_id,
+            seq=seq,
+            role=message.get('role', 'user'),
+            content=message.get('content', ''),
+            extra=json.dumps(extra, ensure_ascii=False) if extra else None
+        )
+
+    def to_message(self):
+        """还原为对话历史中的消息字典 (Judge 回答只带引用，完整数据按 message_id 另行获取)"""
+        message = {"role": self.role, "content": self.content or ''}
+        if self.extra:
+            try:
+                message.update(json.loads(self.extra))
+            except json.JSONDecodeError:
+                pass
+        if 'judge_ref' in message:
+            message['judge_ref'] = {**message['judge_ref'], 'message_id': self.id}
+        return message
+
+
+class JudgePayload(db.Model):
+    """Judge 回答的完整数据 (裁判理由与各模型的全部回答)，只在前端展开对比时按消息ID读取"""
+    __tablename__ = 'judge_payloads'
+
+    message_id = db.Column(db.Integer, db.ForeignKey('messages.id'), primary_key=True)
+    conversation_id = db.Column(db.String(36), index=True, nullable=False)  # 删除/清空对话时按对话删除
+    payload = db.Column(db.Text, nullable=False)  # JSON: {"judge_reasoning": ..., "all_answers": {...}}
+    created_at = db.Column(db.DateTime, default=datetime.now)
+
+    message = db.relationship('Message')
+
 # 后端API服务的完整地址
 API_URL = config.API_URL
 
+# 调用 llm.py 的传输层（http: 独立部署；inprocess: 同进程直接调用）
+backend = create_transport(config.BACKEND_TRANSPORT, API_URL)
+
+# 进行中的流式请求，/cancel_request 据此关闭对应的后端连接与上游流
+cancellation_registry = CancellationRegistry()
+
+# /send_message 的准入控制：并发上限 + 有界等待队列 + 按会话限流 + 过载分级降级
+admission = None
+if config.ADMISSION_ENABLED:
+    admission = AdmissionController(
+        config.ADMISSION_MAX_CONCURRENT,
+        config.ADMISSION_MAX_QUEUE,
+        queue_timeout=config.ADMISSION_QUEUE_TIMEOUT,
+        session_rate=config.ADMISSION_SESSION_RATE,
+        session_burst=config.ADMISSION_SESSION_BURST,
+        heavy_cost=config.ADMISSION_JUDGE_COST,
+        degrade_judge_at=config.ADMISSION_DEGRADE_JUDGE_AT,
+        degrade_k_at=config.ADMISSION_DEGRADE_K_AT,
+        retry_after=config.ADMISSION_RETRY_AFTER
+    )
+
+# Judge 模式因过载降级为单模型回答时，附在回答下方的说明
+JUDGE_DEGRADED_NOTICE = "当前服务负载较高，Judge模式已临时关闭，本次由单个模型回答。"
+
+# 对话滚动摘要：判断未摘要历史长度用的token计数器，以及正在后台摘要的对话
+history_token_counter = TokenCounter(config.PROMPT_TOKEN_ENCODING)
+summarizing_conversations = set()
+summarizing_lock = threading.Lock()
+
 # 全局变量，用于存储检索系统组件
 retrieval_system = None
 
+# 历史对话全文索引是否可用（启动迁移时创建 messages_fts 后置为True）
+message_search_available = False
+
 # RAG 调试开关（环境变量 RAG_DEBUG=1/true/on）
 RAG_DEBUG = config.RAG_DEBUG
 
+# 每轮提问的RAG检索参数（预取与发送时须一致才能复用）
+RAG_TOP_K = 2
+RAG_MIN_SCORE = 0.4
+# LLM 在回答中用 [RAG_QUERY: ...] 请求补充检索时的案例数
+RAG_FOLLOWUP_K = 3
+
+# 回答流中途识别到 RAG_QUERY 标记后，在后台线程执行补充检索
+rag_query_executor = ThreadPoolExecutor(max_workers=config.RAG_QUERY_WORKERS, thread_name_prefix='rag-query')
+
+# 输入时的RAG检索预取（按会话保存草稿的检索结果）
+rag_prefetcher = None
+if config.RAG_PREFETCH_ENABLED:
+    rag_prefetcher = RagPrefetcher(
+        ttl_seconds=config.RAG_PREFETCH_TTL,
+        max_per_session=config.RAG_PREFETCH_MAX_PER_SESSION,
+        near_threshold=config.RAG_PREFETCH_NEAR_THRESHOLD,
+        wait_timeout=config.RAG_PREFETCH_WAIT_TIMEOUT,
+        rate=config.RAG_PREFETCH_RATE,
+        burst=config.RAG_PREFETCH_BURST
+    )
+
+# 图片OCR / 语音识别结果缓存（相同文件重复上传时不再调用远程识别服务）
+media_cache = None
+if config.MEDIA_CACHE_ENABLED:
+    media_cache = MediaResultCache(config.MEDIA_CACHE_PATH, max_bytes=config.MEDIA_CACHE_MAX_BYTES)
+
+# 语义近似回答缓存（可选，仅用于首轮、无历史的提问）
+semantic_cache = None
+if config.SEMANTIC_CACHE_ENABLED:
+    semantic_cache = SemanticCache(
+        threshold=config.SEMANTIC_CACHE_THRESHOLD,
+        max_entries_per_namespace=config.SEMANTIC_CACHE_MAX_ENTRIES,
+        ttl_seconds=config.SEMANTIC_CACHE_TTL
+    )
+
 # ============================================================================
 # 数据库操作函数 - 替代原有的内存字典存储
 # ============================================================================
@@ -140,6 +305,7 @@ def create_new_conversation(session_id, title="新对话"):
 
 def get_current_conversation(session_id):
     """获取当前对话"""
+    wait_for_pending_writes(session_id)
     conv = Conversation.query.filter_by(session_id=session_id, is_current=True).first()
     if not conv:
         conv = create_new_conversation(session_id)
@@ -148,6 +314,7 @@ def get_current_conversation(session_id):
 
 def switch_conversation(session_id, conversation_id):
     """切换到指定对话（不更新updated_at，仅查看时位置不变）"""
+    wait_for_pending_writes(session_id)
     conv = Conversation.query.filter_by(id=conversation_id, session_id=session_id).first()
     if not conv:
         return False
@@ -174,20 +341,52 @@ def switch_conversation(session_id, conversation_id):
     return True
 
 
-def update_conversation_title(session_id, conversation_id, user_message):
-    """更新对话标题（基于用户的第一条消息）"""
-    conv = Conversation.query.filter_by(id=conversation_id, session_id=session_id).first()
-    if conv and conv.title == "新对话" and user_message:
-        title = user_message[:20] + "..." if len(user_message) > 20 else user_message
-        conv.title = title
-        db.session.commit()
-        print(f"更新对话标题 - 对话ID: {conversation_id}, 新标题: {title}")
+def make_conversation_title(user_message):
+    """对话标题（基于用户的第一条消息）"""
+    return user_message[:20] + "..." if len(user_message) > 20 else user_message
 
 
-def get_conversation_list(session_id):
-    """获取用户的对话列表"""
-    conversations = Conversation.query.filter_by(session_id=session_id)\
-        .order_by(Conversation.updated_at.desc()).all()
+def encode_page_cursor(conv):
+    """对话列表的分页游标：上一页最后一个对话的 (updated_at, id)"""
+    raw = f"{conv.updated_at.isoformat()}|{conv.id}"
+    return base64.urlsafe_b64encode(raw.encode('utf-8')).decode('ascii')
+
+
+def decode_page_cursor(cursor):
+    """
+    解析分页游标
+
+    异常:
+        ValueError: 游标格式错误
+    """
+    try:
+        updated_at, conversation_id = base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8').split('|', 1)
+        return datetime.fromisoformat(updated_at), conversation_id
+    except Exception:
+        raise ValueError('无效的分页游标')
+
+
+def get_conversation_list(session_id, limit=None, cursor=None):
+    """
+    获取用户的对话列表 (按更新时间倒序，游标分页)
+
+    参数:
+        limit: 每页条数，默认 CONVERSATION_PAGE_SIZE
+        cursor: 上一页返回的 next_cursor；为空时返回第一页
+    返回:
+        tuple: (对话列表, 下一页的游标；没有更多时为None)
+    """
+    wait_for_pending_writes(session_id)
+    limit = limit or config.CONVERSATION_PAGE_SIZE
+    query = Conversation.query.filter_by(session_id=session_id)
+    if cursor:
+        updated_at, conversation_id = decode_page_cursor(cursor)
+        query = query.filter(db.or_(
+            Conversation.updated_at < updated_at,
+            db.and_(Conversation.updated_at == updated_at, Conversation.id < conversation_id)
+        ))
+    conversations = query.order_by(Conversation.updated_at.desc(), Conversation.id.desc()).limit(limit + 1).all()
+    next_cursor = encode_page_cursor(conversations[limit - 1]) if len(conversations) > limit else None
 
     return [{
         'id': conv.id,
@@ -195,26 +394,188 @@ def get_conversation_list(session_id):
         'created_at': conv.created_at.isoformat() if conv.created_at else None,
         'updated_at': conv.updated_at.isoformat() if conv.updated_at else None,
         'is_current': conv.is_current
-    } for conv in conversations]
+    } for conv in conversations[:limit]], next_cursor
 
 
-def save_conversation_history(session_id, conversation_id, history):
-    """保存对话历史"""
-    conv = Conversation.query.filter_by(id=conversation_id, session_id=session_id).first()
-    if conv:
-        conv.set_history(history)
-        conv.updated_at = datetime.now()
-        db.session.commit()
-        print(f"保存对话历史 - 对话ID: {conversation_id}, 消息数: {len(history)}")
+def get_message_page(conversation_id, before=None, limit=None):
+    """
+    按 seq 倒序读取一页消息 (最新的在前一页)，返回时按时间正序排列
+
+    参数:
+        before: 只返回 seq 小于该值的消息 (上一页返回的 next_before)；为空时返回最新的一页
+        limit: 每页条数，默认 HISTORY_PAGE_SIZE
+    返回:
+        tuple: (消息列表, 更早一页的 before 参数；没有更早的消息时为None)
+    """
+    limit = limit or config.HISTORY_PAGE_SIZE
+    query = Message.query.filter_by(conversation_id=conversation_id)
+    if before is not None:
+        query = query.filter(Message.seq < before)
+    rows = query.order_by(Message.seq.desc()).limit(limit + 1).all()
+    next_before = rows[limit - 1].seq if len(rows) > limit else None
+    return [row.to_message() for row in reversed(rows[:limit])], next_before
+
+
+def read_page_limit(default):
+    """读取请求参数 limit (限制在 1..MAX_PAGE_SIZE)"""
+    limit = request.args.get('limit', type=int) or default
+    return max(1, min(limit, config.MAX_PAGE_SIZE))
+
+
+def append_message_rows(conv, messages, resync=False):
+    """
+    在当前事务中为对话追加消息行 (seq 接在已有消息之后，只插入新行)，由调用方提交
+
+    resync 为True时按表中已有的最大 seq 重新确定起点 (message_count 与实际行数不一致时使用)。
+    """
+    start = conv.message_count or 0
+    if resync:
+        last_seq = db.session.query(db.func.max(Message.seq)).filter_by(conversation_id=conv.id).scalar()
+        start = 0 if last_seq is None else last_seq + 1
+    for offset, message in enumerate(messages):
+        row = Message.from_message(conv.id, start + offset, message)
+        db.session.add(row)
+        if message.get('judge_payload'):
+            db.session.add(JudgePayload(message=row, conversation_id=conv.id,
+                                        payload=json.dumps(message['judge_payload'], ensure_ascii=False)))
+    conv.message_count = start + len(messages)
+    conv.updated_at = datetime.now()
+
+
+class TurnUnitOfWork:
+    """
+    一轮对话的工作单元
+
+    准备阶段只加载一次对话；本轮的标题、检索记录与新消息先累积在内存中 (本轮内的读取也使用这里的数据)，
+    commit() 把它们整体交给后台写入队列，由 apply() 在后台线程的事务中写入。
+    """
+
+    def __init__(self, conv):
+        self.session_id = conv.session_id
+        self.conversation_id = conv.id
+        # 旧版本保存的案例副本 (无查询向量) 不再使用
+        self.rag_history = [item for item in conv.get_rag_history() if 'embedding' in item]
+        self.title = None
+        self.rag_records = []
+        self.messages = []
+        self.committed = False
+
+    def set_title(self, title):
+        self.title = title
+
+    def add_rag_record(self, record):
+        if record is not None:
+            self.rag_records.append(record)
+            self.rag_history.append(record)
+
+    def add_messages(self, messages):
+        self.messages.extend(messages)
+
+    def commit(self):
+        """提交本轮的写入 (可重复调用，只提交一次；之后的修改不再写入)"""
+        if self.committed:
+            return
+        self.committed = True
+        if self.title or self.rag_records or self.messages:
+            write_queue.submit(self.session_id, self)
+
+    def apply(self, resync=False):
+        """
+        在当前事务中写入本轮的修改 (不提交)；resync 见 append_message_rows
+
+        返回:
+            bool: 是否追加了消息 (需要检查对话摘要)
+        """
+        conv = Conversation.query.filter_by(id=self.conversation_id, session_id=self.session_id).first()
+        if not conv:
+            return False  # 对话已被删除
+        if self.title and conv.title == "新对话":
+            conv.title = self.title
+            print(f"更新对话标题 - 对话ID: {self.conversation_id}, 新标题: {self.title}")
+        if self.rag_records:
+            rag_history = [item for item in conv.get_rag_history() if 'embedding' in item] + self.rag_records
+            # 限制保存的检索次数
+            conv.set_rag_history(rag_history[-config.RAG_HISTORY_MAX_QUERIES:])
+        if self.messages:
+            append_message_rows(conv, self.messages, resync)
+        return bool(self.messages)
+
+
+def apply_write_batch(units):
+    """
+    后台写入队列的写入函数：一批工作单元在一个事务中写入 (一次提交)
+
+    整批失败时回滚并逐个重试；仍失败 (如其他进程同时写入同一对话导致 seq 冲突) 时按已有的最大 seq 再试一次。
+    """
+    with app.app_context():
+        try:
+            summarize = [unit.conversation_id for unit in units if unit.apply()]
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            print(f"批量写入失败，逐个重试: {e}")
+            summarize = []
+            for unit in units:
+                for attempt in range(2):
+                    try:
+                        appended = unit.apply(resync=attempt > 0)
+                        db.session.commit()
+                    except Exception as e:
+                        db.session.rollback()
+                        if attempt:
+                            print(f"保存对话失败 - 对话ID: {unit.conversation_id}, 错误: {e}")
+                        continue
+                    if appended:
+                        summarize.append(unit.conversation_id)
+                    break
+
+        message_count = sum(len(unit.messages) for unit in units)
+        print(f"保存对话历史 - {len(units)} 轮对话, 新增消息: {message_count}")
+        for conversation_id in dict.fromkeys(summarize):
+            schedule_history_summary(conversation_id)
+
+
+# 每轮对话的写入由后台线程成批提交，流式回答不等待磁盘；关闭服务时写完队列
+write_queue = WriteBehindQueue(apply_write_batch, max_batch=config.WRITE_BEHIND_MAX_BATCH,
+                               enabled=config.WRITE_BEHIND_ENABLED)
+atexit.register(write_queue.drain, config.WRITE_BEHIND_DRAIN_TIMEOUT)
+
+
+def run_db_maintenance():
+    """执行一次数据库维护 (归档清理过期对话、增量VACUUM、ANALYZE)，返回维护报告"""
+    with app.app_context():
+        db_path = db.engine.url.database
+    return run_maintenance(
+        db_path,
+        retention_days=config.RETENTION_DAYS,
+        archive_dir=config.ARCHIVE_DIR or None,
+        vacuum_pages=config.MAINTENANCE_VACUUM_PAGES,
+        convert_auto_vacuum=config.MAINTENANCE_CONVERT_AUTO_VACUUM,
+        busy_timeout_ms=config.SQLITE_BUSY_TIMEOUT_MS
+    )
+
+
+# 数据库定期维护（startup() 中启动；写入队列中属于已清理对话的工作单元在写入时跳过）
+db_maintenance = MaintenanceScheduler(run_db_maintenance, config.MAINTENANCE_INTERVAL_HOURS,
+                                      config.MAINTENANCE_INITIAL_DELAY)
+
+
+def wait_for_pending_writes(session_id):
+    """读取会话的对话数据前，等待该会话尚未落盘的写入 (通常队列早已为空)"""
+    if session_id and not write_queue.wait_for(session_id, config.WRITE_BEHIND_READ_WAIT):
+        print(f"等待后台写入超时 - 会话ID: {session_id}")
 
 
 def delete_conversation(session_id, conversation_id):
     """删除对话"""
+    wait_for_pending_writes(session_id)
     conv = Conversation.query.filter_by(id=conversation_id, session_id=session_id).first()
     if not conv:
         return False
 
     was_current = conv.is_current
+    JudgePayload.query.filter_by(conversation_id=conversation_id).delete()
+    Message.query.filter_by(conversation_id=conversation_id).delete()
     db.session.delete(conv)
     db.session.commit()
 
@@ -230,63 +591,91 @@ def delete_conversation(session_id, conversation_id):
     return True
 
 
-def add_rag_to_history(session_id, conversation_id, rag_data, user_message):
-    """将检索案例添加到历史中"""
-    conv = Conversation.query.filter_by(id=conversation_id, session_id=session_id).first()
-    if not conv:
-        return
+def encode_query_vector(query_vec):
+    """查询向量以 float16 + base64 存入 rag_history (1024维约2.7KB)"""
+    return base64.b64encode(np.asarray(query_vec, dtype=np.float16).tobytes()).decode('ascii')
 
-    rag_history = conv.get_rag_history()
-
-    # 只保存有实际内容的检索结果
-    for item in rag_data:
-        if item.get('fact') and item.get('meta'):
-            simplified_case = {
-                'fact': item['fact'][:200] + '...' if len(item['fact']) > 200 else item['fact'],
-                'accusation': item['meta'].get('accusation', []),
-                'articles': item['meta'].get('relevant_articles', []),
-                'imprisonment': item['meta'].get('term_of_imprisonment', {}).get('imprisonment', '未知'),
-                'fine': item['meta'].get('punish_of_money', '未知'),
-                'timestamp': datetime.now().isoformat(),
-                'related_query': user_message[:100]
-            }
-            rag_history.append(simplified_case)
 
-    # 限制历史案例数量
-    if len(rag_history) > 20:
-        rag_history = rag_history[-20:]
+def decode_query_vector(encoded):
+    return np.frombuffer(base64.b64decode(encoded), dtype=np.float16).astype(np.float32)
 
-    conv.set_rag_history(rag_history)
-    db.session.commit()
-    print(f"保存检索案例到历史 - 对话ID: {conversation_id}, 总案例数: {len(rag_history)}")
 
+def make_rag_record(retrieval_results, user_message, query_vec):
+    """
+    本轮检索的历史记录：只保存案例ID与相似度，以及查询向量 (案例内容按ID从案例库读取)
 
-def get_relevant_rag_history(session_id, conversation_id, current_query):
-    """获取与当前查询相关的历史检索案例"""
-    conv = Conversation.query.filter_by(id=conversation_id, session_id=session_id).first()
-    if not conv:
-        return []
-
-    rag_history = conv.get_rag_history()
-
-    # 简化逻辑：返回最近的历史检索案例作为参考
-    # 排除与当前查询高度相似的案例（避免重复）
-    relevant_cases = []
-
-    for case in rag_history[-10:]:  # 只考虑最近10个案例
-        case_text = f"{case.get('fact', '')} {' '.join(case.get('accusation', []))}".lower()
+    参数:
+        retrieval_results: search_similar_cases 的结果 (含 case_id / similarity_score)
+        query_vec: 本轮查询的归一化向量，用于之后按向量相似度挑选历史案例
+    返回:
+        dict: 检索记录；没有结果或没有查询向量时返回None
+    """
+    if not retrieval_results or query_vec is None:
+        return None
+    return {
+        'query': user_message[:100],
+        'embedding': encode_query_vector(query_vec),
+        'cases': [{'id': result['case_id'], 'score': round(float(result['similarity_score']), 4)}
+                  for result in retrieval_results],
+        'timestamp': datetime.now().isoformat()
+    }
+
+
+def get_relevant_rag_history(rag_history, query_vec, exclude_case_ids=(), limit=3):
+    """
+    获取与当前查询相关的历史检索案例
 
-        # 检查案例是否包含有用的量刑信息
-        has_sentencing_info = any(keyword in case_text for keyword in ['月', '年', '刑期', '判决', '处罚', '罚金'])
+    以往每次检索 (rag_history 中的记录) 的查询向量与当前查询向量做余弦相似度 (向量已归一化，一次矩阵乘法)，
+    按相似度从高到低取其案例，跳过本轮已检索到的案例并去重，最后按ID从案例库读取内容。
+    """
+    if query_vec is None or retrieval_system is None:
+        return []
 
-        # 简单的重复检测：如果案例的related_query与当前查询完全相同则跳过
-        related_query = case.get('related_query', '')
-        is_duplicate = related_query == current_query[:100]
+    records = [item for item in rag_history if 'embedding' in item and item.get('cases')]
+    if not records:
+        return []
 
-        if has_sentencing_info and not is_duplicate:
-            relevant_cases.append(case)
+    vec = np.asarray(query_vec, dtype=np.float32).reshape(-1)
+    vectors = [decode_query_vector(item['embedding']) for item in records]
+    # 更换嵌入模型后维度不同的旧记录不参与比较
+    records = [item for item, v in zip(records, vectors) if v.shape == vec.shape]
+    if not records:
+        return []
+    matrix = np.vstack([v for v in vectors if v.shape == vec.shape])
+    similarities = matrix @ vec
+
+    seen = {str(case_id) for case_id in exclude_case_ids}
+    selected = []
+    for idx in np.argsort(-similarities):
+        if similarities[idx] < config.RAG_HISTORY_MIN_SIMILARITY or len(selected) >= limit:
+            break
+        record = records[idx]
+        for case in sorted(record['cases'], key=lambda c: -c.get('score', 0)):
+            if str(case['id']) in seen:
+                continue
+            seen.add(str(case['id']))
+            selected.append((case['id'], record['query'], float(similarities[idx])))
+            if len(selected) >= limit:
+                break
 
-    return relevant_cases[:3]  # 最多返回3个相关历史案例
+    cases = retrieval_system.get_cases([case_id for case_id, _, _ in selected]) if selected else {}
+    relevant_cases = []
+    for case_id, related_query, similarity in selected:
+        case = cases.get(case_id)
+        if case is None:
+            continue
+        meta = case['meta']
+        fact = case['fact']
+        relevant_cases.append({
+            'fact': fact[:200] + '...' if len(fact) > 200 else fact,
+            'accusation': meta.get('accusation', []),
+            'articles': meta.get('relevant_articles', []),
+            'imprisonment': meta.get('term_of_imprisonment', {}).get('imprisonment', '未知'),
+            'fine': meta.get('punish_of_money', '未知'),
+            'related_query': related_query,
+            'query_similarity': round(similarity, 4)
+        })
+    return relevant_cases
 
 
 def truncate_chat_history(history, max_turns=10):
@@ -316,102 +705,190 @@ def truncate_chat_history(history, max_turns=10):
     return truncated
 
 
+def get_history_for_prompt(conv, history):
+    """
+    返回发送给LLM的对话上下文
+
+    启用滚动摘要时为 (已有摘要, 摘要之后的近期对话)；否则退回按轮数截断 (保留最近10轮)。
+    注意：完整历史仍保存在数据库中。
+    """
+    if not config.HISTORY_SUMMARY_ENABLED:
+        return "", truncate_chat_history(history, max_turns=10)
+    summary_upto = min(conv.summary_upto or 0, len(history))
+    return conv.summary or "", history[summary_upto:]
+
+
+def schedule_history_summary(conversation_id):
+    """在后台线程中检查并更新对话摘要 (不阻塞当前回答)"""
+    if not config.HISTORY_SUMMARY_ENABLED:
+        return
+    with summarizing_lock:
+        if conversation_id in summarizing_conversations:
+            return
+        summarizing_conversations.add(conversation_id)
+
+    def worker():
+        try:
+            with app.app_context():
+                update_conversation_summary(conversation_id)
+        except Exception as e:
+            print(f"更新对话摘要失败 - 对话ID: {conversation_id}, 错误: {e}")
+        finally:
+            with summarizing_lock:
+                summarizing_conversations.discard(conversation_id)
+
+    threading.Thread(target=worker, daemon=True).start()
+
+
+def update_conversation_summary(conversation_id):
+    """
+    增量更新对话摘要：未摘要的历史超过token阈值时，把除最近几轮以外的部分合并进摘要
+
+    已并入摘要的消息不会再次处理；每次只把新增的较早轮次与已有摘要一起交给摘要模型。
+
+    返回:
+        bool: 是否更新了摘要
+    """
+    conv = db.session.get(Conversation, conversation_id)
+    if not conv:
+        return False
+    history = conv.get_history()
+    summary_upto = min(conv.summary_upto or 0, len(history))
+    pending = history[summary_upto:]
+    pending_tokens = sum(history_token_counter.count(m.get('content', '')) for m in pending)
+    if pending_tokens <= config.HISTORY_SUMMARY_TRIGGER_TOKENS:
+        return False
+
+    # 保留最近几轮完整对话，切分点对齐到用户消息
+    cut = len(history) - config.HISTORY_SUMMARY_KEEP_TURNS * 2
+    while cut > summary_upto and history[cut].get('role') != 'user':
+        cut -= 1
+    if cut <= summary_upto:
+        return False
+
+    previous_summary = conv.summary or ""
+    result = backend.summarize({
+        "summary": previous_summary,
+        "messages": [{"role": m.get('role'), "content": m.get('content', '')} for m in history[summary_upto:cut]],
+        "model_id": config.HISTORY_SUMMARY_MODEL
+    })
+
+    # 摘要期间对话可能被清空或已由其他进程更新，确认后再写入
+    db.session.refresh(conv)
+    if (conv.summary_upto or 0) != summary_upto or (conv.summary or "") != previous_summary \
+            or (conv.message_count or 0) < cut:
+        return False
+
+    # 更新摘要不改变对话在列表中的位置
+    original_updated_at = conv.updated_at
+    conv.summary = result.get("summary", previous_summary)
+    conv.summary_upto = cut
+    conv.updated_at = original_updated_at
+    db.session.commit()
+    print(f"更新对话摘要 - 对话ID: {conversation_id}, 已摘要消息数: {summary_upto} -> {cut}, "
+          f"未摘要历史 {pending_tokens} tokens")
+    return True
+
+
+def search_with_vector(query, k, query_vec=None):
+    """
+    编码查询 (已编码则跳过) 并检索案例
+
+    返回:
+        tuple: (检索结果, 查询向量)；查询向量随检索记录保存，供之后挑选历史案例
+    """
+    if query_vec is None:
+        query_vec = retrieval_system.encode_query(query)
+    return retrieval_system.search_similar_cases(query, k=k, min_score=RAG_MIN_SCORE, query_vec=query_vec), query_vec
+
+
 def parse_rag_query(response_text):
     """
     解析LLM回复中的RAG查询指令
 
+    标记规则与 RagQueryStreamParser 一致：标记不跨行、查询不超过 MAX_QUERY_CHARS 个字符、
+    在第一个 ']' 处结束；所有标记都从回复中移除，查询为空的标记视为没有查询。
+
     参数:
         response_text: LLM的完整回复文本
 
     返回:
         tuple: (清理后的回复文本, RAG查询关键词或None)
     """
-    # 匹配 [RAG_QUERY: xxx] 格式
-    pattern = r'\[RAG_QUERY:\s*(.+?)\]'
-    match = re.search(pattern, response_text)
-
-    if match:
-        query_keywords = match.group(1).strip()
-        # 从回复中移除RAG_QUERY标记
-        clean_response = re.sub(pattern, '', response_text).strip()
+    queries = [query.strip() for query in RAG_QUERY_PATTERN.findall(response_text)]
+    if not queries:
+        return response_text, None
+
+    # 从回复中移除RAG_QUERY标记
+    clean_response = RAG_QUERY_PATTERN.sub('', response_text).strip()
+    query_keywords = next((query for query in queries if query), None)
+    if query_keywords:
         print(f"检测到RAG查询请求: {query_keywords}")
-        return clean_response, query_keywords
-
-    return response_text, None
-
-class LegalCaseRetriever:
-    """法律案件检索器（Milvus 版）"""
-    model_loaded = False
-    def __init__(self, db_uri, model_path, collection_name="legal_cases"):
-        print("正在加载案件检索系统...")
-        self.collection_name = collection_name
-
-        # 连接本地 Milvus SQLite（由 build_database.ipynb 生成的 legal_assistant.db）
-        self.client = MilvusClient(db_uri)
-        if not self.client.has_collection(self.collection_name):
-            raise ValueError(f"Milvus 集合不存在: {self.collection_name}")
-
-        # 获取数据量，用于状态上报
-        stats = self.client.get_collection_stats(self.collection_name)
-        self.case_count = int(stats.get("row_count", 0))
-        print(f"✓ Milvus 已连接，集合包含 {self.case_count} 条记录")
-
-        # 加载嵌入模型
-        self.model = SentenceTransformer(model_path, trust_remote_code=True)
-        device = 'cuda' if torch.cuda.is_available() else 'cpu'
-        self.model.to(device)
-        print(f"✓ 嵌入模型已加载到: {device}")
-        print("案件检索系统初始化完成！")
-
-    def search_similar_cases(self, query_text, k=5, min_score=0.5):
-        """使用 Milvus 检索相似案件"""
-        query_vec = self.model.encode([query_text], normalize_embeddings=True)
-
-        # Milvus 按距离/相似度排序，需与建库时的 metric_type 一致
-        search_res = self.client.search(
-            collection_name=self.collection_name,
-            data=query_vec,
-            limit=k * 2,
-            output_fields=["id", "fact", "summary", "accusation"],
-            search_params={"metric_type": "COSINE"}
-        )
+    return clean_response, query_keywords
+
+
+class RagQueryStreamParser:
+    """
+    在回答流中逐块识别 [RAG_QUERY: ...] 标记 (标记可能被拆分到多个chunk中)
 
-        results = []
-        for hit in search_res[0]:
-            similarity = float(hit.get("distance", 0))
-            if similarity < min_score:
+    feed() 返回可立即转发给浏览器的文本 (已去掉标记)；可能是标记开头的部分先暂存，
+    确认不是标记后再随下一块一起转发。识别规则与 parse_rag_query 一致：标记不跨行。
+    """
+
+    OPEN = "[RAG_QUERY:"
+    MAX_QUERY_CHARS = 200
+
+    def __init__(self):
+        self.pending = ""
+        self.queries = []
+
+    def feed(self, text):
+        out = []
+        self.pending += text
+        while self.pending:
+            start = self.pending.find('[')
+            if start < 0:
+                out.append(self.pending)
+                self.pending = ""
+                break
+            out.append(self.pending[:start])
+            rest = self.pending[start:]
+            if not self.OPEN.startswith(rest[:len(self.OPEN)]):
+                # 不是标记：转发 '[' 后继续查找
+                out.append('[')
+                self.pending = rest[1:]
                 continue
+            if len(rest) < len(self.OPEN):
+                # 可能是标记开头，等待后续文本
+                self.pending = rest
+                break
 
-            entity = hit.get("entity", {})
-            formatted_case = {
-                "fact": entity.get("fact", ""),
-                "meta": {
-                    "relevant_articles": entity.get("articles", []),
-                    "accusation": entity.get("accusation", []),
-                    "punish_of_money": entity.get("fine", "未知"),
-                    "criminals": entity.get("criminals", []),
-                    "term_of_imprisonment": entity.get("term", {})
-                }
-            }
-            results.append({
-                'similarity_score': similarity,
-                'formatted_case': formatted_case
-            })
-
-            # 调试输出：打印命中的案件关键信息
-            if RAG_DEBUG:
-                fact_preview = formatted_case["fact"][:120] + ("..." if len(formatted_case["fact"]) > 120 else "")
-                print(
-                    f"[RAG] hit id={entity.get('id', 'N/A')} sim={similarity:.4f} "
-                    f"accusation={formatted_case['meta'].get('accusation', [])} "
-                    f"articles={formatted_case['meta'].get('relevant_articles', [])} "
-                    f"fact='{fact_preview}'"
-                )
-
-            if len(results) >= k:
+            content = rest[len(self.OPEN):]
+            end = content.find(']')
+            newline = content.find('\n')
+            broken = ((newline >= 0 and (end < 0 or newline < end))
+                      or (end < 0 and len(content) > self.MAX_QUERY_CHARS) or end > self.MAX_QUERY_CHARS)
+            if broken:
+                out.append('[')
+                self.pending = rest[1:]
+                continue
+            if end < 0:
+                self.pending = rest
                 break
+            query = content[:end].strip()
+            if query:
+                self.queries.append(query)
+            self.pending = content[end + 1:]
+        return "".join(out)
 
-        return results
+    def flush(self):
+        """流结束：返回仍暂存的文本 (未闭合的标记按原文转发)"""
+        rest, self.pending = self.pending, ""
+        return rest
+
+
+# 完整回复中的 [RAG_QUERY: ...] 标记 (与 RagQueryStreamParser 的识别规则相同)
+RAG_QUERY_PATTERN = re.compile(r'\[RAG_QUERY:([^\]\n]{0,%d})\]' % RagQueryStreamParser.MAX_QUERY_CHARS)
 
 
 def initialize_retrieval_system():
@@ -469,11 +946,43 @@ def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
 
+def recognize_upload(file_path):
+    """
+    识别上传的临时文件并删除 (在识别线程池中执行)
+
+    返回:
+        tuple: (识别文本, None) 或 (None, 错误信息)
+    """
+    try:
+        print(f"开始识别文件: {os.path.basename(file_path)}")
+        recognized_text = process_multimodal_file(file_path, cache=media_cache)
+        print(f"识别完成，文本长度: {len(recognized_text)}")
+        if is_recognition_failure(recognized_text):
+            return None, recognized_text or '识别结果为空'
+        return recognized_text, None
+    finally:
+        if os.path.exists(file_path):
+            os.remove(file_path)
+
+
+# 上传文件的异步识别任务（/upload_file 立即返回任务ID，识别在有界线程池中并发进行）
+upload_jobs = None
+if config.UPLOAD_JOBS_ENABLED:
+    upload_jobs = UploadJobManager(
+        recognize_upload,
+        max_workers=config.UPLOAD_JOB_WORKERS,
+        max_pending=config.UPLOAD_JOB_MAX_PENDING,
+        ttl_seconds=config.UPLOAD_JOB_TTL
+    )
+
+
 @app.route('/upload_file', methods=['POST'])
 def upload_file():
     """
     处理文件上传并识别内容
-    返回: {success, file_id, filename, file_type, text, error}
+    异步模式 (UPLOAD_JOBS_ENABLED): 保存文件并提交识别任务，立即返回 202 {success, job_id, file_id, filename,
+    file_type, status}，识别结果通过 /upload_jobs/<job_id> 或 /upload_jobs/events 获取
+    同步模式: 返回 {success, file_id, filename, file_type, text, error}
     """
     try:
         # 检查是否有文件
@@ -507,45 +1016,114 @@ def upload_file():
         ext = file.filename.rsplit('.', 1)[1].lower()
         file_type = 'image' if ext in ['jpg', 'jpeg', 'png'] else 'audio'
 
-        # 创建临时文件进行识别
+        # 创建临时文件进行识别 (识别完成后由 recognize_upload 删除)
         with tempfile.NamedTemporaryFile(delete=False, suffix=f'.{ext}') as tmp_file:
             file.save(tmp_file.name)
             tmp_path = tmp_file.name
 
-        try:
-            # 调用多模态识别
-            print(f"开始识别文件: {file.filename}, 类型: {file_type}")
-            recognized_text = process_multimodal_file(tmp_path)
-            print(f"识别完成，文本长度: {len(recognized_text)}")
-
-            # 检查是否识别失败
-            if recognized_text.startswith('错误') or recognized_text.startswith('系统级异常'):
-                return jsonify({
-                    'success': False,
-                    'error': recognized_text
-                }), 500
-
-            # 生成文件ID
-            file_id = str(uuid.uuid4())[:8]
+        if upload_jobs is not None:
+            job = upload_jobs.submit(session.get('session_id'), tmp_path, file.filename, file_type)
+            if job is None:
+                os.remove(tmp_path)
+                return jsonify({'success': False, 'error': '当前识别任务较多，请稍后再试'}), 503
+            print(f"已提交识别任务 {job.job_id}: {file.filename}, 类型: {file_type}")
+            return jsonify({'success': True, 'file_id': job.job_id, **job.snapshot()}), 202
 
-            return jsonify({
-                'success': True,
-                'file_id': file_id,
-                'filename': file.filename,
-                'file_type': file_type,
-                'text': recognized_text
-            })
+        recognized_text, error = recognize_upload(tmp_path)
+        if error:
+            return jsonify({'success': False, 'error': error}), 500
 
-        finally:
-            # 删除临时文件
-            if os.path.exists(tmp_path):
-                os.remove(tmp_path)
+        return jsonify({
+            'success': True,
+            'file_id': str(uuid.uuid4())[:8],
+            'filename': file.filename,
+            'file_type': file_type,
+            'text': recognized_text
+        })
 
     except Exception as e:
         print(f"文件上传处理错误: {str(e)}")
         return jsonify({'success': False, 'error': f'处理失败: {str(e)}'}), 500
 
 
+@app.route('/upload_jobs/<job_id>', methods=['GET'])
+def upload_job_status(job_id):
+    """查询本会话的识别任务状态 (轮询)；识别完成后带识别文本"""
+    if upload_jobs is None:
+        return jsonify({'error': '未启用异步识别'}), 404
+    job = upload_jobs.get(session.get('session_id'), job_id)
+    if job is None:
+        return jsonify({'error': '识别任务不存在或已过期'}), 404
+    return jsonify(job)
+
+
+@app.route('/upload_jobs/events', methods=['GET'])
+def upload_job_events():
+    """
+    识别任务的进度流 (Server-Sent Events)
+    参数: ids=逗号分隔的任务ID；每次任务状态变化发送一条 "job" 事件，全部结束 (或超时) 后发送 "end" 事件并关闭
+    """
+    if upload_jobs is None:
+        return jsonify({'error': '未启用异步识别'}), 404
+    job_ids = [job_id for job_id in request.args.get('ids', '').split(',') if job_id][:MAX_FILES_COUNT * 4]
+    if not job_ids:
+        return jsonify({'error': '缺少任务ID'}), 400
+    session_key = session.get('session_id')
+
+    def generate():
+        seen = {}
+        finished = set()
+        deadline = time.monotonic() + config.UPLOAD_JOB_EVENTS_TIMEOUT
+        while len(finished) < len(job_ids):
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            changed = upload_jobs.changes(session_key, job_ids, seen, timeout=min(15.0, remaining))
+            if not changed:
+                yield ": keepalive\n\n"  # 保持连接 (代理的空闲超时)
+                continue
+            for job in changed:
+                seen[job['job_id']] = job['version']
+                if job['status'] in ('done', 'error', 'not_found'):
+                    finished.add(job['job_id'])
+                yield f"event: job\ndata: {json.dumps(job, ensure_ascii=False)}\n\n"
+        yield "event: end\ndata: {}\n\n"
+
+    return Response(generate(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+def resolve_attachment_jobs(attachments):
+    """
+    发送消息时仍在识别的附件只带 job_id：等待这些任务完成并填入识别文本 (已带文本的附件不等待)
+
+    返回:
+        tuple: (附件列表, None) 或 (None, 需直接返回给客户端的响应)
+    """
+    pending = [att['job_id'] for att in attachments if att.get('job_id') and not att.get('text')]
+    if not pending:
+        return attachments, None
+    if upload_jobs is None:
+        return None, (jsonify({'error': '附件识别任务不存在'}), 400)
+
+    jobs = upload_jobs.wait(session.get('session_id'), pending, timeout=config.UPLOAD_JOB_WAIT_TIMEOUT)
+    resolved = []
+    for att in attachments:
+        job = jobs.get(att.get('job_id')) if att.get('job_id') and not att.get('text') else None
+        if job is None and att.get('job_id') in jobs:
+            return None, (jsonify({'error': f"附件识别任务不存在或已过期: {att.get('filename', '')}"}), 400)
+        if job is None:
+            resolved.append(att)
+        elif job['status'] == 'error':
+            return None, (jsonify({'error': f"附件识别失败: {job['filename']}: {job['error']}"}), 400)
+        elif job['status'] != 'done':
+            return None, (jsonify({'error': f"附件仍在识别中，请稍后重试: {job['filename']}"}), 504)
+        else:
+            resolved.append({'file_id': job['job_id'], 'filename': job['filename'],
+                             'file_type': job['file_type'], 'text': job['text']})
+    return resolved, None
+
+
 # 新增的对话管理路由
 @app.route('/conversations', methods=['GET'])
 def get_conversations():
@@ -554,8 +1132,19 @@ def get_conversations():
     if not session_id:
         return jsonify({'error': '会话不存在'}), 400
 
-    conversations = get_conversation_list(session_id)
-    return jsonify({'conversations': conversations})
+    try:
+        conversations, next_cursor = get_conversation_list(
+            session_id, read_page_limit(config.CONVERSATION_PAGE_SIZE), request.args.get('cursor'))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    # 当前对话可能不在第一页，单独返回其ID
+    current = Conversation.query.filter_by(session_id=session_id, is_current=True).first()
+    return jsonify({
+        'conversations': conversations,
+        'next_cursor': next_cursor,
+        'current_conversation_id': current.id if current else None
+    })
 
 @app.route('/conversations/new', methods=['POST'])
 def create_conversation():
@@ -568,12 +1157,13 @@ def create_conversation():
     title = data.get('title', '新对话')
 
     new_conv = create_new_conversation(session_id, title)
-    conversations = get_conversation_list(session_id)
+    conversations, next_cursor = get_conversation_list(session_id)
 
     return jsonify({
         'success': True,
         'conversation_id': new_conv.id,
-        'conversations': conversations
+        'conversations': conversations,
+        'next_cursor': next_cursor
     })
 
 @app.route('/conversations/<conversation_id>/switch', methods=['POST'])
@@ -585,20 +1175,83 @@ def switch_to_conversation(conversation_id):
 
     if switch_conversation(session_id, conversation_id):
         current_conv = get_current_conversation(session_id)
-        conversations = get_conversation_list(session_id)
+        # 只返回最近一页消息，更早的消息由 /conversations/<id>/messages 按需加载
+        history, next_before = get_message_page(conversation_id, limit=read_page_limit(config.HISTORY_PAGE_SIZE))
 
         return jsonify({
             'success': True,
             'current_conversation': {
                 'id': conversation_id,
                 'title': current_conv.title,
-                'history': current_conv.get_history()
-            },
-            'conversations': conversations
+                'history': history,
+                'next_before': next_before
+            }
         })
     else:
         return jsonify({'error': '对话不存在'}), 404
 
+@app.route('/conversations/<conversation_id>/messages', methods=['GET'])
+def get_conversation_messages(conversation_id):
+    """分页获取对话消息：before 为上一页返回的 next_before，不传时返回最新一页"""
+    session_id = session.get('session_id')
+    if not session_id:
+        return jsonify({'error': '会话不存在'}), 400
+
+    wait_for_pending_writes(session_id)
+    if not Conversation.query.filter_by(id=conversation_id, session_id=session_id).first():
+        return jsonify({'error': '对话不存在'}), 404
+
+    messages, next_before = get_message_page(conversation_id, request.args.get('before', type=int),
+                                             read_page_limit(config.HISTORY_PAGE_SIZE))
+    return jsonify({'messages': messages, 'next_before': next_before})
+
+@app.route('/search', methods=['GET'])
+def search_conversations():
+    """在用户的全部对话中全文搜索消息内容，返回匹配的对话与消息片段 (按BM25相关度排序)"""
+    session_id = session.get('session_id')
+    if not session_id:
+        return jsonify({'error': '会话不存在'}), 400
+    if not message_search_available:
+        return jsonify({'error': '全文搜索未启用'}), 503
+
+    query = (request.args.get('q') or '').strip()
+    if not query:
+        return jsonify({'error': '搜索内容不能为空'}), 400
+
+    wait_for_pending_writes(session_id)
+    result = search_messages(
+        db.session, session_id, query,
+        limit=read_page_limit(config.SEARCH_PAGE_SIZE),
+        snippets_per_conversation=config.SEARCH_SNIPPETS_PER_CONVERSATION,
+        max_hits=config.SEARCH_MAX_HITS
+    )
+    return jsonify({'query': query, **result})
+
+@app.route('/messages/<int:message_id>/judge', methods=['GET'])
+def get_judge_payload(message_id):
+    """获取一条Judge回答的完整数据 (裁判理由与各模型的回答)，前端展开对比时调用"""
+    session_id = session.get('session_id')
+    if not session_id:
+        return jsonify({'error': '会话不存在'}), 400
+
+    wait_for_pending_writes(session_id)
+    row = db.session.query(JudgePayload, Message).join(Message, JudgePayload.message_id == Message.id)\
+        .join(Conversation, Message.conversation_id == Conversation.id)\
+        .filter(JudgePayload.message_id == message_id, Conversation.session_id == session_id).first()
+    if row is None:
+        return jsonify({'error': 'Judge数据不存在'}), 404
+
+    judge_payload, message = row
+    data = json.loads(judge_payload.payload)
+    ref = message.to_message().get('judge_ref', {})
+    return jsonify({
+        'message_id': message_id,
+        'model_used': ref.get('model_used'),
+        'best_answer': message.content,
+        'judge_reasoning': data.get('judge_reasoning', ''),
+        'all_answers': data.get('all_answers', {})
+    })
+
 @app.route('/conversations/<conversation_id>', methods=['DELETE'])
 def delete_conversation_route(conversation_id):
     """删除对话"""
@@ -607,240 +1260,568 @@ def delete_conversation_route(conversation_id):
         return jsonify({'error': '会话不存在'}), 400
 
     if delete_conversation(session_id, conversation_id):
-        conversations = get_conversation_list(session_id)
+        conversations, next_cursor = get_conversation_list(session_id)
         return jsonify({
             'success': True,
-            'conversations': conversations
+            'conversations': conversations,
+            'next_cursor': next_cursor
         })
     else:
         return jsonify({'error': '对话不存在'}), 404
 
-@app.route('/send_message', methods=['POST'])
-def send_message():
-    """接收用户消息并转发到后端API - 支持流式响应和附件"""
-    try:
-        # 检查用户是否已接受免责声明
-        if not session.get('disclaimer_accepted', False):
-            return jsonify({'error': '请先阅读并接受免责声明'}), 403
+def admit_chat_turn(data):
+    """
+    /send_message 的准入控制：按会话限流，并发已满时排队等待
 
-        # 获取用户输入和参数
-        user_message = request.json.get('message', '')
-        selected_model = request.json.get('model', session.get('selected_model', 'deepseek'))
-        is_professional_mode = request.json.get('is_professional_mode', False)
-        rag_enabled = request.json.get('rag_enabled', session.get('rag_enabled', True))
+    需在请求上下文中调用 (读取 session)。
 
-        # 获取附件信息（多模态识别结果）
-        attachments = request.json.get('attachments', [])
+    返回:
+        tuple: (ticket, None) 或 (None, 拒绝响应)；未启用准入控制时 ticket 为 None
+    """
+    if admission is None:
+        return None, None
+    heavy = data.get('model', session.get('selected_model', 'deepseek')) == 'judge'
+    try:
+        return admission.acquire(session.get('session_id') or request.remote_addr, heavy=heavy), None
+    except AdmissionRejected as e:
+        print(f"请求被拒绝 ({e.reason})，建议 {e.retry_after} 秒后重试")
+        return None, (jsonify(e.payload()), e.status, {'Retry-After': str(e.retry_after)})
 
-        # 保存模型选择和RAG设置
-        session['selected_model'] = selected_model
-        session['rag_enabled'] = rag_enabled
 
-        if not user_message and not attachments:
-            return jsonify({'error': '消息不能为空'}), 400
+def prepare_chat_turn(data, degrade_level=LEVEL_NORMAL):
+    """
+    /send_message 的同步准备阶段：校验请求、合并附件、读取对话、RAG检索、构造后端请求
 
-        # 如果有附件，将附件识别文本合并到用户消息中
-        final_message = user_message
-        if attachments:
-            attachment_texts = []
-            for att in attachments:
-                file_type_name = "图片" if att.get('file_type') == 'image' else "音频"
-                attachment_texts.append(f"【{file_type_name}附件: {att.get('filename', '未知文件')}】\n{att.get('text', '')}")
+    需在请求上下文中调用 (读写 session)。
+    degrade_level 为准入时确定的降级等级：Judge 改由单模型回答、减少检索案例数。
 
-            attachments_content = "\n\n".join(attachment_texts)
-            if user_message:
-                final_message = f"【附件内容】\n{attachments_content}\n\n【用户提问】\n{user_message}"
-            else:
-                final_message = f"【附件内容】\n{attachments_content}\n\n【用户提问】\n请分析以上附件内容。"
+    返回:
+        tuple: (turn, None) 或 (None, 需直接返回给客户端的响应)
+        turn 字典包含 payload / user_message / session_id / conversation_id / request_id /
+        attachments / semantic_ctx / judge_degraded / unit (本轮的 TurnUnitOfWork，结束时须 commit)
+    """
+    # 检查用户是否已接受免责声明
+    if not session.get('disclaimer_accepted', False):
+        return None, (jsonify({'error': '请先阅读并接受免责声明'}), 403)
 
-            print(f"消息包含 {len(attachments)} 个附件，合并后消息长度: {len(final_message)}")
+    # 获取用户输入和参数
+    user_message = data.get('message', '')
+    selected_model = data.get('model', session.get('selected_model', 'deepseek'))
+    is_professional_mode = data.get('is_professional_mode', False)
+    rag_enabled = data.get('rag_enabled', session.get('rag_enabled', True))
 
-        # 获取当前对话（从数据库）
-        session_id = session.get('session_id')
-        current_conv = get_current_conversation(session_id)
-        conversation_history = current_conv.get_history()
-        conversation_id = current_conv.id
+    # 获取附件信息（多模态识别结果）
+    attachments = data.get('attachments', [])
 
-        # 截断对话历史，防止token超限（保留最近10轮对话）
-        # 注意：完整历史仍保存在数据库中，仅传递给LLM时截断
-        truncated_history = truncate_chat_history(conversation_history, max_turns=10)
+    # 保存模型选择和RAG设置 (未变化时不赋值，会话无需写回)
+    if session.get('selected_model') != selected_model:
+        session['selected_model'] = selected_model
+    if session.get('rag_enabled') != rag_enabled:
+        session['rag_enabled'] = rag_enabled
 
-        # 如果是第一条消息，更新对话标题（使用原始用户消息，不含附件前缀）
-        if len(conversation_history) == 0:
-            update_conversation_title(session_id, conversation_id, user_message if user_message else "附件分析")
+    if not user_message and not attachments:
+        return None, (jsonify({'error': '消息不能为空'}), 400)
+
+    # 过载降级：Judge 改由单个模型回答 (会话中保存的模型选择不变)
+    judge_degraded = selected_model == 'judge' and degrade_level >= LEVEL_NO_JUDGE
+    if judge_degraded:
+        print(f"负载较高，Judge 模式降级为单模型 {config.ADMISSION_JUDGE_FALLBACK_MODEL}")
+
+    # 如果有附件，将附件识别文本合并到用户消息中
+    final_message = user_message
+    if attachments:
+        attachment_texts = []
+        for att in attachments:
+            file_type_name = "图片" if att.get('file_type') == 'image' else "音频"
+            attachment_texts.append(f"【{file_type_name}附件: {att.get('filename', '未知文件')}】\n{att.get('text', '')}")
+
+        attachments_content = "\n\n".join(attachment_texts)
+        if user_message:
+            final_message = f"【附件内容】\n{attachments_content}\n\n【用户提问】\n{user_message}"
+        else:
+            final_message = f"【附件内容】\n{attachments_content}\n\n【用户提问】\n请分析以上附件内容。"
 
-        # 确定使用的RAG数据（使用原始用户消息进行检索，更精准）
-        current_rag_data = []
-        rag_query = user_message if user_message else "法律文件分析"
-        if rag_enabled and retrieval_system is not None:
-            print(f"正在进行RAG检索，查询: {rag_query}")
-            retrieval_results = retrieval_system.search_similar_cases(rag_query, k=2, min_score=0.4)
-            current_rag_data = [result['formatted_case'] for result in retrieval_results]
-            print(f"RAG检索完成，找到 {len(current_rag_data)} 个相关案例")
+        print(f"消息包含 {len(attachments)} 个附件，合并后消息长度: {len(final_message)}")
 
-            # 保存检索案例到历史
-            add_rag_to_history(session_id, conversation_id, current_rag_data, rag_query)
+    # 获取当前对话（从数据库）
+    session_id = session.get('session_id')
+    current_conv = get_current_conversation(session_id)
+    conversation_history = current_conv.get_history()
+    conversation_id = current_conv.id
+    # 本轮的数据库写入累积在工作单元中，回答结束后由后台队列一次写入
+    unit = TurnUnitOfWork(current_conv)
+
+    # 较早的对话以摘要形式发送，近期对话完整发送，每轮提示词大小基本恒定
+    conversation_summary, recent_history = get_history_for_prompt(current_conv, conversation_history)
+
+    # 如果是第一条消息，更新对话标题（使用原始用户消息，不含附件前缀）
+    if len(conversation_history) == 0 and current_conv.title == "新对话":
+        unit.set_title(make_conversation_title(user_message if user_message else "附件分析"))
+
+    # 确定使用的RAG数据（使用原始用户消息进行检索，更精准）
+    current_rag_data = []
+    current_case_ids = []
+    rag_query = user_message if user_message else "法律文件分析"
+
+    # 语义缓存仅适用于首轮、无附件的单模型提问
+    use_semantic_cache = (semantic_cache is not None and retrieval_system is not None
+                          and selected_model != 'judge' and not conversation_history
+                          and not attachments and bool(user_message))
+    # 过载降级：减少检索案例数
+    rag_k = config.ADMISSION_DEGRADED_K if degrade_level >= LEVEL_REDUCED_K else RAG_TOP_K
+
+    # 输入时已预取过相同或近似草稿的检索结果则直接复用
+    prefetched = None
+    if rag_enabled and retrieval_system is not None and rag_prefetcher is not None and user_message:
+        prefetched = rag_prefetcher.take(session_id, rag_query, rag_k, RAG_MIN_SCORE)
+
+    query_vec = None
+    if use_semantic_cache:
+        # 只有精确命中的预取向量与本次提问一致
+        exact = prefetched is not None and prefetched.match == 'exact'
+        query_vec = prefetched.query_vec if exact else retrieval_system.encode_query(rag_query)
+
+    historical_rag_data = []
+    if rag_enabled and retrieval_system is not None:
+        if prefetched is not None:
+            print(f"复用输入时预取的RAG检索结果 ({prefetched.match}，节省 {prefetched.compute_ms:.0f} ms): {prefetched.query}")
+            retrieval_results = prefetched.results[:rag_k]
+            # 近似命中时为草稿的向量，用于挑选历史案例已足够
+            history_vec = prefetched.query_vec
         else:
-            print("RAG功能已关闭，不使用案例检索")
-
-        # 获取相关历史检索案例
-        historical_rag_data = []
-        if rag_enabled:
-            historical_rag_data = get_relevant_rag_history(session_id, conversation_id, rag_query)
-            print(f"找到 {len(historical_rag_data)} 个相关历史检索案例")
-
-        # 构造发送给API的请求数据，使用合并后的消息
-        payload = {
-            "user_question": final_message,  # 使用包含附件的完整消息
-            "rag_data": current_rag_data,
-            "historical_rag_data": historical_rag_data,
-            "chat_history": truncated_history,
-            "model_id": selected_model,
-            "is_professional_mode": is_professional_mode
+            print(f"正在进行RAG检索，查询: {rag_query}")
+            retrieval_results, query_vec = search_with_vector(rag_query, rag_k, query_vec)
+            history_vec = query_vec
+        current_rag_data = [result['formatted_case'] for result in retrieval_results]
+        current_case_ids = [result['case_id'] for result in retrieval_results]
+        print(f"RAG检索完成，找到 {len(current_rag_data)} 个相关案例")
+
+        # 获取相关历史检索案例 (按查询向量相似度排序，排除本轮已检索到的案例)
+        historical_rag_data = get_relevant_rag_history(unit.rag_history, history_vec, current_case_ids)
+        print(f"找到 {len(historical_rag_data)} 个相关历史检索案例")
+
+        # 记录本轮检索 (案例ID、相似度与查询向量)
+        unit.add_rag_record(make_rag_record(retrieval_results, rag_query, history_vec))
+    else:
+        print("RAG功能已关闭，不使用案例检索")
+
+    # 前端为每次发送生成 request_id，用于 /cancel_request 取消 (登记时加上会话标识)
+    request_id = session_request_id(session_id, data.get('request_id') or str(uuid.uuid4()))
+
+    # 构造发送给API的请求数据，使用合并后的消息
+    payload = {
+        "user_question": final_message,  # 使用包含附件的完整消息
+        "rag_data": current_rag_data,
+        "historical_rag_data": historical_rag_data,
+        "chat_history": recent_history,
+        "conversation_summary": conversation_summary,
+        "model_id": config.ADMISSION_JUDGE_FALLBACK_MODEL if judge_degraded else selected_model,
+        "is_professional_mode": is_professional_mode,
+        "cache_control": data.get('cache_control'),  # 如 "no-cache" 可跳过后端回答缓存
+        "request_id": request_id,
+        "conversation_id": conversation_id
+    }
+
+    semantic_ctx = None
+    if use_semantic_cache:
+        semantic_ctx = {
+            'namespace': semantic_cache_namespace(selected_model, is_professional_mode),
+            'vector': query_vec,
+            'question': user_message,
+            'case_signature': make_case_signature(current_case_ids) if rag_enabled else ''
         }
+        no_cache = 'no-cache' in str(payload.get('cache_control') or '').lower()
+        cached = None if no_cache else semantic_cache.lookup(
+            semantic_ctx['namespace'], query_vec, semantic_ctx['case_signature'])
+        if cached:
+            print(f"语义缓存命中 (相似度 {cached['similarity']:.4f}): {cached['question']}")
+            return None, replay_semantic_cache_hit(cached, final_message, unit)
+
+    # 注意：保存到历史时使用final_message，同时传递附件信息
+    turn = {
+        'payload': payload,
+        'user_message': final_message,
+        'session_id': session_id,
+        'conversation_id': conversation_id,
+        'request_id': request_id,
+        'attachments': attachments,
+        'semantic_ctx': semantic_ctx,
+        'judge_degraded': judge_degraded,
+        'unit': unit
+    }
+    return turn, None
 
-        headers = {"Content-Type": "application/json"}
 
-        # 对于judge模型，使用非流式请求
-        # 注意：保存到历史时使用final_message，同时传递附件信息
-        if selected_model == 'judge':
-            return handle_judge_request(payload, headers, conversation_history, final_message, session_id, conversation_id, attachments)
+@app.route('/send_message', methods=['POST'])
+def send_message():
+    """接收用户消息并转发到后端API - 支持流式响应和附件"""
+    data = request.json or {}
+    # 先等待仍在识别的附件 (不占用准入名额)
+    if data.get('attachments'):
+        data['attachments'], unresolved = resolve_attachment_jobs(data['attachments'])
+        if unresolved is not None:
+            return unresolved
+    ticket, rejected = admit_chat_turn(data)
+    if rejected is not None:
+        return rejected
+
+    turn = None
+    try:
+        turn, early_response = prepare_chat_turn(data, ticket.level if ticket else LEVEL_NORMAL)
+        if early_response is not None:
+            rv = early_response
+        # 对于judge模型，使用非流式请求；其他模型使用流式请求
+        elif turn['payload']['model_id'] == 'judge':
+            rv = handle_judge_request(turn)
+        elif turn['judge_degraded']:
+            rv = handle_degraded_judge_request(turn)
         else:
-            # 对于其他模型，使用流式请求
-            return handle_streaming_request(payload, headers, conversation_history, final_message, session_id, conversation_id, attachments)
+            rv = handle_streaming_request(turn)
 
     except Exception as e:
-        return jsonify({'error': f'处理请求时出错: {str(e)}'}), 500
+        rv = (jsonify({'error': f'处理请求时出错: {str(e)}'}), 500)
+
+    response = make_response(rv)
+    if ticket is not None:
+        # 响应发送完毕 (流式回答结束或浏览器断开) 后才释放并发名额
+        response.call_on_close(ticket.release)
+    if turn is not None:
+        # 出错或浏览器中途断开时，本轮已累积的写入 (标题、检索记录) 同样提交
+        response.call_on_close(turn['unit'].commit)
+    return response
+
 
-def handle_judge_request(payload, headers, conversation_history, user_message, session_id, conversation_id, attachments=None):
+def complete_judge_turn(turn, result):
+    """
+    保存Judge模式的一轮对话
+
+    返回:
+        dict: 返回给前端的结果；后端结果不含 prediction 时返回None
+    """
+    if "prediction" not in result:
+        turn['unit'].commit()
+        return None
+
+    assistant_response = result["prediction"]
+    model_used = result.get("model_used", "未知")
+    judge_reasoning = result.get("judge_reasoning", "")
+    all_answers = result.get("all_answers", {})
+
+    # 更新对话历史
+    # 用户消息：如果有附件，保存附件信息供前端查看
+    user_msg = {"role": "user", "content": turn['user_message']}
+    if turn['attachments']:
+        user_msg["attachments"] = turn['attachments']  # 保存附件信息
+
+    # Judge模式的回答：存储最佳回答作为content；历史中只保留引用，完整数据另存 judge_payloads 表
+    judge_message = {
+        "role": "assistant",
+        "content": assistant_response,  # 最佳回答，用于下次对话的上下文
+        "is_judge_mode": True,  # 标记这是Judge模式的回答
+        "judge_ref": {  # 前端据此显示模型选择器，展开对比时再按 message_id 获取完整数据
+            "model_used": model_used,
+            "models": list(all_answers)
+        },
+        "judge_payload": {
+            "judge_reasoning": judge_reasoning,
+            "all_answers": all_answers
+        }
+    }
+    turn['unit'].add_messages([user_msg, judge_message])
+    turn['unit'].commit()
+
+    return {
+        'response': assistant_response,
+        'model_used': model_used,
+        'judge_reasoning': judge_reasoning,
+        'all_answers': all_answers,
+        'prompt_tokens': result.get("prompt_tokens"),
+        'should_exit': False
+    }
+
+
+def handle_judge_request(turn):
     """处理Judge模型的非流式请求"""
     try:
-        response = requests.post(API_URL, headers=headers, json=payload, timeout=120)
-        response.raise_for_status()
-        result = response.json()
+        result = backend.judge(turn['payload'])
+    except TransportTimeout as e:
+        return jsonify({'error': str(e)}), 504
+    except TransportError as e:
+        # 后端限流/过载 (429/503) 原样告知前端
+        return jsonify({'error': str(e)}), e.status if e.status in (429, 503) else 500
 
-        if "prediction" in result:
-            assistant_response = result["prediction"]
-            model_used = result.get("model_used", "未知")
-            judge_reasoning = result.get("judge_reasoning", "")
-            all_answers = result.get("all_answers", {})
+    body = complete_judge_turn(turn, result)
+    if body is None:
+        return jsonify({'error': f'后端返回错误: {result.get("error", "未知错误")}'}), 500
+    return jsonify(body)
 
-            # 更新对话历史
-            # 用户消息：如果有附件，保存附件信息供前端查看
-            user_msg = {"role": "user", "content": user_message}
-            if attachments:
-                user_msg["attachments"] = attachments  # 保存附件信息
-            conversation_history.append(user_msg)
-
-            # Judge模式的回答：存储最佳回答作为content，同时保存完整数据用于前端展示
-            judge_message = {
-                "role": "assistant",
-                "content": assistant_response,  # 最佳回答，用于下次对话的上下文
-                "is_judge_mode": True,  # 标记这是Judge模式的回答
-                "judge_data": {  # Judge模式的完整数据，用于前端展示
-                    "model_used": model_used,
-                    "judge_reasoning": judge_reasoning,
-                    "all_answers": all_answers,
-                    "best_answer": assistant_response
-                }
-            }
-            conversation_history.append(judge_message)
-            save_conversation_history(session_id, conversation_id, conversation_history)
 
-            return jsonify({
-                'response': assistant_response,
-                'model_used': model_used,
-                'judge_reasoning': judge_reasoning,
-                'all_answers': all_answers,
-                'should_exit': False
-            })
-        else:
-            return jsonify({'error': f'后端返回错误: {result.get("error", "未知错误")}'}), 500
+def finish_degraded_judge_turn(relay, error=None):
+    """
+    Judge 降级为单模型回答后的收尾：保存对话历史，按 Judge 接口的JSON格式返回 (前端Judge分支不处理流式响应)
 
-    except requests.exceptions.Timeout:
-        return jsonify({'error': '请求超时 (Judge模式需要更长时间)'}), 504
-    except requests.exceptions.RequestException as e:
-        return jsonify({'error': f'网络请求错误: {str(e)}'}), 500
+    返回:
+        tuple: (响应内容, HTTP状态码)
+    """
+    if error or relay.stream_had_error or not relay.full_response:
+        return {'error': error or '后端返回错误'}, 500
+    for _ in relay.complete():
+        pass
+    clean_response, _ = parse_rag_query(relay.full_response)
+    return {
+        'response': clean_response,
+        'model_used': relay.model_used,
+        'judge_reasoning': JUDGE_DEGRADED_NOTICE,
+        'all_answers': {},
+        'prompt_tokens': relay.prompt_tokens,
+        'degraded': True,
+        'should_exit': False
+    }, 200
+
+
+def handle_degraded_judge_request(turn):
+    """过载降级时的Judge请求：读完单模型的流式回答后一次性返回"""
+    relay = StreamRelay(turn)
+    error = None
+    source = None
+    try:
+        source = backend.stream(turn['payload'])
+        for event in source:
+            for out in relay.feed(event):
+                if out['event'] == 'error':
+                    error = out['error']
+            if relay.finished:
+                break
+    except TransportError as e:
+        return jsonify({'error': str(e)}), e.status if e.status in (429, 503, 504) else 500
+    finally:
+        if source is not None:
+            source.close()
+        relay.close()
+
+    body, status = finish_degraded_judge_turn(relay, error)
+    return jsonify(body), status
+
+
+def semantic_cache_namespace(model_id, is_professional_mode):
+    """语义缓存命名空间：模型 + 普通/专业模式"""
+    return f"{model_id}:{'professional' if is_professional_mode else 'normal'}"
 
-def handle_streaming_request(payload, headers, conversation_history, user_message, session_id, conversation_id, attachments=None):
-    """处理流式请求，支持LLM主动触发RAG查询"""
 
-    # 从payload中提取需要的参数，用于可能的二次请求
-    rag_enabled = payload.get('rag_data') is not None or True
+def sse_event(event):
+    """将事件字典编码为发往浏览器的 data: 行"""
+    return f"data: {json.dumps(event)}\n\n"
+
+
+def replay_semantic_cache_hit(cached, user_message, unit):
+    """将语义缓存命中的回答以与实时回答相同的事件格式返回，并写入对话历史"""
+    answer = cached['answer']
+
+    unit.add_messages([
+        {"role": "user", "content": user_message},
+        {"role": "assistant", "content": answer}
+    ])
+    unit.commit()
 
     def generate():
-        full_response = ""
-        stream_had_error = False
+        yield sse_event({'event': 'model_info', 'model_used': cached['model_used']})
+        yield sse_event({'event': 'chunk', 'chunk': answer})
+        yield sse_event({'event': 'end_of_stream', 'full_response': answer, 'cached': True})
 
-        try:
-            with requests.post(API_URL, headers=headers, json=payload, stream=True, timeout=60) as response:
-                response.raise_for_status()
+    return Response(generate(), content_type='text/plain')
 
-                for line in response.iter_lines(decode_unicode=True):
-                    if not line:
-                        continue
 
-                    if line.startswith("event: model_info"):
-                        pass
-                    elif line.startswith("event: end_of_stream"):
-                        if full_response and not stream_had_error:
-                            # 检查是否有RAG查询请求
-                            clean_response, rag_query = parse_rag_query(full_response)
-
-                            if rag_query and retrieval_system is not None:
-                                # LLM请求了额外的RAG查询
-                                yield f"data: {json.dumps({'event': 'rag_query_detected', 'query': rag_query})}\n\n"
-
-                                # 执行RAG查询
-                                print(f"执行LLM请求的RAG查询: {rag_query}")
-                                retrieval_results = retrieval_system.search_similar_cases(rag_query, k=3, min_score=0.4)
-                                new_rag_data = [result['formatted_case'] for result in retrieval_results]
-                                print(f"RAG查询完成，找到 {len(new_rag_data)} 个案例")
-
-                                if new_rag_data:
-                                    # 保存新检索的案例到历史
-                                    add_rag_to_history(session_id, conversation_id, new_rag_data, rag_query)
-
-                                    # 通知前端找到了新案例
-                                    yield f"data: {json.dumps({'event': 'rag_results_found', 'count': len(new_rag_data)})}\n\n"
-
-                            # 更新对话历史（使用清理后的回复，不含RAG_QUERY标记）
-                            # 用户消息：如果有附件，保存附件信息供前端查看
-                            user_msg = {"role": "user", "content": user_message}
-                            if attachments:
-                                user_msg["attachments"] = attachments
-                            conversation_history.append(user_msg)
-                            conversation_history.append({"role": "assistant", "content": clean_response})
-                            save_conversation_history(session_id, conversation_id, conversation_history)
-
-                        yield f"data: {json.dumps({'event': 'end_of_stream', 'full_response': full_response})}\n\n"
-                        break
-                    elif line.startswith("event: error"):
-                        stream_had_error = True
-                    elif line.startswith("data: "):
-                        try:
-                            data_str = line.split("data: ", 1)[1]
-                            data_json = json.loads(data_str)
-
-                            if "model_used" in data_json:
-                                model_info = data_json.get("model_used", "未知")
-                                yield f"data: {json.dumps({'event': 'model_info', 'model_used': model_info})}\n\n"
-
-                            elif "chunk" in data_json:
-                                chunk = data_json.get("chunk", "")
-                                full_response += chunk
-                                yield f"data: {json.dumps({'event': 'chunk', 'chunk': chunk})}\n\n"
-
-                            elif "error" in data_json:
-                                stream_had_error = True
-                                error_msg = data_json.get("error", "未知流错误")
-                                yield f"data: {json.dumps({'event': 'error', 'error': error_msg})}\n\n"
-
-                        except (json.JSONDecodeError, IndexError):
-                            pass
-
-        except requests.exceptions.RequestException as e:
-            yield f"data: {json.dumps({'event': 'error', 'error': f'网络请求错误: {str(e)}'})}\n\n"
+class StreamRelay:
+    """
+    将后端事件转换为浏览器事件的中继状态机 (同步/异步服务共用)
+
+    feed() 只做内存操作，可在事件循环中直接调用；识别到 RAG_QUERY 标记时把补充检索提交到后台线程，
+    并从转发的chunk中去掉标记。收到 end_of_stream 后由调用方执行 complete()，其中包含写库等阻塞操作。
+    中途退出时调用 close() 取消尚未开始的后台检索。
+    """
+
+    def __init__(self, turn):
+        self.turn = turn
+        self.full_response = ""
+        self.model_used = ""
+        self.prompt_tokens = None
+        self.stream_had_error = False
+        self.finished = False
+        self.rag_parser = RagQueryStreamParser()
+        self.rag_future = None
+        self.rag_future_query = None
+
+    def _start_followup_retrieval(self):
+        """回答中首次出现 RAG_QUERY 标记时立即开始补充检索，不等生成结束"""
+        if self.rag_future is not None or not self.rag_parser.queries or retrieval_system is None:
+            return
+        self.rag_future_query = self.rag_parser.queries[0]
+        print(f"回答中途检测到RAG查询请求，后台检索: {self.rag_future_query}")
+        self.rag_future = rag_query_executor.submit(search_with_vector, self.rag_future_query, RAG_FOLLOWUP_K)
+
+    def _followup_results(self, rag_query):
+        """
+        取后台补充检索的结果；未提前开始 (或失败) 时现场检索
+
+        返回:
+            tuple: (检索结果, 查询向量)
+        """
+        if self.rag_future is not None and self.rag_future_query == rag_query:
+            ready = self.rag_future.done()
+            try:
+                results = self.rag_future.result()
+                print(f"补充检索{'已在生成期间完成' if ready else '等待后台完成'}")
+                return results
+            except Exception as e:
+                print(f"后台补充检索失败，改为同步检索: {e}")
+        return search_with_vector(rag_query, RAG_FOLLOWUP_K)
+
+    def close(self):
+        if self.rag_future is not None and not self.finished:
+            self.rag_future.cancel()
+
+    def feed(self, event):
+        """处理一个后端事件，返回需要转发给浏览器的事件列表"""
+        event_name = event.get("event")
+
+        if event_name == "model_info":
+            self.model_used = event.get("model_used", "未知")
+            out = {'event': 'model_info', 'model_used': self.model_used}
+            if event.get("requested_model"):
+                # 主模型首字过慢或出错，由备用模型回答
+                out['requested_model'] = event["requested_model"]
+                print(f"由备用模型回答: {event['requested_model']} -> {self.model_used}")
+            if event.get("prompt_tokens") is not None:
+                # 本次请求发送给模型的提示词token数
+                self.prompt_tokens = event["prompt_tokens"]
+                out['prompt_tokens'] = self.prompt_tokens
+                print(f"提示词token数: {self.prompt_tokens} (模型 {self.model_used})")
+            return [out]
+
+        if event_name == "chunk":
+            chunk = event.get("chunk", "")
+            self.full_response += chunk
+            visible = self.rag_parser.feed(chunk)
+            self._start_followup_retrieval()
+            return [{'event': 'chunk', 'chunk': visible}] if visible else []
+
+        if event_name == "error":
+            self.stream_had_error = True
+            return [{'event': 'error', 'error': event.get("error", "未知流错误")}]
+
+        if event_name == "end_of_stream":
+            self.finished = True
+            rest = self.rag_parser.flush()
+            if rest:
+                return [{'event': 'chunk', 'chunk': rest}]
+        return []
+
+    def complete(self):
+        """流结束后的收尾：处理RAG_QUERY、提交本轮的对话历史，逐个产出浏览器事件"""
+        turn = self.turn
+        full_response = self.full_response
+
+        if full_response and not self.stream_had_error:
+            # 检查是否有RAG查询请求
+            clean_response, rag_query = parse_rag_query(full_response)
+
+            if rag_query and retrieval_system is not None:
+                # LLM请求了额外的RAG查询
+                yield {'event': 'rag_query_detected', 'query': rag_query}
+
+                # 执行RAG查询 (通常已在生成期间由后台线程完成)
+                print(f"执行LLM请求的RAG查询: {rag_query}")
+                retrieval_results, query_vec = self._followup_results(rag_query)
+                new_rag_data = [result['formatted_case'] for result in retrieval_results]
+                print(f"RAG查询完成，找到 {len(new_rag_data)} 个案例")
+
+                if new_rag_data:
+                    # 记录新检索的案例
+                    turn['unit'].add_rag_record(make_rag_record(retrieval_results, rag_query, query_vec))
+
+                    # 通知前端找到了新案例
+                    yield {'event': 'rag_results_found', 'count': len(new_rag_data)}
+
+            # 更新对话历史（使用清理后的回复，不含RAG_QUERY标记）
+            # 用户消息：如果有附件，保存附件信息供前端查看
+            user_msg = {"role": "user", "content": turn['user_message']}
+            if turn['attachments']:
+                user_msg["attachments"] = turn['attachments']
+            turn['unit'].add_messages([user_msg, {"role": "assistant", "content": clean_response}])
+
+            # 首轮回答写入语义缓存（触发了二次检索的回答不缓存）
+            semantic_ctx = turn['semantic_ctx']
+            if semantic_ctx and not rag_query:
+                semantic_cache.add(semantic_ctx['namespace'], semantic_ctx['vector'], semantic_ctx['question'],
+                                   semantic_ctx['case_signature'], self.model_used, clean_response)
+
+        # 本轮的写入交给后台队列，不等待磁盘
+        turn['unit'].commit()
+        yield {'event': 'end_of_stream', 'full_response': full_response}
+
+
+def handle_streaming_request(turn):
+    """处理流式请求，支持LLM主动触发RAG查询"""
+
+    def generate():
+        relay = StreamRelay(turn)
+        token = None
+        source = None
+        events = None
+        failed = False
+        upstream_chunks = 0
+
+        def counted(events):
+            # 取消统计按合并帧之前的上游增量计数 (与正常完成的流的平均长度可比)
+            nonlocal upstream_chunks
+            for event in events:
+                if event.get('event') == 'chunk':
+                    upstream_chunks += 1
+                yield event
+
+        try:
+            token = cancellation_registry.register(turn['request_id'], turn['conversation_id'], turn['session_id'])
+            # 同进程模式下 stream() 会立即准备提示词，后端错误在此处抛出
+            source = backend.stream(turn['payload'], cancel_token=token)
+            events = counted(source)
+            if not backend.coalesced:
+                # 按时间片合并token增量，减少发往浏览器的帧数 (HTTP 模式下后端已合并)
+                events = coalesce_events(events, config.STREAM_COALESCE_MS, config.STREAM_COALESCE_BYTES)
+            for event in events:
+                if token.cancelled:
+                    break
+                for out in relay.feed(event):
+                    yield sse_event(out)
+                if relay.finished:
+                    for out in relay.complete():
+                        yield sse_event(out)
+                    break
+
+            if token.cancelled and not relay.finished:
+                # 已取消：不保存不完整的回答
+                yield sse_event({'event': 'cancelled', 'reason': token.reason})
+
+        except TransportError as e:
+            failed = True
+            yield sse_event({'event': 'error', 'error': str(e)})
+        finally:
+            if token is not None:
+                # 浏览器断开时生成器被关闭，同样取消后端请求 (后端出错的流不计入取消统计)
+                if not relay.finished and not token.cancelled and not failed:
+                    token.cancel("disconnect")
+            if events is not None:
+                # 先取消再关闭：合并器的读取线程随上游连接关闭而退出
+                events.close()
+            if token is not None:
+                if not failed:
+                    cancellation_registry.record_finish(token, upstream_chunks)
+                cancellation_registry.unregister(token)
+            if hasattr(source, 'close'):
+                try:
+                    source.close()
+                except ValueError:
+                    pass  # 仍在合并器的读取线程中执行，由读取线程关闭
+            relay.close()
 
     return Response(stream_with_context(generate()), content_type='text/plain')
 
@@ -853,10 +1834,98 @@ def toggle_rag():
     session['rag_enabled'] = rag_enabled
     return jsonify({'success': True, 'rag_enabled': rag_enabled})
 
+@app.route('/prefetch_rag', methods=['POST'])
+def prefetch_rag():
+    """用户输入时预取草稿的RAG检索结果 (前端防抖调用)，发送消息时可直接复用"""
+    if rag_prefetcher is None or retrieval_system is None:
+        return jsonify({'prefetched': False, 'reason': 'disabled'})
+    if not session.get('disclaimer_accepted', False) or not session.get('rag_enabled', True):
+        return jsonify({'prefetched': False, 'reason': 'rag_off'})
+
+    text = ((request.get_json(silent=True) or {}).get('text') or '').strip()
+    if len(text) < config.RAG_PREFETCH_MIN_CHARS:
+        return jsonify({'prefetched': False, 'reason': 'too_short'})
+    # 负载较高时不做投机性的检索
+    if admission is not None and admission.level() >= LEVEL_NO_JUDGE:
+        return jsonify({'prefetched': False, 'reason': 'busy'})
+
+    def retrieve(query):
+        results, query_vec = search_with_vector(query, RAG_TOP_K)
+        return query_vec, results
+
+    entry = rag_prefetcher.prefetch(session.get('session_id'), text, RAG_TOP_K, RAG_MIN_SCORE, retrieve)
+    if entry is None:
+        return jsonify({'prefetched': False, 'reason': 'throttled'})
+    return jsonify({
+        'prefetched': entry.error is None,
+        'cases': len(entry.results or []),
+        'compute_ms': round(entry.compute_ms, 1)
+    })
+
+
+@app.route('/prefetch_stats', methods=['GET'])
+def prefetch_stats():
+    """获取RAG预取统计 (命中率、浪费比例、命中时节省的检索耗时)"""
+    if rag_prefetcher is None:
+        return jsonify({'enabled': False})
+    return jsonify({'enabled': True, **rag_prefetcher.stats()})
+
+def session_request_id(session_id, client_request_id):
+    """
+    登记用的请求ID：前端生成的 request_id 加上会话标识的摘要，
+    其他会话即使得知请求ID也无法取消本会话的请求 (多进程部署时后端同样按此ID取消)
+    """
+    digest = hashlib.sha256((session_id or '').encode('utf-8')).hexdigest()[:16]
+    return f"{digest}:{client_request_id}"
+
+
 @app.route('/cancel_request', methods=['POST'])
 def cancel_request():
-    """取消当前请求"""
-    return jsonify({'success': True, 'message': '取消请求已发送'})
+    """取消当前请求：关闭与后端的连接，并通知后端关闭上游LLM流 (只能取消本会话的请求)"""
+    data = request.get_json(silent=True) or {}
+    session_id = session.get('session_id')
+    request_id = data.get('request_id')
+    conversation_id = None
+    if request_id:
+        request_id = session_request_id(session_id, request_id)
+        token = cancellation_registry.get(request_id)
+        if token is not None and token.session_key != session_id:
+            return jsonify({'success': False, 'cancelled': False, 'error': '无权取消该请求'}), 403
+    else:
+        # 未指定请求ID时取消当前对话中进行中的请求
+        current_conv = Conversation.query.filter_by(session_id=session_id, is_current=True).first()
+        conversation_id = current_conv.id if current_conv else None
+
+    cancelled = cancellation_registry.cancel(request_id, conversation_id)
+    if not cancelled and request_id:
+        # 本进程未找到该请求 (如多进程部署)，直接通知后端
+        cancelled = backend.cancel(request_id)
+    return jsonify({'success': True, 'cancelled': cancelled, 'message': '取消请求已发送'})
+
+
+@app.route('/cancel_stats', methods=['GET'])
+def cancel_stats():
+    """获取流式请求取消的统计信息"""
+    return jsonify(cancellation_registry.stats())
+
+@app.route('/admission_stats', methods=['GET'])
+def admission_stats():
+    """获取准入控制统计 (处理中/排队中的请求数、负载与降级等级、限流与过载拒绝次数)"""
+    if admission is None:
+        return jsonify({'enabled': False})
+    return jsonify({'enabled': True, **admission.stats()})
+
+@app.route('/session_stats', methods=['GET'])
+def session_stats():
+    """获取会话存储统计 (读写次数、跳过的写入、已清理的过期会话)"""
+    if not hasattr(app.session_interface, 'stats'):
+        return jsonify({'store': config.SESSION_TYPE})
+    return jsonify(app.session_interface.stats())
+
+@app.route('/write_stats', methods=['GET'])
+def write_stats():
+    """获取后台写入队列统计 (队列深度、批次大小与耗时、读取前等待未落盘写入的次数)"""
+    return jsonify(write_queue.stats())
 
 @app.route('/clear_history', methods=['POST'])
 def clear_history():
@@ -864,9 +1933,13 @@ def clear_history():
     session_id = session.get('session_id')
     current_conv = get_current_conversation(session_id)
 
-    # 同时清空对话历史和RAG历史
-    current_conv.set_history([])
+    # 同时清空对话历史、RAG历史和对话摘要
+    JudgePayload.query.filter_by(conversation_id=current_conv.id).delete()
+    Message.query.filter_by(conversation_id=current_conv.id).delete()
+    current_conv.message_count = 0
     current_conv.set_rag_history([])
+    current_conv.summary = ''
+    current_conv.summary_upto = 0
     db.session.commit()
 
     return jsonify({'success': True, 'message': '对话历史已清空'})
@@ -885,6 +1958,69 @@ def set_model():
     session['selected_model'] = model
     return jsonify({'success': True, 'model': model})
 
+def is_admin_request():
+    """校验管理接口令牌（未配置 ADMIN_TOKEN 时管理接口不可用）"""
+    return bool(config.ADMIN_TOKEN) and request.headers.get('X-Admin-Token') == config.ADMIN_TOKEN
+
+
+@app.route('/admin/semantic_cache/purge', methods=['POST'])
+def purge_semantic_cache():
+    """清空语义缓存（可通过 namespace 指定 "模型:模式"，不指定则全部清空）"""
+    if not is_admin_request():
+        return jsonify({'error': '无权访问'}), 403
+    if semantic_cache is None:
+        return jsonify({'success': False, 'error': '语义缓存未启用'}), 400
+
+    namespace = (request.get_json(silent=True) or {}).get('namespace')
+    removed = semantic_cache.purge(namespace)
+    return jsonify({'success': True, 'removed': removed, 'stats': semantic_cache.stats()})
+
+
+@app.route('/admin/maintenance', methods=['POST'])
+def run_maintenance_now():
+    """立即执行一次数据库维护，返回维护前后的库文件与页统计"""
+    if not is_admin_request():
+        return jsonify({'error': '无权访问'}), 403
+    if db.engine.dialect.name != 'sqlite':
+        return jsonify({'success': False, 'error': '仅支持SQLite数据库'}), 400
+
+    try:
+        report = db_maintenance.run_now()
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)}), 500
+    if report is None:
+        return jsonify({'success': False, 'error': '数据库维护正在进行'}), 409
+    return jsonify({'success': True, 'report': report})
+
+
+@app.route('/media_cache_stats', methods=['GET'])
+def media_cache_stats():
+    """获取识别结果缓存统计 (命中次数、命中率、省下的识别耗时)"""
+    if media_cache is None:
+        return jsonify({'enabled': False})
+    return jsonify({'enabled': True, **media_cache.stats()})
+
+
+@app.route('/ocr_stats', methods=['GET'])
+def ocr_image_stats():
+    """获取图片预处理与OCR统计 (原始/实际发送字节数、节省比例、切块数、平均预处理与识别耗时)"""
+    return jsonify({'enabled': config.IMAGE_PREPROCESS_ENABLED, **ocr_stats.stats()})
+
+
+@app.route('/upload_job_stats', methods=['GET'])
+def upload_job_stats():
+    """获取异步识别任务统计 (排队/识别中任务数、平均排队与识别耗时、拒绝次数)"""
+    if upload_jobs is None:
+        return jsonify({'enabled': False})
+    return jsonify({'enabled': True, **upload_jobs.stats()})
+
+
+@app.route('/maintenance_stats', methods=['GET'])
+def maintenance_stats():
+    """获取数据库维护统计 (执行次数、最近一次的维护报告)"""
+    return jsonify(db_maintenance.stats())
+
+
 @app.route('/retrieval_status', methods=['GET'])
 def retrieval_status():
     """获取检索系统状态"""
@@ -895,10 +2031,87 @@ def retrieval_status():
             'status': '已初始化',
             'initialized': True,
             'case_count': getattr(retrieval_system, 'case_count', 0),
-            'rag_debug': RAG_DEBUG
+            'rag_debug': RAG_DEBUG,
+            'semantic_cache': semantic_cache.stats() if semantic_cache is not None else None
         })
 
-if __name__ == '__main__':
+
+def migrate_schema():
+    """为旧数据库补充新增的列与索引（db.create_all 不会修改已存在的表），并创建全文索引"""
+    existing = {column['name'] for column in inspect(db.engine).get_columns('conversations')}
+    added_columns = [
+        ('summary', "TEXT DEFAULT ''"),
+        ('summary_upto', 'INTEGER DEFAULT 0'),
+        ('message_count', 'INTEGER DEFAULT 0')
+    ]
+    with db.engine.begin() as conn:
+        for name, ddl in added_columns:
+            if name not in existing:
+                conn.execute(text(f"ALTER TABLE conversations ADD COLUMN {name} {ddl}"))
+                print(f"✓ 数据库迁移: conversations 表新增列 {name}")
+        # 旧数据库补建对话列表分页使用的复合索引
+        conn.execute(text("CREATE INDEX IF NOT EXISTS ix_conversations_session_updated "
+                          "ON conversations (session_id, updated_at)"))
+    install_search_index()
+    migrate_history_blobs()
+    migrate_judge_payloads()
+
+
+def install_search_index():
+    """创建消息全文索引及其同步触发器（仅SQLite；须在迁移旧消息之前，使迁移插入的行经触发器进入索引）"""
+    global message_search_available
+    if not config.MESSAGE_SEARCH_ENABLED or db.engine.dialect.name != 'sqlite':
+        return
+    with db.engine.begin() as conn:
+        message_search_available = install_message_search(conn)
+
+
+def migrate_history_blobs():
+    """一次性迁移：把旧版本 conversations.history 中的整段JSON拆成 messages 表的行，然后清空该列"""
+    legacy = Conversation.query.filter(Conversation.history.isnot(None),
+                                       Conversation.history.notin_(['', '[]'])).all()
+    migrated = 0
+    for conv in legacy:
+        try:
+            history = json.loads(conv.history)
+        except json.JSONDecodeError:
+            history = []
+        # 已有行的对话 (迁移中途中断) 只清空旧列，不重复插入
+        if not Message.query.filter_by(conversation_id=conv.id).first():
+            for seq, message in enumerate(history):
+                db.session.add(Message.from_message(conv.id, seq, message))
+            conv.message_count = len(history)
+            migrated += len(history)
+        conv.history = '[]'
+        db.session.commit()
+    if legacy:
+        print(f"✓ 数据库迁移: {len(legacy)} 个对话的 {migrated} 条消息已迁移到 messages 表")
+
+
+def migrate_judge_payloads():
+    """一次性迁移：把消息中内嵌的 judge_data (含各模型的全部回答) 移到 judge_payloads 表，消息只保留引用"""
+    rows = Message.query.filter(Message.extra.like('%"judge_data"%')).all()
+    for row in rows:
+        try:
+            extra = json.loads(row.extra)
+        except json.JSONDecodeError:
+            continue
+        judge_data = extra.pop('judge_data', None) or {}
+        all_answers = judge_data.get('all_answers', {})
+        extra['judge_ref'] = {'model_used': judge_data.get('model_used'), 'models': list(all_answers)}
+        row.extra = json.dumps(extra, ensure_ascii=False)
+        if db.session.get(JudgePayload, row.id) is None:
+            db.session.add(JudgePayload(message_id=row.id, conversation_id=row.conversation_id, payload=json.dumps({
+                'judge_reasoning': judge_data.get('judge_reasoning', ''),
+                'all_answers': all_answers
+            }, ensure_ascii=False)))
+    if rows:
+        db.session.commit()
+        print(f"✓ 数据库迁移: {len(rows)} 条Judge回答的完整数据已移到 judge_payloads 表")
+
+
+def startup():
+    """服务启动时的初始化：建表、加载检索系统（同步与ASGI两种启动方式共用）"""
     # 确保会话目录存在
     if not os.path.exists('./flask_session'):
         os.makedirs('./flask_session')
@@ -906,7 +2119,10 @@ if __name__ == '__main__':
     # 初始化数据库表（如果不存在则创建）
     with app.app_context():
         db.create_all()
+        migrate_schema()
         print("✓ 数据库初始化完成")
+        if config.MAINTENANCE_ENABLED and db.engine.dialect.name == 'sqlite':
+            db_maintenance.start()
 
     # 启动时初始化检索系统
     print("正在启动法律小助手Web应用...")
@@ -917,5 +2133,9 @@ if __name__ == '__main__':
         else:
             print("警告: 检索系统初始化失败")
 
-    app.run(debug=False, port=5001)
 
+if __name__ == '__main__':
+    startup()
+    # SIGTERM 时正常退出，由 atexit 写完后台写入队列
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    app.run(debug=False, port=5001)
@@ -0,0 +1,322 @@
+# -*- coding: utf-8 -*-
+"""
+文件名: asgi_app.py
+功  能: 基于 asyncio 的 ASGI 服务入口 (/predict 与 /send_message 的异步版本)。
+描  述:
+1. 流式回答期间不再独占 WSGI 线程：上游调用使用 AsyncOpenAI，app.py → llm.py 使用 httpx 异步代理，
+   单个事件循环即可同时维持数千条打开的 SSE 流；Judge 模式的六次上游调用以协程并发。
+2. /send_message 的准备与收尾 (session、数据库、RAG检索) 仍是同步代码，放到线程池中执行，
+   只在这两个短暂阶段占用线程，生成期间不占用。
+3. 其余路由原样交给 Flask 应用 (通过 WSGI 适配挂载)，行为与同步部署一致。
+
+启动:
+    uvicorn asgi_app:create_llm_app --factory --port 5000    # 替代 python llm.py
+    uvicorn asgi_app:create_web_app --factory --port 5001    # 替代 python app.py
+"""
+
+import asyncio
+
+from a2wsgi import WSGIMiddleware
+from starlette.applications import Starlette
+from starlette.background import BackgroundTask
+from starlette.concurrency import run_in_threadpool
+from starlette.responses import JSONResponse, Response, StreamingResponse
+from starlette.routing import Mount, Route
+
+import config
+from admission import AdmissionRejected
+from stream_coalescer import coalesce_events_async
+
+
+async def _read_json(request):
+    try:
+        return await request.json()
+    except ValueError:
+        return None
+
+
+async def admit(controller, session_key, heavy=False):
+    """
+    申请准入 (排队等待会阻塞，放到线程池中执行)
+
+    返回:
+        tuple: (ticket, None) 或 (None, 拒绝响应)；未启用准入控制时 ticket 为 None
+    """
+    if controller is None:
+        return None, None
+    try:
+        return await run_in_threadpool(controller.acquire, session_key, heavy), None
+    except AdmissionRejected as e:
+        return None, JSONResponse(e.payload(), status_code=e.status, headers={"Retry-After": str(e.retry_after)})
+
+
+def release_ticket(ticket):
+    if ticket is not None:
+        ticket.release()
+
+
+def finish_turn(ticket, turn):
+    """释放准入名额，并提交本轮尚未提交的写入 (提交可重复调用)"""
+    release_ticket(ticket)
+    turn['unit'].commit()
+
+
+def with_cookies(response, cookies):
+    """把 Flask 会话产生的 Set-Cookie 头附加到 Starlette 响应上"""
+    for cookie in cookies:
+        response.headers.append('set-cookie', cookie)
+    return response
+
+
+# ===================================================================
+# --- llm.py 的异步服务 ---
+# ===================================================================
+def create_llm_app():
+    """创建 llm.py 的 ASGI 应用：/predict 走异步实现，其余路由交给 Flask"""
+    import llm
+
+    async def predict(request):
+        data = await _read_json(request)
+        if not data or 'user_question' not in data:
+            return JSONResponse({"error": "请求格式错误"}, status_code=400)
+
+        # HTTP Cache-Control 头与请求体中的 cache_control 等效
+        if not data.get('cache_control') and request.headers.get('cache-control'):
+            data['cache_control'] = request.headers.get('cache-control')
+
+        is_judge = data.get('model_id', 'deepseek') == 'judge'
+        ticket, rejected = await admit(llm.admission, data.get('conversation_id') or request.client.host, is_judge)
+        if rejected is not None:
+            return rejected
+
+        if is_judge:
+            try:
+                return JSONResponse(await llm.run_judge_async(data))
+            except llm.PredictError as e:
+                return JSONResponse(e.payload, status_code=e.status)
+            finally:
+                release_ticket(ticket)
+
+        try:
+            events = llm.open_stream_async(data)
+        except llm.PredictError as e:
+            release_ticket(ticket)
+            return JSONResponse(e.payload, status_code=e.status)
+
+        async def body():
+            try:
+                async for event in coalesce_events_async(events, config.STREAM_COALESCE_MS,
+                                                         config.STREAM_COALESCE_BYTES):
+                    yield llm.encode_sse(event)
+            finally:
+                release_ticket(ticket)
+
+        # 客户端在开始发送前断开时 body() 不会执行，由后台任务兜底释放名额 (release 可重复调用)
+        return StreamingResponse(body(), media_type='text/event-stream',
+                                 background=BackgroundTask(release_ticket, ticket))
+
+    return Starlette(routes=[
+        Route('/predict', predict, methods=['POST']),
+        Mount('/', WSGIMiddleware(llm.app))
+    ])
+
+
+# ===================================================================
+# --- app.py 的异步服务 ---
+# ===================================================================
+def create_web_app():
+    """创建 app.py 的 ASGI 应用：/send_message 走异步实现，其余路由交给 Flask"""
+    import flask
+    import app as web
+    from transport import create_async_transport, TransportError, TransportTimeout
+
+    web.startup()
+    backend = create_async_transport(config.BACKEND_TRANSPORT, config.API_URL)
+
+    def in_flask_request(request, body, func, *args):
+        """
+        在 Flask 请求上下文中执行同步函数 (供线程池调用)
+
+        返回:
+            tuple: (函数返回值, 需要回写给浏览器的 Set-Cookie 头列表)
+        """
+        headers = [(k, v) for k, v in request.headers.items() if k.lower() != 'content-length']
+        environ_base = {'REMOTE_ADDR': request.client.host} if request.client else None
+        with web.app.test_request_context(request.url.path, method=request.method, headers=headers, data=body,
+                                          environ_base=environ_base):
+            result = func(*args)
+            cookie_carrier = web.app.response_class()
+            web.app.session_interface.save_session(web.app, flask.session._get_current_object(), cookie_carrier)
+            return result, cookie_carrier.headers.getlist('Set-Cookie')
+
+    def in_app_context(func, *args):
+        with web.app.app_context():
+            return func(*args)
+
+    def to_starlette(rv, cookies):
+        """将 Flask 视图风格的返回值转换为 Starlette 响应"""
+        with web.app.app_context():
+            flask_response = web.app.make_response(rv)
+            body = flask_response.get_data()
+        headers = {'Retry-After': flask_response.headers['Retry-After']} if 'Retry-After' in flask_response.headers else None
+        response = Response(body, status_code=flask_response.status_code,
+                            media_type=flask_response.mimetype, headers=headers)
+        return with_cookies(response, cookies)
+
+    async def iterate_in_app_context(gen_factory):
+        """在工作线程 (应用上下文内) 运行同步生成器，并将产出逐个转交给事件循环"""
+        loop = asyncio.get_running_loop()
+        queue = asyncio.Queue()
+        done = object()
+
+        def worker():
+            try:
+                with web.app.app_context():
+                    for item in gen_factory():
+                        loop.call_soon_threadsafe(queue.put_nowait, item)
+            except Exception as e:
+                loop.call_soon_threadsafe(queue.put_nowait, e)
+            finally:
+                loop.call_soon_threadsafe(queue.put_nowait, done)
+
+        loop.run_in_executor(None, worker)
+        while True:
+            item = await queue.get()
+            if item is done:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+
+    def admit_and_prepare(data):
+        """等待仍在识别的附件、准入控制 (排队时阻塞) 与准备阶段，在同一个线程池任务中执行"""
+        if data.get('attachments'):
+            # 与 WSGI 的 /send_message 相同：先等待附件识别 (不占用准入名额)
+            data['attachments'], unresolved = web.resolve_attachment_jobs(data['attachments'])
+            if unresolved is not None:
+                return None, None, unresolved
+        ticket, rejected = web.admit_chat_turn(data)
+        if rejected is not None:
+            return None, None, rejected
+        try:
+            turn, early_response = web.prepare_chat_turn(data, ticket.level if ticket else web.LEVEL_NORMAL)
+        except Exception:
+            release_ticket(ticket)
+            raise
+        return ticket, turn, early_response
+
+    async def send_message(request):
+        body = await request.body()
+        data = await _read_json(request) or {}
+        try:
+            (ticket, turn, early_response), cookies = await run_in_threadpool(
+                in_flask_request, request, body, admit_and_prepare, data)
+        except Exception as e:
+            return JSONResponse({'error': f'处理请求时出错: {str(e)}'}, status_code=500)
+
+        if early_response is not None:
+            # 语义缓存命中的重放同样占用名额，发送完毕后释放
+            response = to_starlette(early_response, cookies)
+            release_ticket(ticket)
+            return response
+
+        # --- Judge 模式：异步等待后端结果，再到线程池中保存历史 ---
+        if turn['payload']['model_id'] == 'judge':
+            try:
+                result = await backend.judge(turn['payload'])
+            except TransportError as e:
+                status = 504 if isinstance(e, TransportTimeout) else e.status if e.status in (429, 503) else 500
+                turn['unit'].commit()
+                return with_cookies(JSONResponse({'error': str(e)}, status_code=status), cookies)
+            finally:
+                release_ticket(ticket)
+
+            response_body = await run_in_threadpool(in_app_context, web.complete_judge_turn, turn, result)
+            if response_body is None:
+                error_body = {'error': f'后端返回错误: {result.get("error", "未知错误")}'}
+                return with_cookies(JSONResponse(error_body, status_code=500), cookies)
+            return with_cookies(JSONResponse(response_body), cookies)
+
+        # --- Judge 降级为单模型：读完后端流后按 Judge 的JSON格式返回 ---
+        if turn['judge_degraded']:
+            relay = web.StreamRelay(turn)
+            error = None
+            source = backend.stream(turn['payload'])
+            try:
+                async for event in source:
+                    for out in relay.feed(event):
+                        if out['event'] == 'error':
+                            error = out['error']
+                    if relay.finished:
+                        break
+            except TransportError as e:
+                error = str(e)
+            finally:
+                await source.aclose()
+                relay.close()
+            try:
+                response_body, status = await run_in_threadpool(
+                    in_app_context, web.finish_degraded_judge_turn, relay, error)
+            finally:
+                finish_turn(ticket, turn)
+            return with_cookies(JSONResponse(response_body, status_code=status), cookies)
+
+        # --- 单模型模式：异步中继后端流 ---
+        async def generate():
+            relay = web.StreamRelay(turn)
+            token = web.cancellation_registry.register(turn['request_id'], turn['conversation_id'],
+                                                       turn['session_id'])
+            source = backend.stream(turn['payload'], cancel_token=token)
+            failed = False
+            upstream_chunks = 0
+
+            async def counted(events):
+                # 取消统计按合并帧之前的上游增量计数
+                nonlocal upstream_chunks
+                async for event in events:
+                    if event.get('event') == 'chunk':
+                        upstream_chunks += 1
+                    yield event
+
+            events = counted(source)
+            if not backend.coalesced:
+                # HTTP 模式下后端已按时间片合并帧
+                events = coalesce_events_async(events, config.STREAM_COALESCE_MS, config.STREAM_COALESCE_BYTES)
+            try:
+                async for event in events:
+                    if token.cancelled:
+                        break
+                    for out in relay.feed(event):
+                        yield web.sse_event(out)
+                    if relay.finished:
+                        async for out in iterate_in_app_context(relay.complete):
+                            yield web.sse_event(out)
+                        break
+
+                if token.cancelled and not relay.finished:
+                    # 已取消：不保存不完整的回答
+                    yield web.sse_event({'event': 'cancelled', 'reason': token.reason})
+
+            except TransportError as e:
+                failed = True
+                yield web.sse_event({'event': 'error', 'error': str(e)})
+            finally:
+                # 浏览器断开时 (CancelledError/GeneratorExit) 同样取消后端请求 (后端出错的流不计入取消统计)
+                if not relay.finished and not token.cancelled and not failed:
+                    token.cancel("disconnect")
+                await events.aclose()
+                await source.aclose()
+                relay.close()
+                if not failed:
+                    web.cancellation_registry.record_finish(token, upstream_chunks)
+                web.cancellation_registry.unregister(token)
+                finish_turn(ticket, turn)
+
+        response = StreamingResponse(generate(), media_type='text/plain',
+                                     background=BackgroundTask(finish_turn, ticket, turn))
+        return with_cookies(response, cookies)
+
+    return Starlette(routes=[
+        Route('/send_message', send_message, methods=['POST']),
+        Mount('/', WSGIMiddleware(web.app))
+    ])
@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+"""
+文件名: bench_cancellation.py
+功  能: 测量 /cancel_request 取消流式请求后，上游 LLM 流被关闭的速度与节省的token。
+描  述:
+1. 用假的上游流替换 llm.create_chat_stream：每隔 --interval 毫秒产出一个token，
+   读取时阻塞在可被 close() 打断的等待上，模拟 OpenAI 流的网络读取。
+2. 工作线程按 app.py 的方式登记 CancelToken 并消费 transport.stream()，
+   收到 --cancel-after 个chunk后，主线程按 /cancel_request 的方式取消。
+3. 统计: 上游实际产出的token数 / 总token数、取消到上游流关闭的延迟、取消到工作线程退出的延迟。
+4. http 模式经本机 llm.py 的 /predict 与 /cancel；inprocess 模式直接消费事件生成器。
+
+用法: python benchmarks/bench_cancellation.py --tokens 500 --interval 20 --cancel-after 20
+"""
+
+import argparse
+import os
+import sys
+import threading
+import time
+import uuid
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import llm  # noqa: E402
+from cancellation import CancellationRegistry  # noqa: E402
+from transport import HttpTransport, InProcessTransport  # noqa: E402
+from bench_transport import start_llm_server  # noqa: E402
+
+
+class FakeUpstream:
+    """假的上游流：按固定间隔产出token，close() 会立即打断阻塞中的读取"""
+
+    def __init__(self, total, interval):
+        self.total = total
+        self.interval = interval
+        self.produced = 0
+        self.closed_at = None
+        self._closed = threading.Event()
+
+    def __iter__(self):
+        for i in range(self.total):
+            if self._closed.wait(self.interval):
+                raise ConnectionError("上游连接已关闭")
+            self.produced += 1
+            delta = SimpleNamespace(content="案" if i % 2 else "件")
+            yield SimpleNamespace(choices=[SimpleNamespace(delta=delta)])
+
+    def close(self):
+        if not self._closed.is_set():
+            self.closed_at = time.perf_counter()
+            self._closed.set()
+
+
+def run_once(transport, args):
+    """执行一次 "流式请求 → 中途取消"，返回统计字典"""
+    upstreams = []
+
+    def fake_create_chat_stream(model_name, messages):
+        upstream = FakeUpstream(args.tokens, args.interval / 1000.0)
+        upstreams.append(upstream)
+        return upstream
+
+    llm.create_chat_stream = fake_create_chat_stream
+
+    registry = CancellationRegistry()
+    request_id = str(uuid.uuid4())
+    payload = {
+        "user_question": "我朋友醉驾撞人了会判多久",
+        "rag_data": [],
+        "chat_history": [],
+        "model_id": "deepseek",
+        "cache_control": "no-store",
+        "request_id": request_id
+    }
+    reached = threading.Event()
+    result = {"chunks": 0, "exited_at": None}
+
+    def worker():
+        token = registry.register(request_id)
+        source = transport.stream(payload, cancel_token=token)
+        try:
+            for event in source:
+                if token.cancelled:
+                    break
+                if event.get("event") == "chunk":
+                    result["chunks"] += 1
+                    if result["chunks"] == args.cancel_after:
+                        reached.set()
+        finally:
+            source.close()
+            registry.unregister(token)
+            result["exited_at"] = time.perf_counter()
+            reached.set()
+
+    thread = threading.Thread(target=worker)
+    thread.start()
+    reached.wait()
+    cancel_at = time.perf_counter()
+    registry.cancel(request_id)  # 与 /cancel_request 相同
+    thread.join()
+
+    # http 模式下上游在另一个线程中关闭，稍等其收尾
+    deadline = time.time() + 5
+    while upstreams and upstreams[0].closed_at is None and time.time() < deadline:
+        time.sleep(0.001)
+
+    upstream = upstreams[0]
+    return {
+        "produced": upstream.produced,
+        "close_ms": (upstream.closed_at - cancel_at) * 1000 if upstream.closed_at else float("nan"),
+        "exit_ms": (result["exited_at"] - cancel_at) * 1000
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="流式请求取消基准测试")
+    parser.add_argument("--tokens", type=int, default=500, help="上游完整回答的token数")
+    parser.add_argument("--interval", type=float, default=20, help="上游每个token的间隔 (毫秒)")
+    parser.add_argument("--cancel-after", type=int, default=20, help="收到多少个chunk后取消")
+    parser.add_argument("--rounds", type=int, default=5, help="每种模式的测量轮数")
+    args = parser.parse_args()
+
+    # 不做分时合并，chunk 计数与上游token一一对应
+    llm.config.STREAM_COALESCE_MS = 0
+
+    server, url = start_llm_server()
+    try:
+        transports = {"http": HttpTransport(url), "inprocess": InProcessTransport()}
+        print(f"上游token数: {args.tokens}, 间隔: {args.interval} ms, 第 {args.cancel_after} 个chunk后取消")
+        for name, transport in transports.items():
+            runs = [run_once(transport, args) for _ in range(args.rounds)]
+            produced = sum(r["produced"] for r in runs) / len(runs)
+            close_ms = sorted(r["close_ms"] for r in runs)[len(runs) // 2]
+            exit_ms = sorted(r["exit_ms"] for r in runs)[len(runs) // 2]
+            print(f"{name:>10}: 上游产出 {produced:6.1f}/{args.tokens} token "
+                  f"(节省 {1 - produced / args.tokens:6.1%}), "
+                  f"取消→上游关闭 {close_ms:7.2f} ms, 取消→线程退出 {exit_ms:7.2f} ms")
+        print(f"llm.py 取消统计: {llm.cancellation_registry.stats()}")
+    finally:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
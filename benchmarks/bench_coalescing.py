@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+"""
+文件名: bench_coalescing.py
+功  能: 评估 SSE 分时合并在典型生成速度下的效果。
+描  述:
+1. 用模拟时钟按给定速度 (tokens/s，带随机抖动) 回放一段约 1000 token 的中文 Markdown 回答，
+   经 coalesce_events_inline + app.py 的 data: 行编码，统计帧数与帧率。
+2. 服务端 CPU：重复运行中继 (合并 + JSON 编码) 取 process_time 平均值，即每条流的CPU开销。
+3. 客户端渲染：若本机有 node，则加载 static/js/marked.min.js，模拟浏览器每收到一帧
+   就对累计全文调用一次 marked.parse，统计每条流的总渲染耗时。
+
+用法: python benchmarks/bench_coalescing.py --speeds 20 50 100 --windows 0 30 50 100
+"""
+
+import argparse
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from stream_coalescer import coalesce_events_inline  # noqa: E402
+
+NODE_RENDER_SCRIPT = r"""
+const fs = require('fs');
+const marked = require(process.argv[2]);
+const streams = JSON.parse(fs.readFileSync(process.argv[3], 'utf8'));
+const results = streams.map(frames => {
+    let text = '';
+    const start = process.hrtime.bigint();
+    for (const frame of frames) {
+        text += frame;
+        marked.parse(text);
+    }
+    return Number(process.hrtime.bigint() - start) / 1e6;
+});
+console.log(JSON.stringify(results));
+"""
+
+
+def sample_answer_tokens():
+    """取系统提示词中的报告模板作为典型回答内容，按1~3个字符切分为token"""
+    import llm
+    text = (llm.SYSTEM_PROMPT_NORMAL + llm.SYSTEM_PROMPT_PROFESSIONAL)[:2000]
+    rng = random.Random(7)
+    tokens, i = [], 0
+    while i < len(text):
+        step = rng.randint(1, 3)
+        tokens.append(text[i:i + step])
+        i += step
+    return tokens
+
+
+def simulate(tokens, tokens_per_sec, flush_ms, max_bytes, seed=0):
+    """按模拟时钟回放，返回 (帧文本列表, 流持续秒数)"""
+    rng = random.Random(seed)
+    clock = [0.0]
+
+    def events():
+        yield {"event": "model_info", "model_used": "deepseek-chat"}
+        for token in tokens:
+            clock[0] += rng.expovariate(tokens_per_sec)
+            yield {"event": "chunk", "chunk": token}
+        yield {"event": "end_of_stream"}
+
+    frames = [e["chunk"] for e in coalesce_events_inline(events(), flush_ms, max_bytes, clock=lambda: clock[0])
+              if e["event"] == "chunk"]
+    return frames, clock[0]
+
+
+def relay_cpu_seconds(tokens, flush_ms, max_bytes, repeat):
+    """测量中继 (合并 + 浏览器 data: 行编码) 处理一条流的CPU时间"""
+    def events():
+        yield {"event": "model_info", "model_used": "deepseek-chat"}
+        for token in tokens:
+            yield {"event": "chunk", "chunk": token}
+        yield {"event": "end_of_stream"}
+
+    # 模拟时钟每次调用前进 1/60 秒附近，使时间片规则生效
+    tick = [0.0]
+
+    def clock():
+        tick[0] += 0.016
+        return tick[0]
+
+    start = time.process_time()
+    for _ in range(repeat):
+        for event in coalesce_events_inline(events(), flush_ms, max_bytes, clock=clock):
+            _ = f"data: {json.dumps(event)}\n\n"
+    return (time.process_time() - start) / repeat
+
+
+def client_render_ms(frame_lists):
+    node = shutil.which("node")
+    if not node:
+        return None
+    with tempfile.TemporaryDirectory() as tmp:
+        script = os.path.join(tmp, "render.js")
+        data = os.path.join(tmp, "frames.json")
+        with open(script, "w", encoding="utf-8") as f:
+            f.write(NODE_RENDER_SCRIPT)
+        with open(data, "w", encoding="utf-8") as f:
+            json.dump(frame_lists, f, ensure_ascii=False)
+        marked_path = os.path.join(ROOT, "static", "js", "marked.min.js")
+        out = subprocess.run([node, script, marked_path, data], capture_output=True, text=True, check=True)
+        return json.loads(out.stdout)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="SSE 分时合并效果评估")
+    parser.add_argument("--speeds", type=float, nargs="+", default=[20, 50, 100], help="生成速度 tokens/s")
+    parser.add_argument("--windows", type=int, nargs="+", default=[0, 30, 50, 100], help="合并时间片 (ms)，0为不合并")
+    parser.add_argument("--max-bytes", type=int, default=512, help="单帧最大字节数")
+    parser.add_argument("--cpu-repeat", type=int, default=50, help="CPU测量重复次数")
+    args = parser.parse_args()
+
+    tokens = sample_answer_tokens()
+    rows, frame_lists = [], []
+    for speed in args.speeds:
+        for window in args.windows:
+            frames, duration = simulate(tokens, speed, window, args.max_bytes)
+            cpu = relay_cpu_seconds(tokens, window, args.max_bytes, args.cpu_repeat)
+            rows.append((speed, window, len(frames), len(frames) / duration, cpu))
+            frame_lists.append(frames)
+
+    renders = client_render_ms(frame_lists)
+    print(f"回答长度: {len(tokens)} tokens, 单帧上限 {args.max_bytes} 字节")
+    print(f"{'tok/s':>6} {'窗口ms':>7} {'帧数':>6} {'帧/秒':>7} {'服务端CPU/流':>12} {'客户端渲染/流':>13}")
+    for i, (speed, window, frames, fps, cpu) in enumerate(rows):
+        render = f"{renders[i]:>10.1f} ms" if renders else "   (无node)"
+        print(f"{speed:>6.0f} {window:>7} {frames:>6} {fps:>7.1f} {cpu * 1000:>9.2f} ms {render}")
+
+
+if __name__ == "__main__":
+    main()
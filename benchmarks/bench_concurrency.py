@@ -0,0 +1,193 @@
+# -*- coding: utf-8 -*-
+"""
+文件名: bench_concurrency.py
+功  能: 对比同步 (WSGI 线程池) 与异步 (ASGI) 两种部署下 /predict 的并发流承载能力。
+描  述:
+1. 服务端以子进程启动，上游替换为按固定间隔产出token的假流 (只测服务本身的并发能力)。
+2. sync 模式：Flask 应用跑在固定大小的线程池 WSGI 服务器上 (模拟 gunicorn gthread 的线程上限)。
+3. async 模式：asgi_app.create_llm_app() 跑在 uvicorn 单进程单事件循环上。
+4. 客户端同时打开 N 条流，统计同时在传输中的流峰值、首字节时间 (TTFB) 与总耗时。
+
+用法: python benchmarks/bench_concurrency.py --clients 100 500 1000 --tokens 40 --token-delay 0.05
+"""
+
+import argparse
+import asyncio
+import os
+import socket
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+
+# ===================================================================
+# --- 服务端 (子进程) ---
+# ===================================================================
+def install_fake_upstream(llm, token_count, token_delay):
+    """替换 llm.py 的上游调用：每隔 token_delay 秒产出一个token"""
+    from types import SimpleNamespace
+
+    def make_chunk():
+        return SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content="案"))])
+
+    def fake_sync(model_name, messages):
+        for _ in range(token_count):
+            time.sleep(token_delay)
+            yield make_chunk()
+
+    async def fake_async(model_name, messages):
+        async def gen():
+            for _ in range(token_count):
+                await asyncio.sleep(token_delay)
+                yield make_chunk()
+        return gen()
+
+    llm.create_chat_stream = fake_sync
+    llm.create_chat_stream_async = fake_async
+
+
+def serve(mode, port, threads, token_count, token_delay):
+    import logging
+    import llm
+    install_fake_upstream(llm, token_count, token_delay)
+    logging.getLogger("werkzeug").setLevel(logging.ERROR)
+
+    if mode == "sync":
+        from concurrent.futures import ThreadPoolExecutor
+        from werkzeug.serving import BaseWSGIServer
+
+        class PooledWSGIServer(BaseWSGIServer):
+            """固定线程数的WSGI服务器：超出线程数的连接在队列中等待"""
+            request_queue_size = 4096
+
+            def __init__(self, *args, **kwargs):
+                super().__init__(*args, **kwargs)
+                self.pool = ThreadPoolExecutor(max_workers=threads)
+
+            def process_request(self, request, client_address):
+                self.pool.submit(self._handle, request, client_address)
+
+            def _handle(self, request, client_address):
+                try:
+                    self.finish_request(request, client_address)
+                except Exception:
+                    self.handle_error(request, client_address)
+                finally:
+                    self.shutdown_request(request)
+
+        PooledWSGIServer("127.0.0.1", port, llm.app).serve_forever()
+    else:
+        import uvicorn
+        from asgi_app import create_llm_app
+        uvicorn.run(create_llm_app(), host="127.0.0.1", port=port, log_level="warning", backlog=4096)
+
+
+# ===================================================================
+# --- 客户端 ---
+# ===================================================================
+async def run_load(url, clients):
+    import httpx
+
+    state = {"active": 0, "peak": 0}
+    ttfbs, totals, failures = [], [], 0
+    payload = {"user_question": "醉驾撞了人要坐牢吗", "rag_data": [], "chat_history": [],
+               "model_id": "deepseek", "cache_control": "no-store"}
+    limits = httpx.Limits(max_connections=clients + 10, max_keepalive_connections=0)
+
+    async with httpx.AsyncClient(limits=limits, timeout=httpx.Timeout(600.0)) as client:
+        async def one():
+            nonlocal failures
+            start = time.perf_counter()
+            first = None
+            try:
+                async with client.stream("POST", url, json=payload) as response:
+                    async for line in response.aiter_lines():
+                        if first is None and line.startswith("data: {\"chunk\""):
+                            first = time.perf_counter() - start
+                            state["active"] += 1
+                            state["peak"] = max(state["peak"], state["active"])
+                        if line.startswith("event: end_of_stream"):
+                            break
+            except Exception:
+                failures += 1
+                return
+            finally:
+                if first is not None:
+                    state["active"] -= 1
+            ttfbs.append(first if first is not None else float("nan"))
+            totals.append(time.perf_counter() - start)
+
+        wall_start = time.perf_counter()
+        await asyncio.gather(*(one() for _ in range(clients)))
+        wall = time.perf_counter() - wall_start
+
+    return state["peak"], ttfbs, totals, failures, wall
+
+
+def percentile(values, pct):
+    values = sorted(v for v in values if v == v)
+    if not values:
+        return float("nan")
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def wait_for_port(port, timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=1):
+                return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError(f"服务端口 {port} 未就绪")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="同步/异步服务并发流承载能力测试")
+    parser.add_argument("--clients", type=int, nargs="+", default=[100, 500, 1000], help="并发流数量")
+    parser.add_argument("--tokens", type=int, default=40, help="每条流的token数")
+    parser.add_argument("--token-delay", type=float, default=0.05, help="上游每个token的间隔 (秒)")
+    parser.add_argument("--sync-threads", type=int, default=32, help="同步模式的WSGI线程数")
+    parser.add_argument("--modes", nargs="+", default=["sync", "async"], choices=["sync", "async"])
+    parser.add_argument("--serve", choices=["sync", "async"], help=argparse.SUPPRESS)
+    parser.add_argument("--port", type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve:
+        serve(args.serve, args.port, args.sync_threads, args.tokens, args.token_delay)
+        return
+
+    ideal = args.tokens * args.token_delay
+    print(f"每条流 {args.tokens} tokens × {args.token_delay * 1000:.0f} ms ≈ {ideal:.1f} s, "
+          f"同步线程数 {args.sync_threads}")
+    print(f"{'模式':>6} {'并发':>6} {'同时传输峰值':>12} {'TTFB p50':>10} {'TTFB p95':>10} "
+          f"{'总耗时 p95':>10} {'墙钟':>8} {'失败':>5}")
+
+    for mode in args.modes:
+        port = free_port()
+        proc = subprocess.Popen([sys.executable, os.path.abspath(__file__), "--serve", mode, "--port", str(port),
+                                 "--sync-threads", str(args.sync_threads), "--tokens", str(args.tokens),
+                                 "--token-delay", str(args.token_delay)], cwd=ROOT)
+        try:
+            wait_for_port(port)
+            url = f"http://127.0.0.1:{port}/predict"
+            for clients in args.clients:
+                peak, ttfbs, totals, failures, wall = asyncio.run(run_load(url, clients))
+                print(f"{mode:>6} {clients:>6} {peak:>12} {percentile(ttfbs, 50):>9.2f}s {percentile(ttfbs, 95):>9.2f}s "
+                      f"{percentile(totals, 95):>9.2f}s {wall:>7.1f}s {failures:>5}")
+        finally:
+            proc.terminate()
+            proc.wait()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+"""
+文件名: bench_history_writes.py
+功  能: 对比每轮保存对话历史的写入耗时：旧版整段JSON重写 vs messages 表只追加新消息。
+描  述:
+1. 在临时SQLite数据库中为每个规模 (--sizes，默认 10/100/500 条消息) 建一个已有历史的对话，
+   每隔 --judge-every 轮有一轮为 Judge 回答 (附带五个模型的完整回答，与实际保存的内容一致)。
+2. blob 模式：按旧实现把完整历史 json.dumps 后写回 conversations.history 并提交；
+   messages 模式：用 app.append_message_rows 只插入本轮的两条消息并提交 (即后台写入队列中每轮的写入)。
+3. 每个规模各写 --rounds 轮 (写后回滚到原规模，保证每轮测量的历史长度相同)，输出每轮写入耗时的中位数与P90，
+   以及每轮写入的字节数。
+
+用法: python benchmarks/bench_history_writes.py --sizes 10,100,500 --rounds 30
+"""
+
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+import uuid
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+ANSWER = "根据相关案例，醉酒驾驶机动车致人轻伤的，可能构成危险驾驶罪或交通肇事罪。" * 8
+
+
+def setup_environment():
+    workdir = tempfile.mkdtemp(prefix="bench_history_")
+    os.environ.update({
+        "SESSION_FILE_DIR": os.path.join(workdir, "sessions"),
+        "SQLALCHEMY_DATABASE_URI": f"sqlite:///{os.path.join(workdir, 'conversations.db')}",
+        "HISTORY_SUMMARY_ENABLED": "False",
+        "BACKEND_TRANSPORT": "inprocess",
+    })
+
+
+def make_turn(index, judge_every):
+    """一轮对话的两条消息；Judge 轮附带全部模型的回答"""
+    user = {"role": "user", "content": f"第{index}个问题：醉驾撞人会怎么判？"}
+    if judge_every and index % judge_every == judge_every - 1:
+        assistant = {
+            "role": "assistant",
+            "content": ANSWER,
+            "is_judge_mode": True,
+            "judge_ref": {"model_used": "deepseek", "models": ["deepseek", "qwen", "doubao", "gpt4o", "claude"]},
+            "judge_payload": {
+                "judge_reasoning": "综合比较各模型的回答。" * 10,
+                "all_answers": {name: ANSWER for name in ("deepseek", "qwen", "doubao", "gpt4o", "claude")}
+            }
+        }
+    else:
+        assistant = {"role": "assistant", "content": ANSWER}
+    return [user, assistant]
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def bench_blob(app_module, conv_id, session_id, history, turn, rounds):
+    """旧实现：整段历史重写"""
+    db, Conversation = app_module.db, app_module.Conversation
+    timings, written = [], 0
+    for _ in range(rounds):
+        start = time.perf_counter()
+        conv = Conversation.query.filter_by(id=conv_id, session_id=session_id).first()
+        blob = json.dumps(history + turn, ensure_ascii=False)
+        conv.history = blob
+        db.session.commit()
+        timings.append((time.perf_counter() - start) * 1000)
+        written = len(blob.encode("utf-8"))
+    return timings, written
+
+
+def bench_append(app_module, conv_id, session_id, size, turn, rounds):
+    """新实现：只插入本轮消息，测完删除以恢复原规模"""
+    db, Message, Conversation = app_module.db, app_module.Message, app_module.Conversation
+    timings = []
+    written = sum(len(json.dumps(m, ensure_ascii=False).encode("utf-8")) for m in turn)
+    for _ in range(rounds):
+        start = time.perf_counter()
+        conv = Conversation.query.filter_by(id=conv_id, session_id=session_id).first()
+        app_module.append_message_rows(conv, turn)
+        db.session.commit()
+        timings.append((time.perf_counter() - start) * 1000)
+        Message.query.filter(Message.conversation_id == conv_id, Message.seq >= size).delete()
+        db.session.get(Conversation, conv_id).message_count = size
+        db.session.commit()
+    return timings, written
+
+
+def main():
+    parser = argparse.ArgumentParser(description="每轮保存对话历史的写入耗时")
+    parser.add_argument("--sizes", default="10,100,500", help="已有历史的消息数，逗号分隔")
+    parser.add_argument("--rounds", type=int, default=30, help="每个规模写入的轮数")
+    parser.add_argument("--judge-every", type=int, default=5, help="每隔几轮有一轮 Judge 回答 (0 表示没有)")
+    args = parser.parse_args()
+
+    setup_environment()
+    import app as app_module
+
+    sizes = [int(size) for size in args.sizes.split(",")]
+    rows = []
+    with app_module.app.app_context():
+        app_module.db.create_all()
+        db, Conversation, Message = app_module.db, app_module.Conversation, app_module.Message
+        for size in sizes:
+            history = []
+            for index in range(size // 2):
+                history.extend(make_turn(index, args.judge_every))
+            turn = make_turn(size // 2, 0)
+
+            session_id = str(uuid.uuid4())
+            blob_id, rows_id = str(uuid.uuid4()), str(uuid.uuid4())
+            db.session.add(Conversation(id=blob_id, session_id=session_id,
+                                        history=json.dumps(history, ensure_ascii=False)))
+            db.session.add(Conversation(id=rows_id, session_id=session_id, message_count=len(history)))
+            for seq, message in enumerate(history):
+                db.session.add(Message.from_message(rows_id, seq, message))
+            db.session.commit()
+
+            blob_times, blob_bytes = bench_blob(app_module, blob_id, session_id, history, turn, args.rounds)
+            append_times, append_bytes = bench_append(app_module, rows_id, session_id, len(history), turn,
+                                                      args.rounds)
+            rows.append((len(history), blob_times, blob_bytes, append_times, append_bytes))
+
+    print(f"\n每轮写入耗时 (毫秒，{args.rounds} 轮)，Judge 回答每 {args.judge_every} 轮一次")
+    print(f"{'消息数':>6} | {'整段重写 中位数':>14} {'P90':>8} {'写入字节':>10} | {'只追加 中位数':>12} {'P90':>8} {'写入字节':>8}")
+    for size, blob_times, blob_bytes, append_times, append_bytes in rows:
+        print(f"{size:>9} | {percentile(blob_times, 0.5):>18.2f} {percentile(blob_times, 0.9):>8.2f} {blob_bytes:>12} | "
+              f"{percentile(append_times, 0.5):>17.2f} {percentile(append_times, 0.9):>8.2f} {append_bytes:>10}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+"""
+文件名: bench_image_preprocess.py
+功  能: 测量图片预处理对OCR请求体大小与端到端识别耗时的影响 (需要 Pillow)。
+描  述:
+1. 生成几类典型上传图片：手机拍摄的文书照片 (4032x3024、带EXIF旋转、噪点)、手机截图PNG、长截图PNG、小图。
+2. 分别在关闭/开启预处理时调用 multimodal_handler.ocr_image_yunwu，远程接口替换为模拟实现：
+   耗时 = 固定延迟 + 请求体按 --uplink-mbps 上传所需时间 (切块并行时各块分别计时)。
+3. 输出原文件大小、实际发送的图片字节数与JSON请求体大小、切块数、预处理耗时与端到端耗时。
+
+用法: python benchmarks/bench_image_preprocess.py --uplink-mbps 20 --model-latency-ms 800
+"""
+
+import argparse
+import io
+import json
+import os
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+
+def document_image(width, height, line_height, noise_sigma=0):
+    """白底黑字的文书图片；noise_sigma>0 时叠加噪点模拟手机拍摄"""
+    from PIL import Image, ImageDraw
+
+    image = Image.new("RGB", (width, height), (246, 244, 238))
+    if noise_sigma:
+        noise = Image.effect_noise((width, height), noise_sigma).convert("RGB")
+        image = Image.blend(image, noise, 0.25)
+    draw = ImageDraw.Draw(image)
+    margin = width // 12
+    for i, top in enumerate(range(margin, height - margin, line_height)):
+        # 用短横条代替文字：宽度随行变化，行间留白
+        words = 8 + (i * 7) % 9
+        x = margin
+        for j in range(words):
+            word_width = line_height * (1 + (i + j) % 3)
+            if x + word_width > width - margin:
+                break
+            draw.rectangle((x, top, x + word_width, top + line_height // 2), fill=(30, 30, 30))
+            x += word_width + line_height // 3
+    return image
+
+
+def sample_images():
+    from PIL import Image
+
+    photo = document_image(4032, 3024, 60, noise_sigma=40)
+    exif = Image.Exif()
+    exif[274] = 6  # 手机竖拍：像素横向存储，显示时顺时针旋转90度
+    buffer = io.BytesIO()
+    photo.save(buffer, format="JPEG", quality=92, exif=exif.tobytes())
+    samples = [("手机拍摄文书 4032x3024 JPEG", "photo.jpg", buffer.getvalue())]
+
+    for name, filename, image in [
+        ("手机截图 1170x2532 PNG", "screen.png", document_image(1170, 2532, 40)),
+        ("长截图 1080x9000 PNG", "long.png", document_image(1080, 9000, 40)),
+        ("小图 800x600 PNG", "small.png", document_image(800, 600, 24)),
+    ]:
+        buffer = io.BytesIO()
+        image.save(buffer, format="PNG")
+        samples.append((name, filename, buffer.getvalue()))
+    return samples
+
+
+class FakeResponse:
+    def __init__(self, data):
+        self._data = data
+
+    def json(self):
+        return self._data
+
+
+def main():
+    parser = argparse.ArgumentParser(description="图片预处理的请求体大小与端到端OCR耗时")
+    parser.add_argument("--uplink-mbps", type=float, default=20.0, help="模拟的上传带宽 (Mbit/s)")
+    parser.add_argument("--model-latency-ms", type=float, default=800.0, help="模拟的模型固定耗时 (毫秒/次)")
+    args = parser.parse_args()
+
+    import config
+    import multimodal_handler
+
+    body_sizes = []
+
+    def fake_post(url, **kwargs):
+        body = len(json.dumps(kwargs["json"]))
+        body_sizes.append(body)
+        time.sleep(args.model_latency_ms / 1000 + body * 8 / (args.uplink_mbps * 1e6))
+        return FakeResponse({"choices": [{"message": {"content": "识别文本"}}]})
+
+    multimodal_handler.requests.post = fake_post
+    workdir = tempfile.mkdtemp(prefix="bench_image_")
+
+    rows = []
+    for name, filename, data in sample_images():
+        path = os.path.join(workdir, filename)
+        with open(path, "wb") as f:
+            f.write(data)
+        for enabled in (False, True):
+            config.IMAGE_PREPROCESS_ENABLED = enabled
+            body_sizes.clear()
+            prepared = multimodal_handler.prepare_ocr_image(data)
+            start = time.perf_counter()
+            multimodal_handler.ocr_image_yunwu(path)
+            elapsed_ms = (time.perf_counter() - start) * 1000
+            rows.append((name if not enabled else "", "开启" if enabled else "关闭", len(data),
+                         prepared.output_bytes, sum(body_sizes), prepared.tiles,
+                         prepared.parts[0][0], prepared.elapsed_ms, elapsed_ms))
+
+    print(f"\n模拟上传带宽 {args.uplink_mbps} Mbit/s，模型固定耗时 {args.model_latency_ms:.0f}ms；字节数单位 KB")
+    print(f"{'图片':<26} | {'预处理':>4} | {'原文件':>8} | {'发送图片':>8} | {'请求体':>8} | {'块数':>4} | "
+          f"{'MIME':>10} | {'预处理ms':>8} | {'端到端ms':>8}")
+    for name, mode, original, sent, body, tiles, mime, preprocess_ms, elapsed_ms in rows:
+        print(f"{name:<24} | {mode:>5} | {original / 1024:>9.0f} | {sent / 1024:>10.0f} | {body / 1024:>9.0f} | "
+              f"{tiles:>6} | {mime:>10} | {preprocess_ms:>10.0f} | {elapsed_ms:>10.0f}")
+    print(json.dumps(multimodal_handler.ocr_stats.stats(), ensure_ascii=False))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+"""
+文件名: bench_prefetch.py
+功  能: 测量输入时RAG预取对 /send_message 首字时间 (TTFT) 的缩短量，以及预取的浪费比例。
+描  述:
+1. 用假的检索器替换 Milvus + 嵌入模型：编码耗时 --encode-ms、检索耗时 --search-ms (模拟CPU上的 bge-large)。
+   上游替换为首字延迟 --upstream-ms 的假流，后端走 inprocess 传输。
+2. 模拟输入：每个问题在输入到 50%、80%、100% 时停顿，各触发一次 /prefetch_rag (即防抖后的请求)；
+   按 --edit-rate 的比例在发送前再改动几个字 (近似命中或未命中)。
+3. 分别在关闭/开启预取时发送同样的问题，统计 TTFT 中位数与 P90，并输出 /prefetch_stats 的命中率与浪费比例。
+
+用法: python benchmarks/bench_prefetch.py --questions 20 --encode-ms 80 --search-ms 20
+"""
+
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+from types import SimpleNamespace
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+QUESTIONS = [
+    "我朋友醉驾撞人了，对方轻伤，会判多久",
+    "帮人取钱从中拿了好处费算不算帮信罪",
+    "在网上卖自己的银行卡会被判刑吗",
+    "打架把人打成轻伤二级可以和解吗",
+    "借钱不还被告诈骗，这种情况构成犯罪吗",
+    "公司让我做假账，我会承担刑事责任吗",
+    "捡到别人的手机不还算盗窃吗",
+    "酒后驾驶电动车被查会不会坐牢",
+]
+EDITS = ["呢", "？", "，谢谢", "，请详细说明"]
+
+
+def setup_environment(args):
+    workdir = tempfile.mkdtemp(prefix="bench_prefetch_")
+    os.environ.update({
+        "SESSION_FILE_DIR": os.path.join(workdir, "sessions"),
+        "SQLALCHEMY_DATABASE_URI": f"sqlite:///{os.path.join(workdir, 'conversations.db')}",
+        "RESPONSE_CACHE_ENABLED": "False",
+        "SEMANTIC_CACHE_ENABLED": "False",
+        "HISTORY_SUMMARY_ENABLED": "False",
+        "ADMISSION_SESSION_RATE": "0",
+        "BACKEND_TRANSPORT": "inprocess",
+        "STREAM_COALESCE_MS": "0",
+    })
+
+
+class FakeRetriever:
+    """按固定耗时模拟查询编码与向量检索"""
+    case_count = 1000
+
+    def __init__(self, encode_ms, search_ms):
+        self.encode_s = encode_ms / 1000.0
+        self.search_s = search_ms / 1000.0
+
+    def encode_query(self, query_text):
+        import numpy as np
+        time.sleep(self.encode_s)
+        vec = np.zeros(8, dtype=np.float32)
+        vec[hash(query_text) % 8] = 1.0
+        return vec
+
+    @staticmethod
+    def make_case(case_id):
+        return {'fact': f'案情{case_id}', 'meta': {'accusation': ['危险驾驶'], 'relevant_articles': [133],
+                                                 'punish_of_money': 1000, 'term_of_imprisonment': {'imprisonment': 6}}}
+
+    def search_similar_cases(self, query_text, k=5, min_score=0.5, query_vec=None):
+        if query_vec is None:
+            query_vec = self.encode_query(query_text)
+        time.sleep(self.search_s)
+        return [{'case_id': i, 'similarity_score': 0.8, 'formatted_case': self.make_case(i)} for i in range(k)]
+
+    def get_cases(self, case_ids):
+        return {case_id: self.make_case(case_id) for case_id in case_ids}
+
+
+def install_fake_upstream(llm, upstream_ms):
+    def fake_create_chat_stream(model_name, messages):
+        time.sleep(upstream_ms / 1000.0)
+        for text in ["根据", "相关", "案例", "分析"]:
+            yield SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=text))])
+    llm.create_chat_stream = fake_create_chat_stream
+
+
+def send_and_measure_ttft(client, message):
+    """发送消息，返回从请求开始到收到第一个 chunk 事件的毫秒数"""
+    start = time.perf_counter()
+    response = client.post('/send_message', json={'message': message, 'model': 'deepseek'})
+    ttft = None
+    for data in response.response:
+        if ttft is None and b'"chunk"' in data:
+            ttft = (time.perf_counter() - start) * 1000
+    response.close()
+    return ttft
+
+
+def run(app_module, questions, args, prefetch):
+    """按模拟输入过程发送全部问题，返回TTFT列表"""
+    app_module.rag_prefetcher = app_module.RagPrefetcher(
+        wait_timeout=args.wait_timeout) if prefetch else None
+    client = app_module.app.test_client()
+    client.get('/')
+    client.post('/accept_disclaimer')
+
+    ttfts = []
+    for question, final in questions:
+        if prefetch:
+            for ratio in (0.5, 0.8, 1.0):
+                client.post('/prefetch_rag', json={'text': question[:max(1, int(len(question) * ratio))]})
+        time.sleep(args.think_ms / 1000.0)
+        ttfts.append(send_and_measure_ttft(client, final))
+    return ttfts
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="RAG预取的TTFT收益与浪费比例")
+    parser.add_argument("--questions", type=int, default=20, help="发送的问题数")
+    parser.add_argument("--encode-ms", type=float, default=80, help="模拟的查询编码耗时")
+    parser.add_argument("--search-ms", type=float, default=20, help="模拟的向量检索耗时")
+    parser.add_argument("--upstream-ms", type=float, default=200, help="模拟的上游首字延迟")
+    parser.add_argument("--edit-rate", type=float, default=0.25, help="发送前改动草稿的比例")
+    parser.add_argument("--think-ms", type=float, default=50, help="最后一次停顿到按下发送的间隔")
+    parser.add_argument("--wait-timeout", type=float, default=2.0, help="发送时等待进行中预取的秒数")
+    parser.add_argument("--seed", type=int, default=7)
+    args = parser.parse_args()
+
+    setup_environment(args)
+    import llm
+    import app as app_module
+
+    install_fake_upstream(llm, args.upstream_ms)
+    app_module.retrieval_system = FakeRetriever(args.encode_ms, args.search_ms)
+    with app_module.app.app_context():
+        app_module.db.create_all()
+
+    rng = random.Random(args.seed)
+    questions = []
+    for i in range(args.questions):
+        question = QUESTIONS[i % len(QUESTIONS)]
+        final = question + rng.choice(EDITS) if rng.random() < args.edit_rate else question
+        questions.append((question, final))
+
+    baseline = run(app_module, questions, args, prefetch=False)
+    with_prefetch = run(app_module, questions, args, prefetch=True)
+    stats = app_module.rag_prefetcher.stats()
+
+    print(f"\n问题数: {args.questions}, 编码 {args.encode_ms} ms + 检索 {args.search_ms} ms, "
+          f"上游首字 {args.upstream_ms} ms, 改动比例 {args.edit_rate:.0%}")
+    for name, ttfts in (("无预取", baseline), ("预取", with_prefetch)):
+        print(f"{name:>6}: TTFT 中位数 {percentile(ttfts, 0.5):7.1f} ms, P90 {percentile(ttfts, 0.9):7.1f} ms")
+    print(f"TTFT 中位数缩短: {percentile(baseline, 0.5) - percentile(with_prefetch, 0.5):.1f} ms")
+    print(f"预取统计: 预取 {stats['prefetches']} 次, 精确命中 {stats['hits_exact']}, 近似命中 {stats['hits_near']}, "
+          f"未命中 {stats['misses']}, 浪费比例 {stats['wasted_ratio']:.1%}, 平均节省 {stats['avg_saved_ms']} ms")
+
+
+if __name__ == "__main__":
+    main()
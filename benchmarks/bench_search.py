@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+"""
+文件名: bench_search.py
+功  能: 测量历史对话全文搜索 (/search 使用的 message_search.search_messages) 在大量对话下的耗时。
+描  述:
+1. 在临时SQLite数据库中为一个会话建 --conversations 个对话、每个 --turns 轮，另有 --other-sessions 个会话
+   各 --other-conversations 个对话 (索引中来自其他会话的匹配也要被过滤掉)；消息经触发器写入全文索引。
+2. 分别搜索若干个不同命中率的搜索词：至少3个字的走 FTS5 + BM25，不足3个字的退化为 LIKE 扫描。
+3. 作为对照，逐个读取该会话全部对话的历史并在 Python 中做子串匹配 (没有索引时的做法)。
+4. 输出每个搜索词的命中对话数与耗时中位数/P90。
+
+用法: python benchmarks/bench_search.py --conversations 2000 --turns 5 --rounds 20
+"""
+
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+import uuid
+from datetime import datetime, timedelta
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+TOPICS = ["醉驾撞人", "帮信罪取现", "出售银行卡", "轻伤二级和解", "借钱不还诈骗", "公司做假账", "捡到手机不还",
+          "酒后驾驶电动车", "网络赌博", "非法集资"]
+ANSWER = "根据相关案例，{topic}的情形可能构成犯罪，具体量刑取决于情节、后果以及是否取得被害人谅解。" * 4
+QUERIES = ["交通肇事罪", "帮信罪取现", "被害人谅解", "从未出现的词语", "醉驾", "醉驾 谅解"]
+
+
+def setup_environment():
+    workdir = tempfile.mkdtemp(prefix="bench_search_")
+    os.environ.update({
+        "SESSION_FILE_DIR": os.path.join(workdir, "sessions"),
+        "SQLALCHEMY_DATABASE_URI": f"sqlite:///{os.path.join(workdir, 'conversations.db')}",
+        "HISTORY_SUMMARY_ENABLED": "False",
+        "BACKEND_TRANSPORT": "inprocess",
+    })
+
+
+def populate(app_module, session_id, conversations, turns, rng):
+    """批量插入对话与消息 (经 messages 表的触发器进入全文索引)"""
+    db, Conversation, Message = app_module.db, app_module.Conversation, app_module.Message
+    now = datetime.now()
+    conv_rows, message_rows = [], []
+    for index in range(conversations):
+        conv_id = str(uuid.uuid4())
+        topic = rng.choice(TOPICS)
+        conv_rows.append({"id": conv_id, "session_id": session_id, "title": topic, "message_count": turns * 2,
+                          "created_at": now, "updated_at": now - timedelta(minutes=index)})
+        for turn in range(turns):
+            question = f"{topic}的问题{turn}：这种情况会怎么判？" + ("是否构成交通肇事罪？" if topic == "醉驾撞人" else "")
+            message_rows.append({"conversation_id": conv_id, "seq": turn * 2, "role": "user", "content": question,
+                                 "created_at": now})
+            message_rows.append({"conversation_id": conv_id, "seq": turn * 2 + 1, "role": "assistant",
+                                 "content": ANSWER.format(topic=topic), "created_at": now})
+    db.session.execute(db.insert(Conversation), conv_rows)
+    db.session.execute(db.insert(Message), message_rows)
+    db.session.commit()
+
+
+def scan_without_index(app_module, session_id, query):
+    """对照：读出全部历史后在 Python 中匹配"""
+    terms = query.split()
+    matched = 0
+    for conv in app_module.Conversation.query.filter_by(session_id=session_id).all():
+        if any(all(term in m["content"] for term in terms) for m in conv.get_history()):
+            matched += 1
+    return matched
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def timed(func, rounds):
+    timings, result = [], None
+    for _ in range(rounds):
+        start = time.perf_counter()
+        result = func()
+        timings.append((time.perf_counter() - start) * 1000)
+    return timings, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="历史对话全文搜索耗时")
+    parser.add_argument("--conversations", type=int, default=2000, help="被搜索会话的对话数")
+    parser.add_argument("--turns", type=int, default=5, help="每个对话的轮数")
+    parser.add_argument("--other-sessions", type=int, default=10, help="其他会话数")
+    parser.add_argument("--other-conversations", type=int, default=500, help="每个其他会话的对话数")
+    parser.add_argument("--rounds", type=int, default=20, help="每个搜索词的重复次数")
+    parser.add_argument("--baseline-rounds", type=int, default=3, help="无索引对照的重复次数 (0 表示跳过)")
+    parser.add_argument("--seed", type=int, default=7)
+    args = parser.parse_args()
+
+    setup_environment()
+    import app as app_module
+    from message_search import search_messages
+
+    rng = random.Random(args.seed)
+    session_id = str(uuid.uuid4())
+    with app_module.app.app_context():
+        app_module.db.create_all()
+        app_module.install_search_index()
+        if not app_module.message_search_available:
+            print("当前 SQLite 不支持 FTS5 trigram，无法测试")
+            return
+
+        start = time.perf_counter()
+        populate(app_module, session_id, args.conversations, args.turns, rng)
+        for _ in range(args.other_sessions):
+            populate(app_module, str(uuid.uuid4()), args.other_conversations, args.turns, rng)
+        total_messages = (args.conversations + args.other_sessions * args.other_conversations) * args.turns * 2
+        print(f"写入 {total_messages} 条消息 (含全文索引) 用时 {time.perf_counter() - start:.1f} s")
+
+        print(f"\n会话内 {args.conversations} 个对话 × {args.turns} 轮，耗时单位毫秒")
+        print(f"{'搜索词':<14} {'模式':>4} {'命中对话':>6} | {'中位数':>8} {'P90':>8} | {'无索引对照':>10}")
+        for query in QUERIES:
+            timings, result = timed(lambda: search_messages(
+                app_module.db.session, session_id, query, limit=20, max_hits=200), args.rounds)
+            baseline = ""
+            if args.baseline_rounds:
+                base_timings, _ = timed(lambda: scan_without_index(app_module, session_id, query),
+                                        args.baseline_rounds)
+                baseline = f"{percentile(base_timings, 0.5):.1f}"
+            print(f"{query:<14} {result['mode']:>6} {len(result['conversations']):>9} | "
+                  f"{percentile(timings, 0.5):>10.2f} {percentile(timings, 0.9):>8.2f} | {baseline:>12}")
+
+
+if __name__ == "__main__":
+    main()
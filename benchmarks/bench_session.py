@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+"""
+文件名: bench_session.py
+功  能: 测量每个请求的会话存储开销：Flask-Session filesystem vs session_store 的 memory / sqlite 存储。
+描  述:
+1. 注册测试路由：/_bench/plain 不使用会话 (但每个请求仍会打开会话)；/_bench/turn 与 /send_message 一样
+   读取会话并写回 selected_model / rag_enabled (值不变)；/_bench/change 每次写入不同的值。
+2. 每种存储先用 --clients 个客户端各建立一个会话，再按轮次让各客户端依次请求，
+   输出各类请求耗时的中位数 (P90)、跳过的写入次数，以及存储中的会话数 (filesystem 为文件数)。
+   测试路由本身几乎不耗时，请求耗时的差别即为会话存储的开销。
+
+用法: python benchmarks/bench_session.py --clients 200 --requests 2000
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+
+def setup_environment():
+    workdir = tempfile.mkdtemp(prefix="bench_session_")
+    os.environ.update({
+        "SESSION_TYPE": "filesystem",
+        "SESSION_FILE_DIR": os.path.join(workdir, "sessions"),
+        "SESSION_SQLITE_PATH": os.path.join(workdir, "sessions.db"),
+        "SQLALCHEMY_DATABASE_URI": f"sqlite:///{os.path.join(workdir, 'conversations.db')}",
+        "HISTORY_SUMMARY_ENABLED": "False",
+        "BACKEND_TRANSPORT": "inprocess",
+    })
+    return workdir
+
+
+def register_routes(flask_app):
+    from flask import session
+
+    @flask_app.route('/_bench/plain')
+    def bench_plain():
+        return 'ok'
+
+    @flask_app.route('/_bench/start')
+    def bench_start():
+        session['session_id'] = os.urandom(8).hex()
+        session['selected_model'] = 'deepseek'
+        session['rag_enabled'] = True
+        session['disclaimer_accepted'] = True
+        return 'ok'
+
+    @flask_app.route('/_bench/turn')
+    def bench_turn():
+        # 与 /send_message 相同：读取设置并写回 (值不变)
+        session['selected_model'] = session.get('selected_model', 'deepseek')
+        session['rag_enabled'] = session.get('rag_enabled', True)
+        return 'ok'
+
+    @flask_app.route('/_bench/change')
+    def bench_change():
+        session['selected_model'] = os.urandom(4).hex()
+        return 'ok'
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def measure(clients, path, total):
+    timings = []
+    for i in range(total):
+        client = clients[i % len(clients)]
+        start = time.perf_counter()
+        client.get(path)
+        timings.append((time.perf_counter() - start) * 1000)
+    return timings
+
+
+def stored_sessions(interface, session_dir):
+    if hasattr(interface, 'stats'):
+        return interface.stats()['sessions']
+    return len(os.listdir(session_dir)) if os.path.isdir(session_dir) else 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="每个请求的会话存储开销")
+    parser.add_argument("--clients", type=int, default=200, help="并存的会话数")
+    parser.add_argument("--requests", type=int, default=2000, help="每种请求的次数")
+    args = parser.parse_args()
+
+    setup_environment()
+    import config
+    import app as app_module
+    from session_store import create_session_interface
+
+    flask_app = app_module.app
+    register_routes(flask_app)
+    interfaces = [
+        ("filesystem", flask_app.session_interface),
+        ("memory", create_session_interface("memory", config.SESSION_SQLITE_PATH, config.SESSION_TTL,
+                                            sweep_interval=0)),
+        ("sqlite", create_session_interface("sqlite", config.SESSION_SQLITE_PATH, config.SESSION_TTL,
+                                            sweep_interval=0)),
+    ]
+
+    rows = []
+    for name, interface in interfaces:
+        flask_app.session_interface = interface
+        clients = [flask_app.test_client() for _ in range(args.clients)]
+        start_timings = []
+        for client in clients:
+            start = time.perf_counter()
+            client.get('/_bench/start')
+            start_timings.append((time.perf_counter() - start) * 1000)
+        plain = measure(clients, '/_bench/plain', args.requests)
+        turn = measure(clients, '/_bench/turn', args.requests)
+        change = measure(clients, '/_bench/change', args.requests)
+        skipped = interface.stats()['skipped_writes'] if hasattr(interface, 'stats') else 0
+        rows.append((name, start_timings, plain, turn, change, skipped,
+                     stored_sessions(interface, config.SESSION_FILE_DIR)))
+
+    def cell(timings):
+        return f"{percentile(timings, 0.5):.3f} ({percentile(timings, 0.9):.3f})"
+
+    print(f"\n{args.clients} 个会话，每种请求 {args.requests} 次；请求耗时中位数 (P90)，单位毫秒")
+    print(f"{'存储':>10} | {'新建会话':>14} | {'不使用会话':>13} | {'设置不变':>14} | {'设置改变':>14} | "
+          f"{'跳过写入':>8} | {'会话数':>6}")
+    for name, start_timings, plain, turn, change, skipped, count in rows:
+        print(f"{name:>12} | {cell(start_timings):>18} | {cell(plain):>18} | {cell(turn):>18} | {cell(change):>18} | "
+              f"{skipped:>12} | {count:>9}")
+
+
+if __name__ == "__main__":
+    main()
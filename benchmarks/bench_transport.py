@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+"""
+文件名: bench_transport.py
+功  能: 对比 app.py → llm.py 两种传输方式的每token开销。
+描  述:
+1. 用假的上游流替换 llm.create_chat_stream，上游以零延迟产出 N 个token，只测中间链路的开销。
+2. http 模式：在本机随机端口启动 llm.py 的 Flask 应用，经 HttpTransport 读取 SSE。
+3. inprocess 模式：经 InProcessTransport 直接消费事件生成器。
+4. 两种模式都按 app.py 的方式把事件再编码为发往浏览器的 data: 行。
+
+用法: python benchmarks/bench_transport.py --tokens 5000 --rounds 5
+"""
+
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import llm  # noqa: E402
+from transport import HttpTransport, InProcessTransport  # noqa: E402
+
+
+def fake_stream_factory(token_count):
+    """构造假的上游流：每个chunk携带一个中文token"""
+    def fake_create_chat_stream(model_name, messages):
+        for i in range(token_count):
+            delta = SimpleNamespace(content="案" if i % 2 else "件")
+            yield SimpleNamespace(choices=[SimpleNamespace(delta=delta)])
+    return fake_create_chat_stream
+
+
+def run_once(transport, payload):
+    """模拟 app.py 的转发循环，返回 (耗时秒, 转发的chunk数)"""
+    forwarded = 0
+    start = time.perf_counter()
+    for event in transport.stream(payload):
+        if event.get("event") == "chunk":
+            _ = f"data: {json.dumps({'event': 'chunk', 'chunk': event['chunk']})}\n\n"
+            forwarded += 1
+        elif event.get("event") == "end_of_stream":
+            break
+    return time.perf_counter() - start, forwarded
+
+
+def start_llm_server():
+    """在后台线程启动 llm.py 的 WSGI 服务，返回 (server, url)"""
+    import logging
+    from werkzeug.serving import make_server
+    logging.getLogger("werkzeug").setLevel(logging.ERROR)
+    server = make_server("127.0.0.1", 0, llm.app, threaded=True)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server, f"http://127.0.0.1:{server.server_port}/predict"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="传输层每token开销基准测试")
+    parser.add_argument("--tokens", type=int, default=5000, help="每轮上游产出的token数")
+    parser.add_argument("--rounds", type=int, default=5, help="每种模式的测量轮数")
+    args = parser.parse_args()
+
+    llm.create_chat_stream = fake_stream_factory(args.tokens)
+    payload = {
+        "user_question": "我朋友醉驾撞人了会判多久",
+        "rag_data": [],
+        "chat_history": [],
+        "model_id": "deepseek",
+        "cache_control": "no-store"  # 不读写回答缓存
+    }
+
+    server, url = start_llm_server()
+    try:
+        transports = {"http": HttpTransport(url), "inprocess": InProcessTransport()}
+        print(f"上游token数: {args.tokens}, 轮数: {args.rounds}")
+        for name, transport in transports.items():
+            run_once(transport, payload)  # 预热
+            timings = []
+            for _ in range(args.rounds):
+                elapsed, forwarded = run_once(transport, payload)
+                assert forwarded == args.tokens, f"{name}: 转发 {forwarded} != {args.tokens}"
+                timings.append(elapsed)
+            best = min(timings)
+            print(f"{name:>10}: 最佳 {best * 1000:8.1f} ms/轮, 每token {best / args.tokens * 1e6:7.2f} µs")
+    finally:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+"""
+文件名: cancellation.py
+功  能: 流式请求的取消登记表 (app.py 与 llm.py 各持有一个实例)。
+描  述:
+1. 每个流式请求以 request_id 登记一个 CancelToken，同时按 conversation_id 建立索引，
+   /cancel_request 可以按请求ID或对话ID取消 (只能取消登记时记录的会话自己的请求)。
+2. CancelToken.cancel() 会立即执行已登记的回调 (例如关闭上游 OpenAI 流或后端HTTP连接)，
+   使阻塞在读取上的工作线程马上退出，而不是等到下一个token到达。
+3. 统计被取消的流数量、取消前已接收的上游块数 (合并帧之前的模型增量数)，
+   并按正常完成的流的平均长度估算节省的上游块数。
+"""
+
+import threading
+import time
+
+
+class CancelToken:
+    """单个请求的取消标记"""
+
+    def __init__(self, request_id, conversation_id=None, session_key=None):
+        self.request_id = request_id
+        self.conversation_id = conversation_id
+        self.session_key = session_key  # 发起请求的会话，只有该会话可以取消
+        self.reason = None
+        self.created_at = time.time()
+        self._event = threading.Event()
+        self._callbacks = []
+        self._lock = threading.Lock()
+
+    @property
+    def cancelled(self):
+        return self._event.is_set()
+
+    def add_callback(self, callback):
+        """登记取消时要执行的回调；若已取消则立即执行"""
+        with self._lock:
+            if not self._event.is_set():
+                self._callbacks.append(callback)
+                return
+        self._run(callback)
+
+    def cancel(self, reason="user"):
+        """触发取消 (幂等)"""
+        with self._lock:
+            if self._event.is_set():
+                return False
+            self.reason = reason
+            self._event.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            self._run(callback)
+        return True
+
+    @staticmethod
+    def _run(callback):
+        try:
+            callback()
+        except Exception as e:
+            print(f"取消回调执行失败: {e}")
+
+
+class CancellationRegistry:
+    """按请求ID/对话ID登记进行中的流式请求"""
+
+    def __init__(self):
+        self._tokens = {}
+        self._by_conversation = {}
+        self._lock = threading.Lock()
+        self._stats = {
+            "cancelled_streams": 0,
+            "client_disconnects": 0,
+            "chunks_before_cancel": 0,
+            "completed_streams": 0,
+            "completed_chunks": 0,
+            "estimated_chunks_saved": 0
+        }
+
+    def register(self, request_id, conversation_id=None, session_key=None):
+        """登记一个请求，返回其 CancelToken"""
+        token = CancelToken(request_id, conversation_id, session_key)
+        with self._lock:
+            self._tokens[request_id] = token
+            if conversation_id:
+                self._by_conversation[conversation_id] = request_id
+        return token
+
+    def get(self, request_id):
+        """返回进行中请求的 CancelToken，不存在时返回None"""
+        with self._lock:
+            return self._tokens.get(request_id)
+
+    def unregister(self, token):
+        with self._lock:
+            if self._tokens.get(token.request_id) is token:
+                del self._tokens[token.request_id]
+            if token.conversation_id and self._by_conversation.get(token.conversation_id) == token.request_id:
+                del self._by_conversation[token.conversation_id]
+
+    def cancel(self, request_id=None, conversation_id=None, reason="user"):
+        """按请求ID (优先) 或对话ID取消，返回是否找到并取消了请求"""
+        with self._lock:
+            if not request_id and conversation_id:
+                request_id = self._by_conversation.get(conversation_id)
+            token = self._tokens.get(request_id) if request_id else None
+        return token.cancel(reason) if token else False
+
+    def record_finish(self, token, chunks_received):
+        """流结束时记录统计：正常完成的流用于估算平均长度，被取消的流累计节省量"""
+        with self._lock:
+            if token.cancelled:
+                self._stats["cancelled_streams"] += 1
+                if token.reason == "disconnect":
+                    self._stats["client_disconnects"] += 1
+                self._stats["chunks_before_cancel"] += chunks_received
+                if self._stats["completed_streams"]:
+                    average = self._stats["completed_chunks"] / self._stats["completed_streams"]
+                    self._stats["estimated_chunks_saved"] += max(0, int(average - chunks_received))
+            else:
+                self._stats["completed_streams"] += 1
+                self._stats["completed_chunks"] += chunks_received
+
+    def stats(self):
+        with self._lock:
+            return {**self._stats, "active_streams": len(self._tokens)}
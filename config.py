@@ -20,9 +20,23 @@ ALLOWED_EXTENSIONS = {"jpg", "jpeg", "png", "mp3", "wav", "m4a"}
 MAX_FILE_SIZE = int(os.getenv("MAX_FILE_SIZE", str(10 * 1024 * 1024)))  # 10MB
 MAX_FILES_COUNT = int(os.getenv("MAX_FILES_COUNT", "5"))
 
+# 图片OCR前的本地预处理（需要 Pillow）：纠正EXIF方向、缩小并重新编码，长图切块后并行识别
+IMAGE_PREPROCESS_ENABLED = os.getenv("IMAGE_PREPROCESS_ENABLED", "True").lower() in {"1", "true", "yes", "on"}
+IMAGE_MAX_LONG_EDGE = int(os.getenv("IMAGE_MAX_LONG_EDGE", "2048"))  # 缩放后的最大长边 (长图为每块的最大高度)
+IMAGE_JPEG_QUALITY = int(os.getenv("IMAGE_JPEG_QUALITY", "85"))  # 重新编码的JPEG质量
+IMAGE_PASSTHROUGH_BYTES = int(os.getenv("IMAGE_PASSTHROUGH_BYTES", str(512 * 1024)))  # 不超过该大小且无需旋转/切块的图片直接发送
+IMAGE_TILE_ASPECT = float(os.getenv("IMAGE_TILE_ASPECT", "2.5"))  # 高宽比超过该值的长图切块识别
+IMAGE_MAX_TILES = int(os.getenv("IMAGE_MAX_TILES", "6"))  # 长图最多切成的块数
+OCR_TILE_WORKERS = int(os.getenv("OCR_TILE_WORKERS", "6"))  # 并行识别切块的线程数
+
 # 会话存储配置
-SESSION_TYPE = os.getenv("SESSION_TYPE", "filesystem")
+# sqlite: 单个SQLite文件 (多进程共用)；memory: 进程内LRU (单进程，重启丢失)；filesystem: Flask-Session 每会话一个文件
+SESSION_TYPE = os.getenv("SESSION_TYPE", "sqlite")
 SESSION_FILE_DIR = os.getenv("SESSION_FILE_DIR", "./flask_session")
+SESSION_SQLITE_PATH = os.getenv("SESSION_SQLITE_PATH", os.path.join(SESSION_FILE_DIR, "sessions.db"))
+SESSION_TTL = int(os.getenv("SESSION_TTL", str(30 * 24 * 3600)))  # 会话最后一次访问后保留的秒数
+SESSION_SWEEP_INTERVAL = int(os.getenv("SESSION_SWEEP_INTERVAL", "600"))  # 后台清理过期会话的间隔秒数
+SESSION_MEMORY_MAX_ENTRIES = int(os.getenv("SESSION_MEMORY_MAX_ENTRIES", "10000"))  # memory 存储保留的会话数
 SESSION_PERMANENT = os.getenv("SESSION_PERMANENT", "False").lower() in {"1", "true", "yes", "on"}
 SESSION_USE_SIGNER = os.getenv("SESSION_USE_SIGNER", "True").lower() in {"1", "true", "yes", "on"}
 SESSION_KEY_PREFIX = os.getenv("SESSION_KEY_PREFIX", "legal_assistant:")
@@ -30,9 +44,152 @@ SESSION_KEY_PREFIX = os.getenv("SESSION_KEY_PREFIX", "legal_assistant:")
 # SQLite 数据库配置
 SQLALCHEMY_DATABASE_URI = os.getenv("SQLALCHEMY_DATABASE_URI", "sqlite:///conversations.db")
 SQLALCHEMY_TRACK_MODIFICATIONS = os.getenv("SQLALCHEMY_TRACK_MODIFICATIONS", "False").lower() in {"1", "true", "yes", "on"}
+# SQLite 连接参数：WAL 模式下读写互不阻塞；synchronous=NORMAL 时提交不再每次 fsync (检查点时才同步)
+SQLITE_JOURNAL_MODE = os.getenv("SQLITE_JOURNAL_MODE", "WAL")
+SQLITE_SYNCHRONOUS = os.getenv("SQLITE_SYNCHRONOUS", "NORMAL")
+SQLITE_BUSY_TIMEOUT_MS = int(os.getenv("SQLITE_BUSY_TIMEOUT_MS", "5000"))  # 数据库被锁时等待的毫秒数
+
+# 分页：切换对话时只返回最近的若干条消息 (更早的消息滚动到顶部时再加载)，对话列表每页的条数
+HISTORY_PAGE_SIZE = int(os.getenv("HISTORY_PAGE_SIZE", "30"))
+CONVERSATION_PAGE_SIZE = int(os.getenv("CONVERSATION_PAGE_SIZE", "30"))
+MAX_PAGE_SIZE = int(os.getenv("MAX_PAGE_SIZE", "200"))  # 请求参数 limit 的上限
+
+# 历史对话全文搜索 (SQLite FTS5 trigram 索引)：每次返回的对话数、每个对话的片段数、参与排序的匹配消息数上限
+MESSAGE_SEARCH_ENABLED = os.getenv("MESSAGE_SEARCH_ENABLED", "True").lower() in {"1", "true", "yes", "on"}
+SEARCH_PAGE_SIZE = int(os.getenv("SEARCH_PAGE_SIZE", "20"))
+SEARCH_SNIPPETS_PER_CONVERSATION = int(os.getenv("SEARCH_SNIPPETS_PER_CONVERSATION", "3"))
+SEARCH_MAX_HITS = int(os.getenv("SEARCH_MAX_HITS", "200"))
+
+# 每轮对话的写入由后台队列成批提交（关闭后在请求线程中同步写入）
+WRITE_BEHIND_ENABLED = os.getenv("WRITE_BEHIND_ENABLED", "True").lower() in {"1", "true", "yes", "on"}
+WRITE_BEHIND_MAX_BATCH = int(os.getenv("WRITE_BEHIND_MAX_BATCH", "64"))  # 每个事务最多写入的对话轮数
+WRITE_BEHIND_READ_WAIT = float(os.getenv("WRITE_BEHIND_READ_WAIT", "5"))  # 读取会话数据前等待其未完成写入的秒数
+WRITE_BEHIND_DRAIN_TIMEOUT = float(os.getenv("WRITE_BEHIND_DRAIN_TIMEOUT", "10"))  # 关闭服务时写完队列的最长秒数
+
+# 数据库定期维护：保留期外的对话归档 (gzip NDJSON) 后删除，增量 VACUUM 回收空闲页，ANALYZE
+MAINTENANCE_ENABLED = os.getenv("MAINTENANCE_ENABLED", "True").lower() in {"1", "true", "yes", "on"}
+MAINTENANCE_INTERVAL_HOURS = float(os.getenv("MAINTENANCE_INTERVAL_HOURS", "24"))
+MAINTENANCE_INITIAL_DELAY = float(os.getenv("MAINTENANCE_INITIAL_DELAY", "300"))  # 启动后首次维护前等待的秒数
+RETENTION_DAYS = int(os.getenv("RETENTION_DAYS", "0"))  # 对话最后更新后保留的天数（0 不清理）
+ARCHIVE_DIR = os.getenv("ARCHIVE_DIR", "./archive")  # 清理前的归档目录（为空时不归档）
+MAINTENANCE_VACUUM_PAGES = int(os.getenv("MAINTENANCE_VACUUM_PAGES", "0"))  # 每次最多回收的空闲页数（0 全部）
+# 旧库 (auto_vacuum=NONE) 首次维护时执行一次完整 VACUUM 转换为增量模式（期间阻塞写入）
+MAINTENANCE_CONVERT_AUTO_VACUUM = os.getenv("MAINTENANCE_CONVERT_AUTO_VACUUM", "True").lower() in {"1", "true", "yes", "on"}
 
 # 后端API服务的完整地址
 API_URL = os.getenv("API_URL", "http://127.0.0.1:5000/predict")
 
 # RAG 调试开关（环境变量 RAG_DEBUG=1/true/on）
 RAG_DEBUG = os.getenv("RAG_DEBUG", "0").strip().lower() in {"1", "true", "yes", "on"}
+
+# 单模型回答缓存（llm.py /predict）
+RESPONSE_CACHE_ENABLED = os.getenv("RESPONSE_CACHE_ENABLED", "True").lower() in {"1", "true", "yes", "on"}
+RESPONSE_CACHE_PATH = os.getenv("RESPONSE_CACHE_PATH", "./cache/response_cache.db")
+RESPONSE_CACHE_MAX_MEMORY_BYTES = int(os.getenv("RESPONSE_CACHE_MAX_MEMORY_BYTES", str(32 * 1024 * 1024)))  # 32MB
+RESPONSE_CACHE_TTL = int(os.getenv("RESPONSE_CACHE_TTL", str(24 * 3600)))  # 秒
+RESPONSE_CACHE_MAX_DISK_ENTRIES = int(os.getenv("RESPONSE_CACHE_MAX_DISK_ENTRIES", "10000"))
+RESPONSE_CACHE_REPLAY_CHUNK = int(os.getenv("RESPONSE_CACHE_REPLAY_CHUNK", "16"))  # 重放时每个SSE块的字符数
+
+# 图片OCR / 语音识别结果缓存（按文件内容 SHA-256 + 识别引擎，相同文件重复上传不再调用远程服务）
+MEDIA_CACHE_ENABLED = os.getenv("MEDIA_CACHE_ENABLED", "True").lower() in {"1", "true", "yes", "on"}
+MEDIA_CACHE_PATH = os.getenv("MEDIA_CACHE_PATH", "./cache/media_cache.db")
+MEDIA_CACHE_MAX_BYTES = int(os.getenv("MEDIA_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))  # 结果文本总字节数上限
+
+# 上传文件异步识别（/upload_file 立即返回任务ID，识别在后台线程池中进行，前端轮询或通过SSE获取进度）
+UPLOAD_JOBS_ENABLED = os.getenv("UPLOAD_JOBS_ENABLED", "True").lower() in {"1", "true", "yes", "on"}
+UPLOAD_JOB_WORKERS = int(os.getenv("UPLOAD_JOB_WORKERS", "4"))  # 并发识别的线程数
+UPLOAD_JOB_MAX_PENDING = int(os.getenv("UPLOAD_JOB_MAX_PENDING", "32"))  # 排队+识别中的任务上限，超出时返回503
+UPLOAD_JOB_TTL = int(os.getenv("UPLOAD_JOB_TTL", "1800"))  # 识别完成的任务结果保留秒数
+UPLOAD_JOB_WAIT_TIMEOUT = float(os.getenv("UPLOAD_JOB_WAIT_TIMEOUT", "90"))  # 发送消息时等待附件识别完成的秒数
+UPLOAD_JOB_EVENTS_TIMEOUT = float(os.getenv("UPLOAD_JOB_EVENTS_TIMEOUT", "300"))  # SSE进度流的最长持续秒数
+
+# 语义近似回答缓存（app.py，首轮无历史提问）
+SEMANTIC_CACHE_ENABLED = os.getenv("SEMANTIC_CACHE_ENABLED", "False").lower() in {"1", "true", "yes", "on"}
+SEMANTIC_CACHE_THRESHOLD = float(os.getenv("SEMANTIC_CACHE_THRESHOLD", "0.95"))  # 余弦相似度阈值
+SEMANTIC_CACHE_MAX_ENTRIES = int(os.getenv("SEMANTIC_CACHE_MAX_ENTRIES", "500"))  # 每个命名空间的条目上限
+SEMANTIC_CACHE_TTL = int(os.getenv("SEMANTIC_CACHE_TTL", str(24 * 3600)))  # 秒
+
+# 管理接口令牌（请求头 X-Admin-Token；为空时管理接口关闭）
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN", "")
+
+# app.py 调用 llm.py 的传输方式：http（独立部署，经 API_URL）或 inprocess（同进程直接调用）
+BACKEND_TRANSPORT = os.getenv("BACKEND_TRANSPORT", "http").strip().lower()
+
+# SSE 中继的分时合并：每隔多少毫秒或累计多少字节发出一帧（STREAM_COALESCE_MS=0 关闭合并）
+STREAM_COALESCE_MS = int(os.getenv("STREAM_COALESCE_MS", "50"))
+STREAM_COALESCE_BYTES = int(os.getenv("STREAM_COALESCE_BYTES", "512"))
+
+# 提示词token预算（llm.py 组装提示词时按预算裁剪案例与历史）
+# PROMPT_TOKEN_BUDGETS 按模型覆盖默认预算，如 "deepseek=12000,claude=32000,judge=8000"
+PROMPT_TOKEN_BUDGET = int(os.getenv("PROMPT_TOKEN_BUDGET", "16000"))
+PROMPT_TOKEN_BUDGETS = {
+    name.strip(): int(value)
+    for name, value in (item.split("=", 1) for item in os.getenv("PROMPT_TOKEN_BUDGETS", "").split(",") if "=" in item)
+}
+PROMPT_TOKEN_ENCODING = os.getenv("PROMPT_TOKEN_ENCODING", "cl100k_base")  # tiktoken 编码名
+PROMPT_FACT_SENTENCES = int(os.getenv("PROMPT_FACT_SENTENCES", "3"))  # 缩短案情时保留的句子数
+
+# 对话滚动摘要：近期未摘要的历史超过阈值时，由廉价模型把较早的轮次合并进摘要（保存在对话记录上）
+HISTORY_SUMMARY_ENABLED = os.getenv("HISTORY_SUMMARY_ENABLED", "True").lower() in {"1", "true", "yes", "on"}
+HISTORY_SUMMARY_MODEL = os.getenv("HISTORY_SUMMARY_MODEL", "deepseek")  # 生成摘要使用的模型ID
+HISTORY_SUMMARY_TRIGGER_TOKENS = int(os.getenv("HISTORY_SUMMARY_TRIGGER_TOKENS", "6000"))  # 未摘要历史的token阈值
+HISTORY_SUMMARY_KEEP_TURNS = int(os.getenv("HISTORY_SUMMARY_KEEP_TURNS", "3"))  # 始终完整保留的最近轮数
+HISTORY_SUMMARY_MAX_CHARS = int(os.getenv("HISTORY_SUMMARY_MAX_CHARS", "800"))  # 摘要字数上限
+HISTORY_SUMMARY_MESSAGE_TOKENS = int(os.getenv("HISTORY_SUMMARY_MESSAGE_TOKENS", "2000"))  # 送去摘要的单条消息token上限
+
+# 单模型对冲请求：主模型在 HEDGE_TTFT_MS 毫秒内未输出首字 (或直接报错) 时，同时请求备用模型，先出字者胜出
+HEDGE_ENABLED = os.getenv("HEDGE_ENABLED", "False").lower() in {"1", "true", "yes", "on"}
+HEDGE_TTFT_MS = int(os.getenv("HEDGE_TTFT_MS", "4000"))
+# 各模型的备用模型（模型ID=备用模型ID，逗号分隔）
+HEDGE_FALLBACKS = {
+    name.strip(): fallback.strip()
+    for name, fallback in (item.split("=", 1) for item in os.getenv(
+        "HEDGE_FALLBACKS", "deepseek=qwen,qwen=deepseek,zhipu=deepseek,gpt4o=deepseek,claude=gpt4o,grok=gpt4o"
+    ).split(",") if "=" in item)
+}
+
+# "auto" 模型路由：按各模型 TTFT / 生成速度 / 错误率的 EWMA 选择最健康的模型
+AUTO_ROUTE_MODELS_NORMAL = [m.strip() for m in os.getenv(
+    "AUTO_ROUTE_MODELS_NORMAL", "deepseek,zhipu,gpt4o,claude,qwen,grok").split(",") if m.strip()]
+AUTO_ROUTE_MODELS_PROFESSIONAL = [m.strip() for m in os.getenv(
+    "AUTO_ROUTE_MODELS_PROFESSIONAL", "gpt4o,claude,qwen,deepseek").split(",") if m.strip()]  # 专业模式只在该子集中选择
+AUTO_ROUTE_ALPHA = float(os.getenv("AUTO_ROUTE_ALPHA", "0.2"))  # EWMA 平滑系数
+AUTO_ROUTE_EXPECTED_TOKENS = int(os.getenv("AUTO_ROUTE_EXPECTED_TOKENS", "400"))  # 打分时假设的回答token数
+AUTO_ROUTE_EXPLORE = float(os.getenv("AUTO_ROUTE_EXPLORE", "0.05"))  # 随机探索其他模型的概率
+
+# 准入控制与过载保护（app.py /send_message）：全局并发上限 + 有界等待队列 + 按会话令牌桶限流
+ADMISSION_ENABLED = os.getenv("ADMISSION_ENABLED", "True").lower() in {"1", "true", "yes", "on"}
+ADMISSION_MAX_CONCURRENT = int(os.getenv("ADMISSION_MAX_CONCURRENT", "32"))  # 同时处理的请求数
+ADMISSION_MAX_QUEUE = int(os.getenv("ADMISSION_MAX_QUEUE", "64"))  # 排队请求数上限，超出返回503
+ADMISSION_QUEUE_TIMEOUT = float(os.getenv("ADMISSION_QUEUE_TIMEOUT", "15"))  # 排队最长等待秒数
+ADMISSION_RETRY_AFTER = int(os.getenv("ADMISSION_RETRY_AFTER", "5"))  # 过载时 Retry-After 秒数
+ADMISSION_SESSION_RATE = float(os.getenv("ADMISSION_SESSION_RATE", "0.2"))  # 每个会话每秒补充的令牌数（0 不限流）
+ADMISSION_SESSION_BURST = int(os.getenv("ADMISSION_SESSION_BURST", "6"))  # 每个会话可连续发送的请求数
+ADMISSION_JUDGE_COST = int(os.getenv("ADMISSION_JUDGE_COST", "3"))  # Judge 请求消耗的令牌数
+# 分级降级：负载 = (处理中 + 排队中) / (并发上限 + 队列上限)
+ADMISSION_DEGRADE_JUDGE_AT = float(os.getenv("ADMISSION_DEGRADE_JUDGE_AT", "0.4"))  # 超过后 Judge 改由单模型回答
+ADMISSION_DEGRADE_K_AT = float(os.getenv("ADMISSION_DEGRADE_K_AT", "0.7"))  # 超过后减少RAG检索案例数
+ADMISSION_JUDGE_FALLBACK_MODEL = os.getenv("ADMISSION_JUDGE_FALLBACK_MODEL", "deepseek")  # Judge 降级时使用的模型ID
+ADMISSION_DEGRADED_K = int(os.getenv("ADMISSION_DEGRADED_K", "1"))  # 降级时的RAG检索案例数
+
+# llm.py /predict 的准入控制（按 conversation_id 限流，不做降级）
+LLM_ADMISSION_MAX_CONCURRENT = int(os.getenv("LLM_ADMISSION_MAX_CONCURRENT", "64"))
+LLM_ADMISSION_MAX_QUEUE = int(os.getenv("LLM_ADMISSION_MAX_QUEUE", "128"))
+
+# 输入时的RAG检索预取（前端防抖调用 /prefetch_rag，发送时复用相同或近似草稿的检索结果）
+RAG_PREFETCH_ENABLED = os.getenv("RAG_PREFETCH_ENABLED", "True").lower() in {"1", "true", "yes", "on"}
+RAG_PREFETCH_TTL = int(os.getenv("RAG_PREFETCH_TTL", "60"))  # 预取结果有效期（秒）
+RAG_PREFETCH_MAX_PER_SESSION = int(os.getenv("RAG_PREFETCH_MAX_PER_SESSION", "3"))  # 每个会话保留的草稿数
+RAG_PREFETCH_MIN_CHARS = int(os.getenv("RAG_PREFETCH_MIN_CHARS", "4"))  # 草稿少于该字数时不预取
+RAG_PREFETCH_NEAR_THRESHOLD = float(os.getenv("RAG_PREFETCH_NEAR_THRESHOLD", "0.9"))  # 近似命中的字符二元组相似度
+RAG_PREFETCH_WAIT_TIMEOUT = float(os.getenv("RAG_PREFETCH_WAIT_TIMEOUT", "2"))  # 发送时等待进行中预取的秒数
+# 每个会话的预取限速 (令牌桶：每秒补充数与桶容量)，超出时不做检索 (RAG_PREFETCH_RATE=0 不限速)
+RAG_PREFETCH_RATE = float(os.getenv("RAG_PREFETCH_RATE", "1"))
+RAG_PREFETCH_BURST = int(os.getenv("RAG_PREFETCH_BURST", "4"))
+
+# 回答中途识别到 [RAG_QUERY: ...] 时执行补充检索的后台线程数
+RAG_QUERY_WORKERS = int(os.getenv("RAG_QUERY_WORKERS", "4"))
+
+# 历史检索案例：按当前查询与以往查询向量的余弦相似度挑选
+RAG_HISTORY_MAX_QUERIES = int(os.getenv("RAG_HISTORY_MAX_QUERIES", "20"))  # 每个对话保存的检索次数
+RAG_HISTORY_MIN_SIMILARITY = float(os.getenv("RAG_HISTORY_MIN_SIMILARITY", "0.5"))  # 低于该相似度的以往查询不参考
@@ -0,0 +1,327 @@
+# -*- coding: utf-8 -*-
+"""
+文件名: db_maintenance.py
+功  能: conversations.db 的定期维护：过期对话归档与清理、增量 VACUUM、ANALYZE，并报告维护前后的库文件与页统计。
+描  述:
+1. 保留期：updated_at 早于 retention_days 天前的对话 (含其消息、Judge 数据) 先写入 gzip 压缩的 NDJSON 归档
+   (每行一个对话，含全部消息)，归档文件落盘 (fsync) 后再按批删除，每批一个事务，避免长时间占用写锁。
+   删除时再次检查 updated_at，归档后又有新消息的对话不会被删除。
+2. 增量 VACUUM：库为 auto_vacuum=INCREMENTAL 时，按批把空闲页归还给文件系统 (每批一个事务)；
+   旧库 (auto_vacuum=NONE) 可选执行一次完整 VACUUM 转换为增量模式 (会阻塞写入，仅需一次)。
+3. 合并全文索引 (messages_fts 存在时)、ANALYZE 更新查询规划统计、WAL checkpoint 截断 WAL 文件。
+4. 直接使用 sqlite3 连接，既可由 app.py 的后台调度线程执行，也可作为命令行工具单独运行：
+       python db_maintenance.py instance/conversations.db --retention-days 180 --archive-dir ./archive
+"""
+
+import argparse
+import gzip
+import json
+import os
+import sqlite3
+import threading
+import time
+from datetime import datetime, timedelta
+
+AUTO_VACUUM_MODES = {0: "none", 1: "full", 2: "incremental"}
+
+
+def connect(db_path, busy_timeout_ms=5000):
+    """维护用的连接：自动提交，事务由本模块显式控制"""
+    conn = sqlite3.connect(db_path, timeout=busy_timeout_ms / 1000, isolation_level=None)
+    conn.row_factory = sqlite3.Row
+    return conn
+
+
+def _pragma(conn, name):
+    return conn.execute(f"PRAGMA {name}").fetchone()[0]
+
+
+def _table_exists(conn, name):
+    return conn.execute("SELECT 1 FROM sqlite_master WHERE name = ?", (name,)).fetchone() is not None
+
+
+def database_stats(conn, db_path):
+    """库文件大小、页统计与各表行数"""
+    page_size = _pragma(conn, "page_size")
+    page_count = _pragma(conn, "page_count")
+    freelist_count = _pragma(conn, "freelist_count")
+    wal_path = db_path + "-wal"
+    stats = {
+        "file_bytes": os.path.getsize(db_path) if os.path.exists(db_path) else 0,
+        "wal_bytes": os.path.getsize(wal_path) if os.path.exists(wal_path) else 0,
+        "page_size": page_size,
+        "page_count": page_count,
+        "freelist_count": freelist_count,
+        "free_ratio": round(freelist_count / page_count, 4) if page_count else 0.0,
+        "auto_vacuum": AUTO_VACUUM_MODES.get(_pragma(conn, "auto_vacuum"), "unknown")
+    }
+    for table in ("conversations", "messages", "judge_payloads"):
+        if _table_exists(conn, table):
+            stats[f"{table}_rows"] = conn.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+    return stats
+
+
+def _loads(value, default):
+    try:
+        return json.loads(value) if value else default
+    except json.JSONDecodeError:
+        return default
+
+
+def _archive_records(conn, conversation_ids):
+    """一批对话的归档记录 (对话字段 + 按 seq 排序的消息，Judge 数据并入对应消息)"""
+    placeholders = ",".join("?" * len(conversation_ids))
+    has_payloads = _table_exists(conn, "judge_payloads")
+    messages = {}
+    rows = conn.execute(
+        "SELECT m.id, m.conversation_id, m.seq, m.role, m.content, m.extra, m.created_at"
+        + (", p.payload AS judge_payload FROM messages m LEFT JOIN judge_payloads p ON p.message_id = m.id"
+           if has_payloads else ", NULL AS judge_payload FROM messages m")
+        + f" WHERE m.conversation_id IN ({placeholders}) ORDER BY m.conversation_id, m.seq", conversation_ids)
+    for row in rows:
+        message = {"seq": row["seq"], "role": row["role"], "content": row["content"],
+                   "created_at": row["created_at"], **_loads(row["extra"], {})}
+        if row["judge_payload"]:
+            message["judge_payload"] = _loads(row["judge_payload"], {})
+        messages.setdefault(row["conversation_id"], []).append(message)
+
+    for conv in conn.execute(
+            "SELECT id, session_id, title, summary, rag_history, created_at, updated_at "
+            f"FROM conversations WHERE id IN ({placeholders})", conversation_ids):
+        yield {
+            "id": conv["id"],
+            "session_id": conv["session_id"],
+            "title": conv["title"],
+            "summary": conv["summary"],
+            "rag_history": _loads(conv["rag_history"], []),
+            "created_at": conv["created_at"],
+            "updated_at": conv["updated_at"],
+            "messages": messages.get(conv["id"], [])
+        }
+
+
+def write_archive(conn, conversation_ids, archive_dir, batch_size=200):
+    """
+    把对话写入 gzip NDJSON 归档 (先写临时文件，fsync 后改名)
+
+    返回:
+        tuple: (归档文件路径, 压缩后字节数)
+    """
+    os.makedirs(archive_dir, exist_ok=True)
+    path = os.path.join(archive_dir, f"conversations-{datetime.now().strftime('%Y%m%d-%H%M%S')}.ndjson.gz")
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as raw:
+        with gzip.GzipFile(fileobj=raw, mode="wb") as archive:
+            for start in range(0, len(conversation_ids), batch_size):
+                for record in _archive_records(conn, conversation_ids[start:start + batch_size]):
+                    archive.write((json.dumps(record, ensure_ascii=False) + "\n").encode("utf-8"))
+        raw.flush()
+        os.fsync(raw.fileno())
+    os.replace(tmp_path, path)
+    return path, os.path.getsize(path)
+
+
+def purge_conversations(conn, cutoff, archive_dir=None, batch_size=200):
+    """
+    归档并删除 updated_at 早于 cutoff 的对话
+
+    参数:
+        cutoff: datetime，更新时间早于该时间的对话被清理
+        archive_dir: 归档目录；为空时不归档直接删除
+    返回:
+        dict: 清理的对话数、消息数与归档文件
+    """
+    cutoff_text = cutoff.isoformat(sep=" ")
+    conversation_ids = [row[0] for row in conn.execute(
+        "SELECT id FROM conversations WHERE updated_at < ? ORDER BY updated_at", (cutoff_text,))]
+    result = {"cutoff": cutoff_text, "conversations": 0, "messages": 0, "archive_path": None, "archive_bytes": 0}
+    if not conversation_ids:
+        return result
+
+    if archive_dir:
+        result["archive_path"], result["archive_bytes"] = write_archive(conn, conversation_ids, archive_dir,
+                                                                        batch_size)
+
+    has_payloads = _table_exists(conn, "judge_payloads")
+    for start in range(0, len(conversation_ids), batch_size):
+        batch = conversation_ids[start:start + batch_size]
+        placeholders = ",".join("?" * len(batch))
+        # 只删除仍然过期的对话 (归档期间可能有新消息)
+        stale = f"SELECT id FROM conversations WHERE id IN ({placeholders}) AND updated_at < ?"
+        params = batch + [cutoff_text]
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            if has_payloads:
+                conn.execute(f"DELETE FROM judge_payloads WHERE conversation_id IN ({stale})", params)
+            result["messages"] += conn.execute(
+                f"DELETE FROM messages WHERE conversation_id IN ({stale})", params).rowcount
+            result["conversations"] += conn.execute(
+                f"DELETE FROM conversations WHERE id IN ({placeholders}) AND updated_at < ?", params).rowcount
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+    return result
+
+
+def incremental_vacuum(conn, max_pages=0, batch_pages=1000, convert=False):
+    """
+    把空闲页归还给文件系统
+
+    参数:
+        max_pages: 本次最多回收的页数 (0 表示全部)
+        batch_pages: 每个事务回收的页数
+        convert: 库不是增量模式时，是否执行一次完整 VACUUM 转换为 auto_vacuum=INCREMENTAL
+    返回:
+        dict: {"mode": 执行前的 auto_vacuum 模式, "action": "incremental"|"converted"|"skipped", "pages_freed": int}
+    """
+    mode = AUTO_VACUUM_MODES.get(_pragma(conn, "auto_vacuum"), "unknown")
+    result = {"mode": mode, "action": "skipped", "pages_freed": 0}
+    before = _pragma(conn, "freelist_count")
+    if mode != "incremental":
+        if convert:
+            conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+            conn.execute("VACUUM")
+            result.update(action="converted", pages_freed=before)
+        return result
+
+    # sqlite3 模块对不返回行的 PRAGMA 只执行一步 (回收一页)，因此逐页执行，每批一个事务
+    freed = 0
+    while max_pages <= 0 or freed < max_pages:
+        free = _pragma(conn, "freelist_count")
+        if not free:
+            break
+        step = min(free, batch_pages) if max_pages <= 0 else min(free, batch_pages, max_pages - freed)
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            for _ in range(step):
+                conn.execute("PRAGMA incremental_vacuum(1)")
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        freed += step
+    result.update(action="incremental", pages_freed=freed)
+    return result
+
+
+def run_maintenance(db_path, retention_days=0, archive_dir=None, vacuum_pages=0, convert_auto_vacuum=False,
+                    batch_size=200, busy_timeout_ms=5000):
+    """
+    执行一次完整维护，返回报告 (维护前后的统计与各步骤结果)
+
+    参数:
+        retention_days: 保留天数 (<=0 不清理对话)
+        archive_dir: 清理前的归档目录 (为空时不归档)
+        vacuum_pages: 每次增量 VACUUM 最多回收的页数 (0 表示全部)
+        convert_auto_vacuum: 旧库是否执行一次完整 VACUUM 转换为增量模式
+    """
+    started = time.perf_counter()
+    conn = connect(db_path, busy_timeout_ms)
+    try:
+        report = {"started_at": datetime.now().isoformat(), "before": database_stats(conn, db_path)}
+        if retention_days > 0:
+            cutoff = datetime.now() - timedelta(days=retention_days)
+            report["purge"] = purge_conversations(conn, cutoff, archive_dir, batch_size)
+        report["vacuum"] = incremental_vacuum(conn, vacuum_pages, convert=convert_auto_vacuum)
+        if _table_exists(conn, "messages_fts"):
+            conn.execute("INSERT INTO messages_fts(messages_fts) VALUES ('optimize')")
+        conn.execute("ANALYZE")
+        conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        report["after"] = database_stats(conn, db_path)
+    finally:
+        conn.close()
+    report["duration_ms"] = round((time.perf_counter() - started) * 1000, 1)
+    return report
+
+
+def format_report(report):
+    """报告的单行摘要 (用于日志)"""
+    before, after = report["before"], report["after"]
+    purge = report.get("purge") or {}
+    return (f"数据库维护完成 ({report['duration_ms']} ms): 清理对话 {purge.get('conversations', 0)} 个、"
+            f"消息 {purge.get('messages', 0)} 条; 回收空闲页 {report['vacuum']['pages_freed']} "
+            f"({report['vacuum']['action']}); 库文件 (含WAL) {(before['file_bytes'] + before['wal_bytes']) / 1e6:.2f} MB -> "
+            f"{(after['file_bytes'] + after['wal_bytes']) / 1e6:.2f} MB, 空闲页 {before['freelist_count']} -> "
+            f"{after['freelist_count']}")
+
+
+class MaintenanceScheduler:
+    """
+    定期执行维护任务的后台线程 (同一时间只执行一次)
+
+    参数:
+        task: 无参函数，返回维护报告
+        interval_hours: 执行间隔 (小时)
+        initial_delay: 启动后首次执行前等待的秒数
+    """
+
+    def __init__(self, task, interval_hours=24, initial_delay=300):
+        self.task = task
+        self.interval_seconds = interval_hours * 3600
+        self.initial_delay = initial_delay
+        self._run_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self._stats = {"runs": 0, "errors": 0, "last_run_at": None, "last_error": None, "last_report": None}
+
+    def start(self):
+        if self._thread is None and self.interval_seconds > 0:
+            self._thread = threading.Thread(target=self._loop, name="db-maintenance", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _loop(self):
+        delay = self.initial_delay
+        while not self._stop.wait(delay):
+            self.run_now()
+            delay = self.interval_seconds
+
+    def run_now(self):
+        """
+        立即执行一次维护
+
+        返回:
+            dict: 维护报告；已有维护正在执行时返回None
+        """
+        if not self._run_lock.acquire(blocking=False):
+            return None
+        try:
+            report = self.task()
+            self._stats.update(runs=self._stats["runs"] + 1, last_run_at=datetime.now().isoformat(),
+                               last_report=report, last_error=None)
+            print(format_report(report))
+            return report
+        except Exception as e:
+            self._stats.update(errors=self._stats["errors"] + 1, last_run_at=datetime.now().isoformat(),
+                               last_error=str(e))
+            print(f"数据库维护失败: {e}")
+            raise
+        finally:
+            self._run_lock.release()
+
+    def stats(self):
+        return {**self._stats, "running": self._run_lock.locked(), "scheduled": self._thread is not None,
+                "interval_hours": self.interval_seconds / 3600}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="conversations.db 维护：归档清理过期对话、增量VACUUM、ANALYZE")
+    parser.add_argument("db_path", help="SQLite 数据库文件 (Flask-SQLAlchemy 的相对路径位于 instance/ 下)")
+    parser.add_argument("--retention-days", type=int, default=0, help="保留天数 (0 不清理对话)")
+    parser.add_argument("--archive-dir", default="./archive", help="清理前的归档目录 (空字符串表示不归档)")
+    parser.add_argument("--vacuum-pages", type=int, default=0, help="最多回收的空闲页数 (0 表示全部)")
+    parser.add_argument("--convert-auto-vacuum", action="store_true",
+                        help="旧库执行一次完整 VACUUM 转换为增量模式 (期间阻塞写入)")
+    args = parser.parse_args()
+
+    report = run_maintenance(args.db_path, args.retention_days, args.archive_dir or None, args.vacuum_pages,
+                             args.convert_auto_vacuum)
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+    print(format_report(report))
+
+
+if __name__ == "__main__":
+    main()
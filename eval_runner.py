@@ -0,0 +1,329 @@
+# -*- coding: utf-8 -*-
+"""
+文件名: eval_runner.py
+功  能: 批量离线评测：把 JSONL 问题集逐条送过完整流程 (RAG检索 + /predict)，结果流式写入 JSONL。
+描  述:
+1. 输入每行一个 JSON 对象：
+       {"id": "q1", "question": "醉驾撞人会判多久", "history": [...], "model": "deepseek", "professional": false, "rag": true}
+   只有 question 必填；id 缺省时用行号，model / professional / rag 缺省时用命令行参数。
+2. 每条依次执行：查询编码 → Milvus 检索 → 后端请求 (http 经 /predict，inprocess 直接调用 llm.py)；
+   记录 encode / search / TTFT (首个文本块) / 总耗时，提示词token数 (后端 model_info) 与回答token数。
+3. 按 --concurrency 并发、按 --rate 限制每秒发起的请求数；输入逐行读取，同时在途的条目不超过并发数的两倍，
+   不会把整个数据集读入内存。
+4. 每条完成后立即追加一行到输出文件并 flush；再次运行时跳过输出中已成功的ID (断点续跑)，
+   失败的条目会重新执行，同一ID以最后一行为准。
+5. 每条请求带独立的 conversation_id：后端 /predict 按会话限流 (ADMISSION_SESSION_RATE/BURST)，
+   不带时所有条目共用评测机IP的一个令牌桶，超出后被 429 拒绝。整体并发仍受后端
+   ADMISSION_MAX_CONCURRENT/ADMISSION_MAX_QUEUE 限制，--concurrency 不应超过两者之和。
+6. Ctrl-C 时停止发起新条目并取消进行中的流式请求，已完成的结果写入后退出；
+   Judge 请求无法中途取消，等待 --interrupt-grace 秒后放弃，未完成的条目下次运行时重新执行。
+
+用法:
+    python eval_runner.py questions.jsonl results.jsonl --concurrency 4 --rate 2
+    python eval_runner.py questions.jsonl results.jsonl --transport inprocess --no-rag
+"""
+
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+import uuid
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import config
+from admission import TokenBucket
+from cancellation import CancelToken
+from prompt_budget import TokenCounter
+from transport import create_transport
+
+
+def read_items(path):
+    """逐行产出 (item_id, item)；跳过空行，无法解析的行产出错误条目"""
+    with open(path, 'r', encoding='utf-8') as f:
+        for line_no, line in enumerate(f, 1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                item = json.loads(line)
+            except json.JSONDecodeError as e:
+                yield f"line:{line_no}", {"_error": f"无法解析的JSON: {e}"}
+                continue
+            yield str(item.get("id") or f"line:{line_no}"), item
+
+
+def load_completed_ids(path):
+    """读取已有输出中成功完成的ID (只保留ID集合)"""
+    completed = set()
+    if not os.path.exists(path):
+        return completed
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue  # 上次中断时写了一半的行
+            if record.get("status") == "ok":
+                completed.add(record.get("id"))
+            else:
+                completed.discard(record.get("id"))
+    return completed
+
+
+class ResultWriter:
+    """线程安全的结果追加写入，每行写完立即 flush"""
+
+    def __init__(self, path):
+        # 上次中断可能留下没有换行结尾的半行，先补换行
+        needs_newline = False
+        if os.path.exists(path) and os.path.getsize(path) > 0:
+            with open(path, 'rb') as f:
+                f.seek(-1, os.SEEK_END)
+                needs_newline = f.read(1) != b'\n'
+        self._file = open(path, 'a', encoding='utf-8')
+        if needs_newline:
+            self._file.write('\n')
+        self._lock = threading.Lock()
+
+    def write(self, record):
+        line = json.dumps(record, ensure_ascii=False)
+        with self._lock:
+            self._file.write(line + '\n')
+            self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
+class EvalRunner:
+    """单条评测的执行逻辑 (各工作线程共用)"""
+
+    def __init__(self, backend, retriever, args):
+        self.backend = backend
+        self.retriever = retriever
+        self.args = args
+        self.counter = TokenCounter(config.PROMPT_TOKEN_ENCODING)
+        self.stopped = threading.Event()
+        self._tokens = set()  # 进行中的流式请求
+        self._lock = threading.Lock()
+
+    def interrupt(self):
+        """停止发起新请求，并取消进行中的流 (关闭与后端的连接/上游流)"""
+        self.stopped.set()
+        with self._lock:
+            tokens = list(self._tokens)
+        for token in tokens:
+            token.cancel("interrupt")
+
+    def retrieve(self, question, timings):
+        start = time.perf_counter()
+        query_vec = self.retriever.encode_query(question)
+        timings["encode_ms"] = round((time.perf_counter() - start) * 1000, 1)
+
+        start = time.perf_counter()
+        results = self.retriever.search_similar_cases(question, k=self.args.k, min_score=self.args.min_score,
+                                                      query_vec=query_vec)
+        timings["search_ms"] = round((time.perf_counter() - start) * 1000, 1)
+        return results
+
+    def run_item(self, item_id, item):
+        """执行一条评测，返回结果记录；中断后返回None (不写入，下次运行时重新执行)"""
+        if self.stopped.is_set():
+            return None
+        record = {"id": item_id, "question": item.get("question")}
+        if "_error" in item or not item.get("question"):
+            record.update({"status": "error", "error": item.get("_error", "缺少 question 字段")})
+            return record
+
+        model_id = item.get("model") or self.args.model
+        use_rag = item.get("rag", not self.args.no_rag) and self.retriever is not None
+        timings = {"encode_ms": None, "search_ms": None, "ttft_ms": None, "total_ms": None}
+        record.update({"model_id": model_id, "professional": bool(item.get("professional", self.args.professional))})
+        start = time.perf_counter()
+        try:
+            results = self.retrieve(item["question"], timings) if use_rag else []
+            record["case_ids"] = [r["case_id"] for r in results]
+            payload = {
+                "user_question": item["question"],
+                "rag_data": [r["formatted_case"] for r in results],
+                "historical_rag_data": [],
+                "chat_history": item.get("history", []),
+                "conversation_summary": item.get("summary", ""),
+                "model_id": model_id,
+                "is_professional_mode": record["professional"],
+                "cache_control": self.args.cache_control,
+                "request_id": str(uuid.uuid4()),
+                # 每条独立的会话标识：后端按会话限流，各条目不共用一个令牌桶
+                "conversation_id": f"eval-{uuid.uuid4().hex}"
+            }
+            request_start = time.perf_counter()
+            if model_id == "judge":
+                result = self.backend.judge(payload)
+                answer = result.get("prediction", "")
+                record.update({"model_used": result.get("model_used"), "prompt_tokens": result.get("prompt_tokens")})
+            else:
+                answer = self.stream_answer(payload, record, timings, request_start)
+            timings["total_ms"] = round((time.perf_counter() - start) * 1000, 1)
+            record.update({"status": "ok", "answer": answer, "completion_tokens": self.counter.count(answer)})
+        except Exception as e:
+            if self.stopped.is_set():
+                return None
+            timings["total_ms"] = round((time.perf_counter() - start) * 1000, 1)
+            record.update({"status": "error", "error": str(e)})
+        record.update(timings)
+        return record
+
+    def stream_answer(self, payload, record, timings, request_start):
+        """读取后端事件流，返回完整回答；TTFT 从发出后端请求算起"""
+        parts = []
+        token = CancelToken(payload["request_id"], payload["conversation_id"])
+        with self._lock:
+            self._tokens.add(token)
+        if self.stopped.is_set():
+            token.cancel("interrupt")
+        source = None
+        try:
+            source = self.backend.stream(payload, cancel_token=token)
+            for event in source:
+                if token.cancelled:
+                    break
+                if self._handle_event(event, parts, record, timings, request_start):
+                    break
+        finally:
+            if hasattr(source, "close"):
+                source.close()
+            with self._lock:
+                self._tokens.discard(token)
+        if token.cancelled:
+            # 取消后传输层不再抛出读取错误，不能把不完整的回答记为成功
+            raise RuntimeError("评测已中断")
+        return "".join(parts)
+
+    @staticmethod
+    def _handle_event(event, parts, record, timings, request_start):
+        """处理一个后端事件，流结束时返回True"""
+        name = event.get("event")
+        if name == "model_info":
+            record["model_used"] = event.get("model_used")
+            record["prompt_tokens"] = event.get("prompt_tokens")
+        elif name == "chunk":
+            if timings["ttft_ms"] is None:
+                timings["ttft_ms"] = round((time.perf_counter() - request_start) * 1000, 1)
+            parts.append(event.get("chunk", ""))
+        elif name == "error":
+            raise RuntimeError(event.get("error", "未知流错误"))
+        return name == "end_of_stream"
+
+
+def percentile(values, p):
+    values = sorted(v for v in values if v is not None)
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def create_retriever(args):
+    if args.no_rag:
+        return None
+    from retriever import LegalCaseRetriever
+    return LegalCaseRetriever(db_uri=args.milvus_db, model_path=args.embedding_model, collection_name='legal_cases')
+
+
+def main():
+    parser = argparse.ArgumentParser(description="批量离线评测 (JSONL 问题集)")
+    parser.add_argument("input", help="输入 JSONL 问题集")
+    parser.add_argument("output", help="输出 JSONL (追加写入，可断点续跑)")
+    parser.add_argument("--transport", default=config.BACKEND_TRANSPORT, choices=["http", "inprocess"],
+                        help="http: 经 API_URL 调用 /predict；inprocess: 同进程调用 llm.py")
+    parser.add_argument("--api-url", default=config.API_URL)
+    parser.add_argument("--model", default="deepseek", help="条目未指定 model 时使用的模型ID")
+    parser.add_argument("--professional", action="store_true", help="条目未指定 professional 时使用专业模式")
+    parser.add_argument("--no-rag", action="store_true", help="不做RAG检索")
+    parser.add_argument("--k", type=int, default=2, help="每条检索的案例数")
+    parser.add_argument("--min-score", type=float, default=0.4, help="检索相似度下限")
+    parser.add_argument("--concurrency", type=int, default=4, help="并发执行的条目数")
+    parser.add_argument("--rate", type=float, default=0, help="每秒最多发起的条目数 (0 不限)")
+    parser.add_argument("--cache-control", default="no-store", help="传给后端的 cache_control (默认不读写回答缓存)")
+    parser.add_argument("--no-resume", action="store_true", help="不跳过输出中已完成的条目")
+    parser.add_argument("--interrupt-grace", type=float, default=5.0,
+                        help="Ctrl-C 后等待进行中条目结束的秒数 (超时仍未结束的 Judge 请求直接放弃)")
+    parser.add_argument("--milvus-db", default='./AutoSurvey-main/database/legal_assistant.db')
+    parser.add_argument("--embedding-model", default='./AutoSurvey-main/model/bge-large-zh-v1.5')
+    args = parser.parse_args()
+
+    completed = set() if args.no_resume else load_completed_ids(args.output)
+    if completed:
+        print(f"断点续跑：跳过已完成的 {len(completed)} 条")
+
+    runner = EvalRunner(create_transport(args.transport, args.api_url), create_retriever(args), args)
+    writer = ResultWriter(args.output)
+    bucket = TokenBucket(args.rate, max(1, int(args.rate))) if args.rate > 0 else None
+    summary = {"ok": 0, "error": 0, "skipped": 0}
+    ttfts, totals = [], []
+    started = time.time()
+
+    def collect(future):
+        record = None if future.cancelled() else future.result()
+        if record is None:
+            return  # 中断时未执行或未完成的条目
+        writer.write(record)
+        summary[record["status"]] += 1
+        ttfts.append(record.get("ttft_ms"))
+        totals.append(record.get("total_ms"))
+        done = summary["ok"] + summary["error"]
+        print(f"[{done}] {record['id']}: {record['status']} "
+              f"ttft={record.get('ttft_ms')} ms total={record.get('total_ms')} ms"
+              + (f" error={record['error']}" if record["status"] == "error" else ""))
+
+    in_flight = set()
+    executor = ThreadPoolExecutor(max_workers=args.concurrency)
+    try:
+        for item_id, item in read_items(args.input):
+            if item_id in completed:
+                summary["skipped"] += 1
+                continue
+            # 在途条目不超过并发数的两倍，输入按需读取
+            while len(in_flight) >= args.concurrency * 2:
+                finished, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    collect(future)
+            if bucket is not None:
+                while True:
+                    delay = bucket.take()
+                    if delay <= 0:
+                        break
+                    time.sleep(delay)
+            in_flight.add(executor.submit(runner.run_item, item_id, item))
+
+        for future in wait(in_flight).done:
+            collect(future)
+    except KeyboardInterrupt:
+        runner.interrupt()
+        for future in in_flight:
+            future.cancel()
+        # 流式请求已取消，很快返回；宽限期内完成的条目照常写入
+        finished, pending = wait(in_flight, timeout=args.interrupt_grace)
+        for future in finished:
+            collect(future)
+        executor.shutdown(wait=False)
+        writer.close()
+        print("\n已中断，已完成的结果均已写入，可再次运行以继续")
+        if pending:
+            # 仍在等待 Judge 结果的工作线程不是守护线程，正常退出时解释器会一直等待它们
+            print(f"放弃 {len(pending)} 个仍在进行的条目")
+            os._exit(130)
+        sys.exit(130)
+    finally:
+        executor.shutdown(wait=False)
+        writer.close()
+
+    elapsed = time.time() - started
+    print(f"\n完成: 成功 {summary['ok']}, 失败 {summary['error']}, 跳过 {summary['skipped']}, 用时 {elapsed:.1f} s")
+    print(f"TTFT P50/P90: {percentile(ttfts, 0.5)} / {percentile(ttfts, 0.9)} ms, "
+          f"总耗时 P50/P90: {percentile(totals, 0.5)} / {percentile(totals, 0.9)} ms")
+
+
+if __name__ == "__main__":
+    main()
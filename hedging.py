@@ -0,0 +1,279 @@
+# -*- coding: utf-8 -*-
+"""
+文件名: hedging.py
+功  能: 单模型流式请求的对冲 (hedged request) 与自动切换备用模型。
+描  述:
+1. 先向主模型发起流式请求；若在截止时间内没有收到第一个文本增量 (首字时间 TTFT 过慢)，
+   再向备用模型发起同样的请求，两路竞速。
+2. 主模型在截止时间前直接报错时，立即改用备用模型 (failover)。
+3. 哪一路先产出第一个文本增量就采用哪一路，另一路立即关闭 (不再消耗token)。
+4. 同步版本用工作线程读取首个增量，异步版本用协程任务；获胜后由调用方继续迭代同一个上游流。
+"""
+
+import asyncio
+import queue
+import threading
+import time
+
+
+class HedgeCancelled(Exception):
+    """竞速期间请求被取消"""
+
+
+class HedgeStats:
+    """对冲统计：触发次数、各路获胜次数"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stats = {"requests": 0, "hedged": 0, "failovers": 0, "primary_wins": 0, "fallback_wins": 0,
+                       "failed": 0}
+
+    def record(self, name):
+        with self._lock:
+            self._stats[name] += 1
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats)
+
+
+class UpstreamAttempt:
+    """一路上游请求 (同步)：在工作线程中建立流并读到第一个文本增量为止"""
+
+    def __init__(self, model_name):
+        self.model_name = model_name
+        self.started_at = time.monotonic()
+        self.stream = None
+        self.iterator = None
+        self.buffered = []  # 读取首个增量过程中收到的全部chunk (含首个增量)
+        self.error = None
+        self._closed = False
+        self._lock = threading.Lock()
+
+    def run(self, create_stream, has_content, done):
+        try:
+            stream = create_stream(self.model_name)
+            with self._lock:
+                if self._closed:
+                    stream.close()
+                    self.error = HedgeCancelled("请求已关闭")
+                    return
+                self.stream = stream
+            iterator = iter(stream)
+            for chunk in iterator:
+                self.buffered.append(chunk)
+                if has_content(chunk):
+                    break
+            self.iterator = iterator
+        except Exception as e:
+            self.error = e
+        finally:
+            done.put(self)
+
+    def chunks(self):
+        """获胜后依次产出已缓冲的chunk与剩余的上游chunk"""
+        yield from self.buffered
+        if self.iterator is not None:
+            yield from self.iterator
+
+    def close(self):
+        with self._lock:
+            self._closed = True
+            stream = self.stream
+        if stream is not None:
+            stream.close()
+
+
+def race_first_token(create_stream, has_content, primary, fallback, deadline, cancel_token=None, stats=None):
+    """
+    主模型/备用模型竞速首个文本增量 (同步)
+
+    参数:
+        create_stream: 函数 (model_name) -> 上游流
+        has_content: 函数 (chunk) -> chunk 是否包含文本增量
+        primary / fallback: 主模型与备用模型名 (fallback 为空时不对冲)
+        deadline: 等待主模型首个增量的秒数，超时后发起备用请求
+        cancel_token: 可选的 CancelToken，取消时关闭所有进行中的请求
+
+    返回:
+        UpstreamAttempt: 获胜的一路 (其余各路已关闭)
+    """
+    done = queue.Queue()
+    attempts = []
+    start = time.monotonic()
+
+    def launch(model_name):
+        attempt = UpstreamAttempt(model_name)
+        attempts.append(attempt)
+        threading.Thread(target=attempt.run, args=(create_stream, has_content, done), daemon=True).start()
+
+    if cancel_token is not None:
+        cancel_token.add_callback(lambda: done.put(None))
+    if stats is not None:
+        stats.record("requests")
+
+    launch(primary)
+    hedged = not fallback
+    pending = 1
+    failed = []
+    while pending:
+        timeout = None if hedged else max(0.0, deadline - (time.monotonic() - start))
+        try:
+            attempt = done.get(timeout=timeout)
+        except queue.Empty:
+            # 主模型首字过慢：发起对冲请求
+            hedged = True
+            pending += 1
+            launch(fallback)
+            if stats is not None:
+                stats.record("hedged")
+            continue
+
+        if attempt is None:
+            for other in attempts:
+                other.close()
+            raise HedgeCancelled("请求已取消")
+
+        pending -= 1
+        if attempt.error is None:
+            for other in attempts:
+                if other is not attempt:
+                    other.close()
+            if stats is not None:
+                stats.record("primary_wins" if attempt.model_name == primary else "fallback_wins")
+            return attempt
+
+        failed.append(attempt)
+        if not hedged:
+            # 主模型直接报错：立即切换备用模型
+            hedged = True
+            pending += 1
+            launch(fallback)
+            if stats is not None:
+                stats.record("failovers")
+
+    if stats is not None:
+        stats.record("failed")
+    raise failed[0].error
+
+
+class AsyncUpstreamAttempt:
+    """一路上游请求 (异步)"""
+
+    def __init__(self, model_name):
+        self.model_name = model_name
+        self.started_at = time.monotonic()
+        self.stream = None
+        self.iterator = None
+        self.buffered = []
+
+    async def run(self, create_stream, has_content):
+        try:
+            self.stream = await create_stream(self.model_name)
+            self.iterator = self.stream.__aiter__()
+            while True:
+                try:
+                    chunk = await self.iterator.__anext__()
+                except StopAsyncIteration:
+                    self.iterator = None
+                    break
+                self.buffered.append(chunk)
+                if has_content(chunk):
+                    break
+        except asyncio.CancelledError:
+            await self.close()
+            raise
+        return self
+
+    async def chunks(self):
+        for chunk in self.buffered:
+            yield chunk
+        if self.iterator is not None:
+            async for chunk in self.iterator:
+                yield chunk
+
+    async def close(self):
+        if self.stream is None:
+            return
+        close = getattr(self.stream, "close", None) or getattr(self.stream, "aclose", None)
+        if close is not None:
+            await close()
+
+
+async def race_first_token_async(create_stream, has_content, primary, fallback, deadline,
+                                 cancel_token=None, stats=None):
+    """race_first_token 的异步版本 (create_stream 为协程函数)"""
+    loop = asyncio.get_running_loop()
+    cancelled = asyncio.Event()
+    if cancel_token is not None:
+        # 取消可能来自其他线程，需切回事件循环
+        cancel_token.add_callback(lambda: loop.call_soon_threadsafe(cancelled.set))
+    cancel_waiter = asyncio.ensure_future(cancelled.wait())
+    if stats is not None:
+        stats.record("requests")
+
+    attempts = {}
+
+    def launch(model_name):
+        attempt = AsyncUpstreamAttempt(model_name)
+        attempts[asyncio.ensure_future(attempt.run(create_stream, has_content))] = attempt
+
+    async def close_all(except_attempt=None):
+        cancelling = []
+        for task, attempt in attempts.items():
+            if attempt is except_attempt:
+                continue
+            if not task.done():
+                # 任务被取消时会自行关闭已建立的上游流
+                task.cancel()
+                cancelling.append(task)
+                continue
+            if not task.cancelled():
+                task.exception()  # 取出异常，避免 "exception was never retrieved" 警告
+            await attempt.close()
+        if cancelling:
+            await asyncio.gather(*cancelling, return_exceptions=True)
+
+    launch(primary)
+    hedged = not fallback
+    start = loop.time()
+    first_error = None
+    winner = None
+    try:
+        while True:
+            pending = {task for task in attempts if not task.done()}
+            if not pending:
+                break
+            timeout = None if hedged else max(0.0, deadline - (loop.time() - start))
+            done, _ = await asyncio.wait(pending | {cancel_waiter}, timeout=timeout,
+                                         return_when=asyncio.FIRST_COMPLETED)
+            if cancel_waiter in done:
+                raise HedgeCancelled("请求已取消")
+            if not done:
+                hedged = True
+                launch(fallback)
+                if stats is not None:
+                    stats.record("hedged")
+                continue
+
+            for task in done:
+                if task.exception() is None:
+                    winner = attempts[task]
+                    if stats is not None:
+                        stats.record("primary_wins" if winner.model_name == primary else "fallback_wins")
+                    return winner
+                first_error = first_error or task.exception()
+
+            if not hedged:
+                hedged = True
+                launch(fallback)
+                if stats is not None:
+                    stats.record("failovers")
+    finally:
+        cancel_waiter.cancel()
+        # 只保留获胜的一路；取消、出错或调用方被取消时关闭全部请求
+        await close_all(except_attempt=winner)
+
+    if stats is not None:
+        stats.record("failed")
+    raise first_error
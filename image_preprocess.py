@@ -0,0 +1,265 @@
+# -*- coding: utf-8 -*-
+"""
+文件名: image_preprocess.py
+功  能: 图片OCR前的本地预处理 (供 multimodal_handler.py 的 ocr_image_yunwu 使用)，缩小发给视觉模型的请求体。
+描  述:
+1. 按文件头识别真实格式 (JPEG/PNG/WebP/GIF)，data URL 使用对应的 MIME 类型 (原先一律标为 image/jpeg)。
+2. 按 EXIF 方向信息旋转为正向，长边缩小到 max_long_edge (视觉模型会自行缩放到约2048像素，更大的图只增加传输)，
+   转为 RGB/灰度后按 jpeg_quality 重新编码为 JPEG (原图为PNG时同时尝试PNG，取较小者)；
+   不需要旋转时若重新编码后反而更大 (文字截图缩小后常见)，则发送原文件，由模型自行缩放。
+3. 高宽比超过 tile_aspect 的长图 (长截图、多页拼接的扫描件) 按宽度缩放后切成若干块分别识别，
+   切分位置选在边界附近最亮的一行 (文字行之间的空白)，避免把一行文字切成两半。
+4. 依赖 Pillow；未安装时不做处理，只纠正 MIME 类型。PreprocessStats 统计节省的字节数与OCR端到端耗时。
+"""
+
+import io
+import math
+import threading
+import time
+
+IMAGE_SIGNATURES = (
+    (b"\xff\xd8\xff", "jpeg"),
+    (b"\x89PNG\r\n\x1a\n", "png"),
+    (b"GIF87a", "gif"),
+    (b"GIF89a", "gif"),
+)
+IMAGE_MIME = {"jpeg": "image/jpeg", "png": "image/png", "webp": "image/webp", "gif": "image/gif"}
+
+_pil_checked = False
+_pil_available = False
+_pil_lock = threading.Lock()
+
+
+def pillow_available():
+    """Pillow 是否可用 (首次调用时检查，未安装时提示一次)"""
+    global _pil_checked, _pil_available
+    with _pil_lock:
+        if not _pil_checked:
+            try:
+                import PIL  # noqa: F401
+                _pil_available = True
+            except ImportError:
+                print("警告: 未安装 Pillow (pip install Pillow)，图片将不经缩放直接发送给OCR模型")
+            _pil_checked = True
+    return _pil_available
+
+
+def detect_image_format(data):
+    """按文件头判断图片格式，无法识别时返回None"""
+    for signature, name in IMAGE_SIGNATURES:
+        if data.startswith(signature):
+            return name
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return "webp"
+    return None
+
+
+class PreparedImage:
+    """预处理结果：parts 为按顺序识别的 [(mime, bytes)]，多于一块时为长图切块"""
+
+    def __init__(self, parts, original_bytes, source_format, size, resized=False, rotated=False, elapsed_ms=0.0):
+        self.parts = parts
+        self.original_bytes = original_bytes
+        self.source_format = source_format
+        self.size = size  # 处理后的整图尺寸 (宽, 高)；未处理时为None
+        self.resized = resized
+        self.rotated = rotated
+        self.elapsed_ms = elapsed_ms
+
+    @property
+    def output_bytes(self):
+        return sum(len(data) for _, data in self.parts)
+
+    @property
+    def tiles(self):
+        return len(self.parts)
+
+
+def raw_image(data, elapsed_ms=0.0):
+    """不做处理的结果：原文件，MIME 类型按文件头判断"""
+    source_format = detect_image_format(data)
+    return PreparedImage([(IMAGE_MIME.get(source_format, "image/jpeg"), data)], len(data), source_format, None,
+                         elapsed_ms=elapsed_ms)
+
+
+def _to_rgb(image):
+    """透明背景合成到白底；灰度图保持单通道 (JPEG 体积更小)"""
+    from PIL import Image
+
+    if image.mode in ("RGB", "L"):
+        return image
+    if image.mode in ("RGBA", "LA", "P", "PA"):
+        image = image.convert("RGBA")
+        background = Image.new("RGB", image.size, (255, 255, 255))
+        background.paste(image, mask=image.getchannel("A"))
+        return background
+    return image.convert("RGB")
+
+
+def _orientation(image):
+    """EXIF 方向标记 (274)；无EXIF时返回None"""
+    try:
+        return image.getexif().get(274)
+    except Exception:
+        return None
+
+
+def _encode(image, quality, try_png):
+    """
+    重新编码，返回 (mime, bytes)：默认 JPEG；
+    原图为 PNG (多为文字截图，大片纯色) 时同时尝试 PNG，取较小者
+    """
+    buffer = io.BytesIO()
+    image.save(buffer, format="JPEG", quality=quality, optimize=True)
+    best = ("image/jpeg", buffer.getvalue())
+    if try_png:
+        buffer = io.BytesIO()
+        image.save(buffer, format="PNG")
+        if buffer.tell() < len(best[1]):
+            best = ("image/png", buffer.getvalue())
+    return best
+
+
+def _cut_band(tile_height):
+    """切点在目标边界之前的搜索范围 (行数)"""
+    return max(1, tile_height // 8)
+
+
+def _cut_rows(image, tile_height):
+    """
+    长图的切分位置 (像素行)：每块不超过 tile_height，
+    切点取目标边界之前 1/8 块高范围内平均亮度最高的一行
+    """
+    from PIL import Image
+
+    width, height = image.size
+    # 每行的平均亮度：缩成1像素宽的灰度图
+    brightness = list(image.convert("L").resize((1, height), Image.BOX).getdata())
+    band = _cut_band(tile_height)
+    cuts = [0]
+    while height - cuts[-1] > tile_height:
+        target = cuts[-1] + tile_height
+        window = range(target - band, target)
+        cuts.append(max(window, key=lambda row: (brightness[row], row)))
+    cuts.append(height)
+    return cuts
+
+
+def _plan(width, height, max_long_edge, tile_aspect, max_tiles):
+    """返回 (是否切块, 缩放比例)"""
+    tall = height > max_long_edge and height / width > tile_aspect
+    if tall:
+        # 长图：宽度不超过 max_long_edge，块数不超过 max_tiles
+        # (每个切点最多提前 band 行，每块至少 max_long_edge - band 行)
+        rows_per_tile = max_long_edge - _cut_band(max_long_edge)
+        return True, min(1.0, max_long_edge / width, max_tiles * rows_per_tile / height)
+    return False, min(1.0, max_long_edge / max(width, height))
+
+
+def prepare_image(data, max_long_edge=2048, jpeg_quality=85, tile_aspect=2.5, max_tiles=6,
+                  passthrough_bytes=512 * 1024):
+    """
+    预处理待OCR的图片
+
+    参数:
+        data: 图片文件内容
+        max_long_edge: 普通图片缩放后的最大长边；长图为每块的最大高度 (宽度同样不超过该值)
+        jpeg_quality: 重新编码的 JPEG 质量
+        tile_aspect: 高宽比超过该值且高度超过 max_long_edge 时切块
+        max_tiles: 最多切成的块数 (块数超出时整图进一步缩小)
+        passthrough_bytes: 不超过该大小、无需旋转和切块的图片直接发送原文件 (不解码)
+    返回:
+        PreparedImage
+    """
+    start = time.perf_counter()
+    if not pillow_available():
+        return raw_image(data, elapsed_ms=(time.perf_counter() - start) * 1000)
+    source_format = detect_image_format(data)
+
+    from PIL import Image, ImageOps
+
+    # Image.open 只读取文件头；GIF 等多帧图片只取第一帧
+    with Image.open(io.BytesIO(data)) as opened:
+        orientation = _orientation(opened)
+        rotated = orientation not in (None, 1)
+        width, height = opened.size
+        if orientation in (5, 6, 7, 8):  # 旋转90度：显示时宽高互换
+            width, height = height, width
+        tall, scale = _plan(width, height, max_long_edge, tile_aspect, max_tiles)
+        if not rotated and not tall and source_format in IMAGE_MIME and len(data) <= passthrough_bytes:
+            return raw_image(data, elapsed_ms=(time.perf_counter() - start) * 1000)
+        if scale < 1.0 and source_format == "jpeg":
+            # JPEG 解码时直接按 1/2、1/4、1/8 缩小 (不小于目标尺寸)，省去大部分解码与缩放时间
+            opened.draft("RGB", (math.ceil(opened.size[0] * scale), math.ceil(opened.size[1] * scale)))
+        image = _to_rgb(ImageOps.exif_transpose(opened))
+
+    resized = scale < 1.0
+    target = (max(1, round(width * scale)), max(1, round(height * scale)))
+    if image.size != target:
+        image = image.resize(target, Image.LANCZOS)
+
+    try_png = source_format == "png"
+    size = image.size
+    if tall and image.size[1] > max_long_edge:
+        cuts = _cut_rows(image, max_long_edge)
+        parts = [_encode(image.crop((0, top, image.size[0], bottom)), jpeg_quality, try_png)
+                 for top, bottom in zip(cuts, cuts[1:])]
+    else:
+        encoded = _encode(image, jpeg_quality, try_png)
+        if not rotated and source_format in IMAGE_MIME and len(encoded[1]) >= len(data):
+            # 重新编码后反而更大 (如缩小后出现灰阶过渡的文字截图)：发送原文件，由模型自行缩放
+            parts = [(IMAGE_MIME[source_format], data)]
+            size, resized = (width, height), False
+        else:
+            parts = [encoded]
+    return PreparedImage(parts, len(data), source_format, size, resized=resized, rotated=rotated,
+                         elapsed_ms=(time.perf_counter() - start) * 1000)
+
+
+class PreprocessStats:
+    """图片预处理与OCR的累计统计 (线程安全)"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stats = {
+            "images": 0,
+            "resized": 0,
+            "rotated": 0,
+            "tiled": 0,
+            "tiles": 0,
+            "failures": 0,
+            "original_bytes": 0,
+            "sent_bytes": 0,
+            "preprocess_ms_total": 0.0,
+            "ocr_ms_total": 0.0
+        }
+
+    def record(self, prepared, ocr_ms, failed=False):
+        with self._lock:
+            stats = self._stats
+            stats["images"] += 1
+            stats["resized"] += int(prepared.resized)
+            stats["rotated"] += int(prepared.rotated)
+            stats["tiled"] += int(prepared.tiles > 1)
+            stats["tiles"] += prepared.tiles
+            stats["failures"] += int(failed)
+            stats["original_bytes"] += prepared.original_bytes
+            stats["sent_bytes"] += prepared.output_bytes
+            stats["preprocess_ms_total"] += prepared.elapsed_ms
+            stats["ocr_ms_total"] += ocr_ms
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+        images = stats["images"]
+        preprocess_total = stats.pop("preprocess_ms_total")
+        ocr_total = stats.pop("ocr_ms_total")
+        stats.update({
+            "pillow": pillow_available(),
+            "bytes_saved": stats["original_bytes"] - stats["sent_bytes"],
+            "saved_ratio": round(1 - stats["sent_bytes"] / stats["original_bytes"], 4)
+            if stats["original_bytes"] else 0.0,
+            "avg_preprocess_ms": round(preprocess_total / images, 1) if images else 0.0,
+            "avg_ocr_ms": round(ocr_total / images, 1) if images else 0.0
+        })
+        return stats
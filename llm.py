@@ -8,11 +8,21 @@
 3. (新增) 支持 "is_professional_mode" 参数，用于切换不同的系统提示词。
 """
 
+import asyncio
 import openai
 from flask import Flask, request, jsonify, Response, stream_with_context
 import threading
 import json
+import time
+import uuid
 import config
+from admission import AdmissionController, AdmissionRejected
+from cancellation import CancellationRegistry
+from hedging import HedgeStats, race_first_token, race_first_token_async
+from model_router import ModelRouter, ModelStatsTracker
+from prompt_budget import PromptBudget, TokenCounter
+from response_cache import ResponseCache, make_cache_key, parse_cache_control, replay_events
+from stream_coalescer import coalesce_events
 
 # --- 1. 全局配置 ---
 YUNWU_API_KEY = config.YUNWU_API_KEY
@@ -21,6 +31,48 @@ YUNWU_BASE_URL = config.YUNWU_BASE_URL
 app = Flask(__name__)
 app.config['JSON_AS_ASCII'] = False
 
+# 单模型回答缓存（temperature=0.1，相同输入的回答可直接复用）
+response_cache = None
+if config.RESPONSE_CACHE_ENABLED:
+    response_cache = ResponseCache(
+        config.RESPONSE_CACHE_PATH,
+        max_memory_bytes=config.RESPONSE_CACHE_MAX_MEMORY_BYTES,
+        ttl_seconds=config.RESPONSE_CACHE_TTL,
+        max_disk_entries=config.RESPONSE_CACHE_MAX_DISK_ENTRIES
+    )
+
+# 提示词token计数 (首次使用时加载 tiktoken 编码)
+token_counter = TokenCounter(config.PROMPT_TOKEN_ENCODING)
+
+# 进行中的流式请求 (供 /cancel 关闭上游流)
+cancellation_registry = CancellationRegistry()
+
+# 首字过慢时的对冲请求统计
+hedge_stats = HedgeStats()
+
+# /predict 的准入控制：并发上限 + 有界等待队列 + 按对话限流 (降级由 app.py 决定)
+admission = None
+if config.ADMISSION_ENABLED:
+    admission = AdmissionController(
+        config.LLM_ADMISSION_MAX_CONCURRENT,
+        config.LLM_ADMISSION_MAX_QUEUE,
+        queue_timeout=config.ADMISSION_QUEUE_TIMEOUT,
+        session_rate=config.ADMISSION_SESSION_RATE,
+        session_burst=config.ADMISSION_SESSION_BURST,
+        heavy_cost=config.ADMISSION_JUDGE_COST,
+        retry_after=config.ADMISSION_RETRY_AFTER
+    )
+
+# 各上游模型的实时延迟/错误率统计，以及 "auto" 模型的路由
+model_stats = ModelStatsTracker(alpha=config.AUTO_ROUTE_ALPHA)
+model_router = ModelRouter(
+    model_stats,
+    {"normal": config.AUTO_ROUTE_MODELS_NORMAL, "professional": config.AUTO_ROUTE_MODELS_PROFESSIONAL},
+    model_name_of=lambda model_id: get_model_name(model_id),
+    expected_tokens=config.AUTO_ROUTE_EXPECTED_TOKENS,
+    explore=config.AUTO_ROUTE_EXPLORE
+)
+
 # ===================================================================
 # --- 2. Prompt工程 (已修改：增加专业版/普通版) ---
 # ===================================================================
@@ -247,6 +299,20 @@ JSON格式必须如下:
 }}
 """
 
+# 2.5 对话摘要 (长对话中较早的轮次由廉价模型压缩为摘要)
+SUMMARY_PROMPT_TEMPLATE = """
+你是刑事法律咨询对话的记录整理员。请把对话压缩成一份摘要，供后续回答时作为上下文使用。
+
+【要求】
+1. 保留用户陈述的全部关键事实：时间、地点、人物关系、具体行为、金额、伤情、是否自首/赔偿/取得谅解等，以及用户的诉求。
+2. 保留助手已经给出的主要结论：可能涉及的罪名、量刑区间、给出的建议、已生成报告的要点。
+3. 如果提供了【已有摘要】，请把【新增对话】的内容合并进去，输出一份完整的新摘要，不要重复。
+4. 不要保留寒暄和格式，用简洁的中文陈述句，不超过{max_chars}字。直接输出摘要正文。
+"""
+
+SUMMARY_ROLE_NAMES = {"user": "用户", "assistant": "助手"}
+
+
 def format_rag_data_for_prompt(rag_data, historical_rag_data=None):
     """格式化RAG数据用于提示词，包括当前检索和历史检索的案例"""
     current_cases_text = ""
@@ -331,6 +397,7 @@ def call_model_sync(model_id, messages):
     if not selected_model_name:
         raise ValueError(f"未知的模型ID: '{model_id}'")
         
+    started_at = time.monotonic()
     try:
         client = openai.OpenAI(api_key=YUNWU_API_KEY, base_url=YUNWU_BASE_URL)
         response = client.chat.completions.create(
@@ -340,163 +407,685 @@ def call_model_sync(model_id, messages):
             stream=False # 明确非流式
         )
         if response.choices and len(response.choices) > 0:
-            return response.choices[0].message.content
+            answer = response.choices[0].message.content
+            # Judge 模式的上游调用同样计入 auto 路由的统计
+            model_stats.record_completion(selected_model_name, time.monotonic() - started_at,
+                                          token_counter.count(answer or ""))
+            return answer
         else:
             raise Exception("API未返回有效回答")
     except openai.OpenAIError as e:
+        model_stats.record_error(selected_model_name)
         app.logger.error(f"调用云雾API ({selected_model_name}) 时发生错误: {e}")
         return f"模型 {model_id} 在回答时出错: {str(e)}"
     except Exception as e:
+        model_stats.record_error(selected_model_name)
         app.logger.error(f"调用模型时发生未知错误: {e}")
         return f"模型 {model_id} 发生未知错误: {str(e)}"
 
-# ===================================================================
-# --- 4. API接口定义 (已重构，支持专业模式) ---
-# ===================================================================
-# 修改 /predict 路由中的消息构造部分
-@app.route('/predict', methods=['POST'])
-def predict():
-    data = request.json
-    if not data or 'user_question' not in data:
-        return jsonify({"error": "请求格式错误"}), 400
+async def call_model_async(model_id, messages):
+    """call_model_sync 的异步版本，供 ASGI 服务的 Judge 模式使用 (不占用线程)"""
+    selected_model_name = get_model_name(model_id)
+    if not selected_model_name:
+        raise ValueError(f"未知的模型ID: '{model_id}'")
+
+    started_at = time.monotonic()
+    try:
+        response = await get_async_client().chat.completions.create(
+            model=selected_model_name,
+            messages=messages,
+            temperature=0.1,
+            stream=False
+        )
+        if response.choices and len(response.choices) > 0:
+            answer = response.choices[0].message.content
+            # Judge 模式的上游调用同样计入 auto 路由的统计
+            model_stats.record_completion(selected_model_name, time.monotonic() - started_at,
+                                          token_counter.count(answer or ""))
+            return answer
+        else:
+            raise Exception("API未返回有效回答")
+    except openai.OpenAIError as e:
+        model_stats.record_error(selected_model_name)
+        app.logger.error(f"调用云雾API ({selected_model_name}) 时发生错误: {e}")
+        return f"模型 {model_id} 在回答时出错: {str(e)}"
+    except Exception as e:
+        model_stats.record_error(selected_model_name)
+        app.logger.error(f"调用模型时发生未知错误: {e}")
+        return f"模型 {model_id} 发生未知错误: {str(e)}"
+
+
+_async_client = None
+
+
+def get_async_client():
+    """惰性创建共享的异步OpenAI客户端 (复用连接池)"""
+    global _async_client
+    if _async_client is None:
+        _async_client = openai.AsyncOpenAI(api_key=YUNWU_API_KEY, base_url=YUNWU_BASE_URL)
+    return _async_client
+
+
+class PredictError(Exception):
+    """预测请求无法完成时抛出，携带HTTP状态码和返回体"""
+
+    def __init__(self, message, status=500, details=None):
+        super().__init__(message)
+        self.status = status
+        self.payload = {"error": message}
+        if details is not None:
+            self.payload["details"] = details
 
-    # 4.1 提取通用数据
+
+def create_chat_stream(model_name, messages):
+    """向云雾API发起流式请求，返回上游的流对象"""
+    client = openai.OpenAI(api_key=YUNWU_API_KEY, base_url=YUNWU_BASE_URL)
+    return client.chat.completions.create(
+        model=model_name,
+        messages=messages,
+        temperature=0.1,
+        stream=True  # <--- 关键：开启流式
+    )
+
+
+async def create_chat_stream_async(model_name, messages):
+    """create_chat_stream 的异步版本，返回可 async for 迭代的上游流"""
+    return await get_async_client().chat.completions.create(
+        model=model_name,
+        messages=messages,
+        temperature=0.1,
+        stream=True
+    )
+
+
+def get_prompt_budget(model_id):
+    """返回指定模型的提示词token预算"""
+    return config.PROMPT_TOKEN_BUDGETS.get(model_id, config.PROMPT_TOKEN_BUDGET)
+
+
+def wrap_user_message(rag_text, user_question):
+    """拼接本轮发送给LLM的用户消息"""
+    return f"**【系统检索信息】**\n{rag_text}\n\n**【用户本轮提问】**\n{user_question}\n\n请根据以上信息、结合历史对话，回答我的问题。"
+
+
+def build_messages(data):
+    """
+    根据请求数据构造发送给LLM的消息 (按模型的token预算裁剪案例与历史)
+
+    返回:
+        tuple: (messages_for_llm, rag_text, selected_system_prompt, prompt_report)
+    """
     user_question = data['user_question']
     rag_data = data.get('rag_data', [])
     historical_rag_data = data.get('historical_rag_data', [])  # 新增：历史检索案例
-    chat_history = data.get('chat_history', [])
-    model_id = data.get('model_id', 'deepseek')
+    chat_history = data.get('chat_history', [])  # 摘要之后的近期对话
 
     is_professional = data.get('is_professional_mode', False)
     selected_system_prompt = SYSTEM_PROMPT_PROFESSIONAL if is_professional else SYSTEM_PROMPT_NORMAL
 
-    # 4.2 准备基础消息 (所有模型通用)
-    # 修改：传入历史检索案例数据
-    rag_text = format_rag_data_for_prompt(rag_data, historical_rag_data)
+    model_id = data.get('model_id', 'deepseek')
+    budget = PromptBudget(get_prompt_budget(model_id), token_counter,
+                          format_rag_data_for_prompt, wrap_user_message, config.PROMPT_FACT_SENTENCES)
+    messages_for_llm, rag_text, prompt_report = budget.build(
+        selected_system_prompt, chat_history, rag_data, historical_rag_data, user_question,
+        summary=data.get('conversation_summary'))
+
+    if prompt_report["trimmed"]:
+        app.logger.info(f"提示词超出预算已裁剪 ({model_id}): {prompt_report}")
+    return messages_for_llm, rag_text, selected_system_prompt, prompt_report
+
+
+def build_judge_messages(data, rag_text, selected_system_prompt, results):
+    """根据所有参赛模型的回答构造裁判模型的消息"""
+    answers_text_list = []
+    for model_name, answer in results.items():
+        answers_text_list.append(f"--- 来自模型 {model_name} 的回答 ---\n{answer}\n")
+
+    # (修改) 将选择的系统提示词(selected_system_prompt)传给Judge
+    judge_prompt = JUDGE_PROMPT_TEMPLATE.format(
+        user_question=data['user_question'],
+        rag_data=rag_text,
+        system_instructions=selected_system_prompt, # <--- (新增) 告诉裁判使用了什么指令
+        answers_text="\n".join(answers_text_list)
+    )
+    return [{"role": "system", "content": judge_prompt}]
+
+
+def parse_judge_response(judge_response_text, results):
+    """解析裁判的JSON输出，返回 /predict Judge 模式的结果"""
+    try:
+        if "```json" in judge_response_text:
+            judge_response_text = judge_response_text.split("```json")[1].split("```")[0].strip()
+        judge_result = json.loads(judge_response_text)
+        best_answer = judge_result.get("best_answer", "裁判未能选出最佳回答")
+        reasoning = judge_result.get("reasoning", "裁判未提供理由")
+    except Exception as e:
+        app.logger.error(f"Judge模式：裁判返回的JSON格式错误: {judge_response_text}。 错误: {e}")
+        raise PredictError("裁判返回结果格式错误，无法解析", 500, details=judge_response_text)
+
+    return {
+        "prediction": best_answer, 
+        "model_used": f"Judge ({JUDGE_MODEL_ID})",
+        "judge_reasoning": reasoning, 
+        "all_answers": results
+    }
+
+
+def run_judge(data):
+    """
+    Judge 模式 (非流式)：并行调用所有参赛模型，再由裁判模型选出最佳回答
+
+    返回:
+        dict: {prediction, model_used, judge_reasoning, all_answers}
+    """
+    messages_for_llm, rag_text, selected_system_prompt, prompt_report = build_messages(data)
+    try:
+        # 1. 并行调用所有“参赛”模型
+        # (注意: messages_for_llm 已经包含了正确的(专业或普通)系统提示词)
+        threads = []
+        results = {} 
+        def thread_target(contestant_id):
+            app.logger.info(f"Judge模式：开始调用 {contestant_id}...")
+            answer = call_model_sync(contestant_id, messages_for_llm) # 使用非流式函数
+            results[contestant_id] = answer
+            app.logger.info(f"Judge模式：{contestant_id} 调用完成。")
+
+        for contestant_id in CONTESTANT_MODELS:
+            thread = threading.Thread(target=thread_target, args=(contestant_id,))
+            threads.append(thread)
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        app.logger.info("Judge模式：所有参赛模型调用完毕，准备调用裁判模型。")
+
+        # 2. 调用“裁判”模型
+        judge_messages = build_judge_messages(data, rag_text, selected_system_prompt, results)
+        judge_response_text = call_model_sync(JUDGE_MODEL_ID, judge_messages) # 使用非流式函数
+        app.logger.info(f"Judge模式：裁判 ({JUDGE_MODEL_ID}) 评判完成。")
+
+    except Exception as e:
+        app.logger.error(f"Judge模式处理时发生未知错误: {e}")
+        raise PredictError(f"服务器内部错误: {e}", 500)
+
+    # 3. 解析裁判的JSON输出
+    result = parse_judge_response(judge_response_text, results)
+    result["prompt_tokens"] = prompt_report["prompt_tokens"]
+    return result
+
+
+async def run_judge_async(data):
+    """run_judge 的异步版本：参赛模型以协程并发调用，不占用线程"""
+    messages_for_llm, rag_text, selected_system_prompt, prompt_report = build_messages(data)
+    try:
+        answers = await asyncio.gather(*(call_model_async(cid, messages_for_llm) for cid in CONTESTANT_MODELS))
+        results = dict(zip(CONTESTANT_MODELS, answers))
+        app.logger.info("Judge模式(异步)：所有参赛模型调用完毕，准备调用裁判模型。")
 
-    messages_for_llm = [
-        {"role": "system", "content": selected_system_prompt},
-        *chat_history,
-        {"role": "user", "content": f"**【系统检索信息】**\n{rag_text}\n\n**【用户本轮提问】**\n{user_question}\n\n请根据以上信息、结合历史对话，回答我的问题。"}
+        judge_messages = build_judge_messages(data, rag_text, selected_system_prompt, results)
+        judge_response_text = await call_model_async(JUDGE_MODEL_ID, judge_messages)
+    except Exception as e:
+        app.logger.error(f"Judge模式处理时发生未知错误: {e}")
+        raise PredictError(f"服务器内部错误: {e}", 500)
+
+    result = parse_judge_response(judge_response_text, results)
+    result["prompt_tokens"] = prompt_report["prompt_tokens"]
+    return result
+
+
+def summarize_history(data):
+    """
+    将对话中较早的轮次合并进已有摘要 (增量摘要，不重新处理已摘要的内容)
+
+    参数:
+        data: {"summary": 已有摘要, "messages": [{"role", "content"}, ...], "model_id": 摘要模型}
+
+    返回:
+        dict: {"summary": 新摘要, "model_used": 模型名}
+    """
+    model_id = data.get('model_id') or config.HISTORY_SUMMARY_MODEL
+    model_name = get_model_name(model_id)
+    if not model_name:
+        raise PredictError(f"未知的模型ID: '{model_id}'", 400)
+    messages = data.get('messages') or []
+    if not messages:
+        raise PredictError("没有需要摘要的对话", 400)
+
+    dialogue = "\n\n".join(
+        f"{SUMMARY_ROLE_NAMES.get(m.get('role'), m.get('role'))}: "
+        f"{token_counter.truncate(m.get('content', ''), config.HISTORY_SUMMARY_MESSAGE_TOKENS)}"
+        for m in messages
+    )
+    summary_messages = [
+        {"role": "system", "content": SUMMARY_PROMPT_TEMPLATE.format(max_chars=config.HISTORY_SUMMARY_MAX_CHARS)},
+        {"role": "user", "content": f"【已有摘要】\n{data.get('summary') or '无'}\n\n【新增对话】\n{dialogue}"}
     ]
+    try:
+        client = openai.OpenAI(api_key=YUNWU_API_KEY, base_url=YUNWU_BASE_URL)
+        response = client.chat.completions.create(model=model_name, messages=summary_messages, temperature=0.1)
+        summary = response.choices[0].message.content if response.choices else None
+    except Exception as e:
+        app.logger.error(f"生成对话摘要时发生错误: {e}")
+        raise PredictError(f"生成对话摘要失败: {e}", 502)
+    if not summary:
+        raise PredictError("摘要模型未返回内容", 502)
+    return {"summary": summary.strip(), "model_used": model_name}
+
+
+def prepare_stream(data):
+    """
+    单个模型模式的公共准备步骤：校验模型、构造消息、查询回答缓存
+
+    返回:
+        tuple: (selected_model_name, messages_for_llm, cache_key, no_store, cached, prompt_report)
+        其中 cached 为命中的缓存条目 (dict) 或 None，prompt_report 为提示词token统计
+    """
+    model_id = data.get('model_id', 'deepseek')
+    selected_model_name = get_model_name(model_id)
+    if not selected_model_name:
+        raise PredictError(f"未知的模型ID: '{model_id}'", 400)
+
+    messages_for_llm, _, _, prompt_report = build_messages(data)
+
+    # 缓存控制：请求体中的 cache_control 标记
+    no_cache, no_store = parse_cache_control(data.get('cache_control'))
+    cache_key = None
+    cached = None
+    if response_cache is not None:
+        cache_key = make_cache_key(selected_model_name, messages_for_llm)
+        if no_cache:
+            response_cache.record_bypass()
+        else:
+            cached = response_cache.get(cache_key)
+            if cached:
+                app.logger.info(f"回答缓存命中: {cache_key[:12]}")
+    return selected_model_name, messages_for_llm, cache_key, no_store, cached, prompt_report
+
+
+def store_answer(cache_key, no_store, model_name, answer_parts):
+    """流正常结束后将完整回答写入缓存"""
+    if cache_key and not no_store and answer_parts:
+        response_cache.put(cache_key, model_name, "".join(answer_parts))
+
+
+def extract_delta(chunk):
+    """取出上游流式chunk中的文本增量，没有则返回None"""
+    # 检查choices是否存在且不为空
+    if chunk.choices and len(chunk.choices) > 0:
+        delta = chunk.choices[0].delta
+        if delta and delta.content:
+            return delta.content
+    return None
+
+
+def resolve_auto_model(data):
+    """model_id 为 "auto" 时按实时统计选出模型，返回替换了 model_id 的请求数据副本"""
+    if data.get('model_id') != 'auto':
+        return data
+    model_id = model_router.choose(professional=bool(data.get('is_professional_mode', False)))
+    app.logger.info(f"auto 路由选择模型: {model_id}")
+    return {**data, 'model_id': model_id}
+
+
+def record_stream_stats(model_used, requested_model, started_at, first_token_at, answer_parts):
+    """记录一次成功流式调用的 TTFT 与生成速度 (供 auto 路由使用)"""
+    if model_used != requested_model:
+        # 主模型首字超时或出错，由备用模型回答
+        model_stats.record_error(requested_model)
+    if first_token_at is None:
+        return
+    model_stats.record_success(model_used, first_token_at - started_at,
+                               token_counter.count("".join(answer_parts)), time.monotonic() - first_token_at)
+
+
+def get_fallback_model(model_id):
+    """返回对冲请求使用的备用模型名 (未启用对冲或未配置备用模型时返回None)"""
+    if not config.HEDGE_ENABLED:
+        return None
+    fallback_id = config.HEDGE_FALLBACKS.get(model_id)
+    fallback_name = get_model_name(fallback_id) if fallback_id else None
+    if not fallback_name or fallback_name == get_model_name(model_id):
+        return None
+    return fallback_name
+
+
+def has_delta(chunk):
+    return extract_delta(chunk) is not None
+
+
+def model_info_event(model_used, requested_model, prompt_report):
+    """model_info 事件：model_used 为实际回答的模型，由备用模型回答时附带原请求模型"""
+    event = {"event": "model_info", "model_used": model_used, "prompt_tokens": prompt_report["prompt_tokens"]}
+    if model_used != requested_model:
+        event["requested_model"] = requested_model
+    return event
+
+
+def answer_cache_key(cache_key, model_used, requested_model, messages):
+    """由备用模型回答时按实际模型另存缓存，避免以备用模型的回答冒充主模型"""
+    if cache_key and model_used != requested_model:
+        return make_cache_key(model_used, messages)
+    return cache_key
+
+
+def register_stream(data, cancel_token=None):
+    """
+    为流式请求准备取消标记
+
+    同进程模式下 app.py 会传入自己的 CancelToken；HTTP 模式下按请求体中的 request_id 登记，
+    由 /cancel 接口取消。
+
+    返回:
+        tuple: (CancelToken, 是否由本模块登记 (结束时需注销))
+    """
+    if cancel_token is not None:
+        return cancel_token, False
+    request_id = data.get('request_id') or str(uuid.uuid4())
+    return cancellation_registry.register(request_id, data.get('conversation_id')), True
+
+
+def finish_stream(token, owns_token, chunks_received, completed):
+    """流结束时的收尾：未正常结束且未被取消时视为客户端断开，记录统计并注销"""
+    if not completed and not token.cancelled:
+        token.cancel("disconnect")
+    cancellation_registry.record_finish(token, chunks_received)
+    if owns_token:
+        cancellation_registry.unregister(token)
+
+
+def open_stream(data, cancel_token=None):
+    """
+    单个模型模式：校验请求并返回流式事件生成器
+
+    生成器产出的事件均为字典，与 app.py 转发给浏览器的格式一致：
+        {"event": "model_info", "model_used": ...}
+        {"event": "chunk", "chunk": ...}
+        {"event": "error", "error": ...}
+        {"event": "cancelled", "reason": ...}
+        {"event": "end_of_stream"}
+
+    参数校验与缓存查询在调用时立即执行 (失败抛出 PredictError)，
+    上游请求在开始迭代生成器时才发出。
+    请求被取消 (或客户端断开导致生成器被关闭) 时立即关闭上游流，不再继续消耗token。
+    启用对冲时 model_info 在决出实际回答的模型后才发送，model_used 为实际回答的模型。
+    """
+    data = resolve_auto_model(data)
+    selected_model_name, messages_for_llm, cache_key, no_store, cached, prompt_report = prepare_stream(data)
+    if cached:
+        return replay_events(cached["model_used"], cached["answer"], config.RESPONSE_CACHE_REPLAY_CHUNK,
+                             prompt_report)
+    fallback_model_name = get_fallback_model(data.get('model_id', 'deepseek'))
+
+    def stream_events():
+        token, owns_token = register_stream(data, cancel_token)
+        answer_parts = []
+        stream = None
+        model_used = selected_model_name
+        started_at = time.monotonic()
+        first_token_at = None
+        completed = False
 
-    # ===================================================================
-    # --- 4.3 核心修改：判断是否为 "Judge" 模式 ---
-    # ===================================================================
-    if model_id == 'judge':
-        # --- JUDGE 模式 (保持非流式) ---
         try:
-            # 1. 并行调用所有“参赛”模型
+            # 1. 告诉客户端模型名称及本次提示词的token数 (对冲时等决出实际回答的模型后再发送)
+            if not fallback_model_name:
+                yield model_info_event(model_used, selected_model_name, prompt_report)
+
+            # 2. 调用API (stream=True)，迭代流并逐块转发
             # (注意: messages_for_llm 已经包含了正确的(专业或普通)系统提示词)
-            threads = []
-            results = {} 
-            def thread_target(contestant_id):
-                app.logger.info(f"Judge模式：开始调用 {contestant_id}...")
-                answer = call_model_sync(contestant_id, messages_for_llm) # 使用非流式函数
-                results[contestant_id] = answer
-                app.logger.info(f"Judge模式：{contestant_id} 调用完成。")
-
-            for contestant_id in CONTESTANT_MODELS:
-                thread = threading.Thread(target=thread_target, args=(contestant_id,))
-                threads.append(thread)
-                thread.start()
-            for thread in threads:
-                thread.join()
-
-            app.logger.info("Judge模式：所有参赛模型调用完毕，准备调用裁判模型。")
-            
-            # 2. 准备裁判提示词
-            answers_text_list = []
-            for model_name, answer in results.items():
-                answers_text_list.append(f"--- 来自模型 {model_name} 的回答 ---\n{answer}\n")
-            
-            # (修改) 将选择的系统提示词(selected_system_prompt)传给Judge
-            judge_prompt = JUDGE_PROMPT_TEMPLATE.format(
-                user_question=user_question,
-                rag_data=rag_text,
-                system_instructions=selected_system_prompt, # <--- (新增) 告诉裁判使用了什么指令
-                answers_text="\n".join(answers_text_list)
-            )
-            judge_messages = [{"role": "system", "content": judge_prompt}]
-            
-            # 3. 调用“裁判”模型
-            judge_response_text = call_model_sync(JUDGE_MODEL_ID, judge_messages) # 使用非流式函数
-            app.logger.info(f"Judge模式：裁判 ({JUDGE_MODEL_ID}) 评判完成。")
-
-            # 4. 解析裁判的JSON输出
             try:
-                if "```json" in judge_response_text:
-                    judge_response_text = judge_response_text.split("```json")[1].split("```")[0].strip()
-                judge_result = json.loads(judge_response_text)
-                best_answer = judge_result.get("best_answer", "裁判未能选出最佳回答")
-                reasoning = judge_result.get("reasoning", "裁判未提供理由")
-                
-                return jsonify({
-                    "prediction": best_answer, 
-                    "model_used": f"Judge ({JUDGE_MODEL_ID})",
-                    "judge_reasoning": reasoning, 
-                    "all_answers": results
-                })
-            except Exception as e:
-                app.logger.error(f"Judge模式：裁判返回的JSON格式错误: {judge_response_text}。 错误: {e}")
-                return jsonify({"error": "裁判返回结果格式错误，无法解析", "details": judge_response_text}), 500
+                if fallback_model_name:
+                    # 对冲：主模型首字超时或报错时同时请求备用模型，先出字的一路胜出，另一路立即关闭
+                    attempt = race_first_token(
+                        lambda name: create_chat_stream(name, messages_for_llm), has_delta,
+                        selected_model_name, fallback_model_name, config.HEDGE_TTFT_MS / 1000.0,
+                        token, hedge_stats)
+                    stream, chunks, model_used = attempt.stream, attempt.chunks(), attempt.model_name
+                    started_at = attempt.started_at
+                    yield model_info_event(model_used, selected_model_name, prompt_report)
+                else:
+                    stream = create_chat_stream(selected_model_name, messages_for_llm)
+                    chunks = stream
+                # 取消时直接关闭底层HTTP连接，阻塞中的读取会立即返回
+                token.add_callback(stream.close)
+                for chunk in chunks:
+                    if token.cancelled:
+                        break
+                    content = extract_delta(chunk)
+                    if content:
+                        if first_token_at is None:
+                            first_token_at = time.monotonic()
+                        answer_parts.append(content)
+                        yield {"event": "chunk", "chunk": content}
 
-        except Exception as e:
-            app.logger.error(f"Judge模式处理时发生未知错误: {e}")
-            return jsonify({"error": f"服务器内部错误: {e}"}), 500
+            except Exception as e:
+                if not token.cancelled:
+                    app.logger.error(f"流式传输中发生错误: {e}")
+                    model_stats.record_error(model_used)
+                    yield {"event": "error", "error": str(e)}
+            else:
+                # 仅缓存完整、无错误、未被取消的回答
+                if not token.cancelled:
+                    record_stream_stats(model_used, selected_model_name, started_at, first_token_at, answer_parts)
+                    store_answer(answer_cache_key(cache_key, model_used, selected_model_name, messages_for_llm),
+                                 no_store, model_used, answer_parts)
+
+            if token.cancelled:
+                yield {"event": "cancelled", "reason": token.reason}
+
+            # 3. 发送流结束信号
+            completed = True
+            yield {"event": "end_of_stream"}
+
+        finally:
+            if stream is not None:
+                stream.close()
+            finish_stream(token, owns_token, len(answer_parts), completed)
+
+    return stream_events()
+
+
+async def close_async_stream(stream):
+    """关闭上游异步流 (AsyncOpenAI 的 AsyncStream 提供 close()，普通异步生成器提供 aclose())"""
+    close = getattr(stream, "close", None) or getattr(stream, "aclose", None)
+    if close is not None:
+        await close()
+
+
+def open_stream_async(data, cancel_token=None):
+    """open_stream 的异步版本，返回异步事件生成器 (供 ASGI 服务使用)"""
+    data = resolve_auto_model(data)
+    selected_model_name, messages_for_llm, cache_key, no_store, cached, prompt_report = prepare_stream(data)
+    fallback_model_name = None if cached else get_fallback_model(data.get('model_id', 'deepseek'))
+
+    async def stream_events():
+        if cached:
+            for event in replay_events(cached["model_used"], cached["answer"], config.RESPONSE_CACHE_REPLAY_CHUNK,
+                                       prompt_report):
+                yield event
+            return
+
+        token, owns_token = register_stream(data, cancel_token)
+        loop = asyncio.get_running_loop()
+        answer_parts = []
+        stream = None
+        model_used = selected_model_name
+        started_at = time.monotonic()
+        first_token_at = None
+        completed = False
 
-    # ===================================================================
-    # --- 4.4 单个模型模式：改为流式输出 ---
-    # ===================================================================
-    else:
         try:
-            selected_model_name = get_model_name(model_id)
-            if not selected_model_name:
-                return jsonify({"error": f"未知的模型ID: '{model_id}'"}), 400
-
-            # 定义流式响应生成器
-            def stream_response():
-                client = openai.OpenAI(api_key=YUNWU_API_KEY, base_url=YUNWU_BASE_URL)
-                
-                # 1. 告诉客户端模型名称 (自定义事件)
-                model_name_data = json.dumps({"model_used": selected_model_name})
-                yield f"event: model_info\ndata: {model_name_data}\n\n"
-
-                # 2. 调用API (stream=True)
-                # (注意: messages_for_llm 已经包含了正确的(专业或普通)系统提示词)
-                stream = client.chat.completions.create(
-                    model=selected_model_name,
-                    messages=messages_for_llm,
-                    temperature=0.1,
-                    stream=True  # <--- 关键：开启流式
-                )
-                
-                # 3. 迭代流，并将数据块转发给客户端
-                try:
-                    for chunk in stream:
-                        # 检查choices是否存在且不为空
-                        if chunk.choices and len(chunk.choices) > 0:
-                            delta = chunk.choices[0].delta
-                            if delta and delta.content:
-                                content = delta.content
-                                # 格式化为 Server-Sent Event (SSE)
-                                chunk_data = json.dumps({"chunk": content})
-                                yield f"data: {chunk_data}\n\n"
-
-                except Exception as e:
+            if not fallback_model_name:
+                yield model_info_event(model_used, selected_model_name, prompt_report)
+            try:
+                if fallback_model_name:
+                    attempt = await race_first_token_async(
+                        lambda name: create_chat_stream_async(name, messages_for_llm), has_delta,
+                        selected_model_name, fallback_model_name, config.HEDGE_TTFT_MS / 1000.0,
+                        token, hedge_stats)
+                    stream, chunks, model_used = attempt.stream, attempt.chunks(), attempt.model_name
+                    started_at = attempt.started_at
+                    yield model_info_event(model_used, selected_model_name, prompt_report)
+                else:
+                    stream = await create_chat_stream_async(selected_model_name, messages_for_llm)
+                    chunks = stream
+                # 取消可能来自其他线程 (如 /cancel 的WSGI线程)，需切回事件循环关闭上游流
+                token.add_callback(lambda: asyncio.run_coroutine_threadsafe(close_async_stream(stream), loop))
+                async for chunk in chunks:
+                    if token.cancelled:
+                        break
+                    content = extract_delta(chunk)
+                    if content:
+                        if first_token_at is None:
+                            first_token_at = time.monotonic()
+                        answer_parts.append(content)
+                        yield {"event": "chunk", "chunk": content}
+
+            except Exception as e:
+                if not token.cancelled:
                     app.logger.error(f"流式传输中发生错误: {e}")
-                    error_data = json.dumps({"error": str(e)})
-                    yield f"event: error\ndata: {error_data}\n\n"
-                
-                # 4. 发送流结束信号 (自定义事件)
-                yield "event: end_of_stream\ndata: {}\n\n"
-
-            # 返回流式响应
-            return Response(stream_with_context(stream_response()), mimetype='text/event-stream')
-
-        except Exception as e:
-            app.logger.error(f"流式模式启动时发生错误: {e}")
-            return jsonify({"error": f"服务器内部错误: {e}"}), 500
+                    model_stats.record_error(model_used)
+                    yield {"event": "error", "error": str(e)}
+            else:
+                if not token.cancelled:
+                    record_stream_stats(model_used, selected_model_name, started_at, first_token_at, answer_parts)
+                    store_answer(answer_cache_key(cache_key, model_used, selected_model_name, messages_for_llm),
+                                 no_store, model_used, answer_parts)
+
+            if token.cancelled:
+                yield {"event": "cancelled", "reason": token.reason}
+
+            completed = True
+            yield {"event": "end_of_stream"}
+
+        finally:
+            if stream is not None:
+                await close_async_stream(stream)
+            finish_stream(token, owns_token, len(answer_parts), completed)
+
+    return stream_events()
+
+
+def encode_sse(event):
+    """将事件字典编码为 /predict 的 Server-Sent Event 文本"""
+    name = event.get("event")
+    if name == "chunk":
+        return f"data: {json.dumps({'chunk': event['chunk']})}\n\n"
+    if name == "model_info":
+        payload = {k: v for k, v in event.items() if k != "event"}
+        return f"event: model_info\ndata: {json.dumps(payload)}\n\n"
+    if name == "error":
+        return f"event: error\ndata: {json.dumps({'error': event['error']})}\n\n"
+    if name == "end_of_stream":
+        return "event: end_of_stream\ndata: {}\n\n"
+    payload = {k: v for k, v in event.items() if k != "event"}
+    return f"event: {name}\ndata: {json.dumps(payload)}\n\n"
+
+
+# ===================================================================
+# --- 4. API接口定义 (已重构，支持专业模式) ---
+# ===================================================================
+@app.route('/predict', methods=['POST'])
+def predict():
+    data = request.json
+    if not data or 'user_question' not in data:
+        return jsonify({"error": "请求格式错误"}), 400
+
+    # HTTP Cache-Control 头与请求体中的 cache_control 等效
+    if not data.get('cache_control') and request.headers.get('Cache-Control'):
+        data['cache_control'] = request.headers.get('Cache-Control')
+
+    is_judge = data.get('model_id', 'deepseek') == 'judge'
+    ticket = None
+    if admission is not None:
+        try:
+            ticket = admission.acquire(data.get('conversation_id') or request.remote_addr, heavy=is_judge)
+        except AdmissionRejected as e:
+            return jsonify(e.payload()), e.status, {"Retry-After": str(e.retry_after)}
+
+    # --- JUDGE 模式 (保持非流式) ---
+    if is_judge:
+        try:
+            return jsonify(run_judge(data))
+        except PredictError as e:
+            return jsonify(e.payload), e.status
+        finally:
+            if ticket is not None:
+                ticket.release()
+
+    # --- 单个模型模式：流式输出 ---
+    try:
+        events = open_stream(data)
+    except Exception as e:
+        if ticket is not None:
+            ticket.release()
+        if isinstance(e, PredictError):
+            return jsonify(e.payload), e.status
+        app.logger.error(f"流式模式启动时发生错误: {e}")
+        return jsonify({"error": f"服务器内部错误: {e}"}), 500
+
+    # 按时间片合并token增量，减少SSE帧数
+    events = coalesce_events(events, config.STREAM_COALESCE_MS, config.STREAM_COALESCE_BYTES)
+    response = Response(stream_with_context(encode_sse(event) for event in events), mimetype='text/event-stream')
+    if ticket is not None:
+        # 流式响应发送完毕 (或客户端断开) 后才释放并发名额
+        response.call_on_close(ticket.release)
+    return response
+
+
+@app.route('/summarize', methods=['POST'])
+def summarize():
+    """将较早的对话轮次合并进对话摘要 (由 app.py 在对话变长后调用)"""
+    data = request.get_json(silent=True) or {}
+    try:
+        return jsonify(summarize_history(data))
+    except PredictError as e:
+        return jsonify(e.payload), e.status
+
+
+@app.route('/cancel', methods=['POST'])
+def cancel():
+    """取消进行中的流式请求 (按 request_id 或 conversation_id)，并立即关闭对应的上游流"""
+    data = request.get_json(silent=True) or {}
+    request_id = data.get('request_id')
+    conversation_id = data.get('conversation_id')
+    if not request_id and not conversation_id:
+        return jsonify({"error": "缺少 request_id 或 conversation_id"}), 400
+    cancelled = cancellation_registry.cancel(request_id, conversation_id, reason=data.get('reason', 'user'))
+    return jsonify({"cancelled": cancelled})
+
+
+@app.route('/cancel_stats', methods=['GET'])
+def cancel_stats():
+    """获取流式请求取消的统计信息 (取消数量、取消前已接收块数、估算节省的块数)"""
+    return jsonify(cancellation_registry.stats())
+
+
+@app.route('/routing_table', methods=['GET'])
+def routing_table():
+    """获取 "auto" 模型的实时路由表 (各模式候选模型的分数与 TTFT/生成速度/错误率)"""
+    return jsonify({"routes": model_router.table(), "models": model_stats.snapshot()})
+
+
+@app.route('/hedge_stats', methods=['GET'])
+def hedge_stats_view():
+    """获取对冲请求的统计信息 (触发次数、主/备用模型获胜次数)"""
+    return jsonify({"enabled": config.HEDGE_ENABLED, "ttft_ms": config.HEDGE_TTFT_MS, **hedge_stats.stats()})
+
+
+@app.route('/admission_stats', methods=['GET'])
+def admission_stats():
+    """获取准入控制统计 (处理中/排队中的请求数、排队等待时间、限流与过载拒绝次数)"""
+    if admission is None:
+        return jsonify({"enabled": False})
+    return jsonify({"enabled": True, **admission.stats()})
+
+
+@app.route('/cache_stats', methods=['GET'])
+def cache_stats():
+    """获取回答缓存的命中率等统计信息"""
+    if response_cache is None:
+        return jsonify({"enabled": False})
+    return jsonify({"enabled": True, **response_cache.stats()})
 
 
 # --- 5. 启动服务 (保持不变) ---
@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+"""
+文件名: media_cache.py
+功  能: 图片OCR与语音识别结果的持久化缓存 (供 multimodal_handler.py 的 process_multimodal_file 使用)。
+描  述:
+1. 以 "文件内容的 SHA-256 + 识别引擎标识 (服务与模型)" 为键：同一文件重复上传 (出错后重传、在新对话中再次上传)
+   直接返回上次的识别结果，不访问网络；更换识别模型后旧结果自然不再命中。
+2. 结果保存在本地 SQLite，重启后仍可命中；总字节数超过上限时按最近使用时间淘汰。
+   多个工作进程共用同一数据库文件，总字节数每次写入时在写事务内按磁盘上的数据重新统计，不在进程内累计。
+3. 只缓存识别成功的结果 (由调用方判断)；统计命中/未命中次数与命中省下的识别耗时。
+"""
+
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+
+
+def file_digest(file_path, chunk_size=1024 * 1024):
+    """文件内容的 SHA-256 (分块读取)"""
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class MediaResultCache:
+    """
+    识别结果缓存：SQLite 持久化，按总字节数限额的 LRU 淘汰
+
+    参数:
+        db_path: SQLite 文件路径
+        max_bytes: 缓存结果文本的总字节数上限
+    """
+
+    def __init__(self, db_path, max_bytes=64 * 1024 * 1024):
+        self.db_path = db_path
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "misses": 0, "stores": 0, "evictions": 0, "saved_ms_total": 0.0}
+
+        directory = os.path.dirname(os.path.abspath(db_path))
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS media_cache ("
+            " digest TEXT NOT NULL,"
+            " engine TEXT NOT NULL,"
+            " text TEXT NOT NULL,"
+            " size INTEGER NOT NULL,"
+            " compute_ms REAL NOT NULL,"
+            " hits INTEGER NOT NULL DEFAULT 0,"
+            " created_at REAL NOT NULL,"
+            " last_used_at REAL NOT NULL,"
+            " PRIMARY KEY (digest, engine))"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_media_cache_last_used ON media_cache(last_used_at)")
+        self._conn.commit()
+
+    def get(self, digest, engine):
+        """
+        查询缓存
+
+        返回:
+            str: 识别结果；未命中返回None
+        """
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT text, compute_ms FROM media_cache WHERE digest = ? AND engine = ?", (digest, engine)
+            ).fetchone()
+            if row is None:
+                self._stats["misses"] += 1
+                return None
+            try:
+                self._conn.execute(
+                    "UPDATE media_cache SET hits = hits + 1, last_used_at = ? WHERE digest = ? AND engine = ?",
+                    (time.time(), digest, engine)
+                )
+                self._conn.commit()
+            except sqlite3.Error:
+                # 只影响LRU顺序：写锁被其他进程占用时放弃本次更新，结果照常返回
+                self._conn.rollback()
+            self._stats["hits"] += 1
+            self._stats["saved_ms_total"] += row[1]
+            return row[0]
+
+    def put(self, digest, engine, text, compute_ms=0.0):
+        """写入识别结果，超过总字节数上限时淘汰最久未使用的条目"""
+        size = len(text.encode("utf-8"))
+        if size > self.max_bytes:
+            return
+        now = time.time()
+        with self._lock:
+            # 立即取得写锁：其他进程的写入与淘汰在此事务提交前等待，统计出的总字节数不会过时
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO media_cache (digest, engine, text, size, compute_ms, hits, created_at, "
+                    "last_used_at) VALUES (?, ?, ?, ?, ?, 0, ?, ?)",
+                    (digest, engine, text, size, compute_ms, now, now)
+                )
+                total = self._total_bytes()
+                while total > self.max_bytes:
+                    victims = self._conn.execute(
+                        "SELECT digest, engine, size FROM media_cache ORDER BY last_used_at LIMIT 32").fetchall()
+                    if not victims:
+                        break
+                    for victim_digest, victim_engine, victim_size in victims:
+                        if total <= self.max_bytes:
+                            break
+                        self._conn.execute("DELETE FROM media_cache WHERE digest = ? AND engine = ?",
+                                           (victim_digest, victim_engine))
+                        total -= victim_size
+                        self._stats["evictions"] += 1
+                self._conn.commit()
+            except Exception:
+                self._conn.rollback()
+                raise
+            self._stats["stores"] += 1
+
+    def clear(self):
+        """清空缓存"""
+        with self._lock:
+            self._conn.execute("DELETE FROM media_cache")
+            self._conn.commit()
+
+    def _total_bytes(self):
+        """数据库中全部结果的总字节数 (包括其他进程写入的条目；调用方持有锁)"""
+        return self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM media_cache").fetchone()[0]
+
+    def stats(self):
+        """返回命中率、条目数与占用字节数"""
+        with self._lock:
+            stats = dict(self._stats)
+            lookups = stats["hits"] + stats["misses"]
+            stats["saved_ms_total"] = round(stats["saved_ms_total"], 1)
+            stats.update({
+                "hit_rate": round(stats["hits"] / lookups, 4) if lookups else 0.0,
+                "entries": self._conn.execute("SELECT COUNT(*) FROM media_cache").fetchone()[0],
+                "bytes": self._total_bytes(),
+                "max_bytes": self.max_bytes
+            })
+            return stats
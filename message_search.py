@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+"""
+文件名: message_search.py
+功  能: 对话消息的全文搜索 (SQLite FTS5)，供 app.py 的 /search 使用。
+描  述:
+1. messages_fts 是以 messages 表为外部内容的 FTS5 索引 (trigram 分词，中文无需分词即可按子串匹配)；
+   messages 表上的触发器在插入/删除/修改消息时同步更新索引，与消息写入在同一事务中完成。
+2. 搜索词按空白拆分，各词之间为 AND；至少3个字的词走 FTS5 MATCH，按 BM25 排序并由 snippet() 截取片段；
+   全部搜索词都不足3个字时 (trigram 无法索引) 退化为在本会话的消息中 LIKE 匹配，按对话更新时间排序。
+3. 只在 SQL 中读取匹配消息的片段，不把对话历史读入 Python；结果按对话分组，每个对话保留得分最高的几条片段。
+"""
+
+import html
+import re
+
+from sqlalchemy import text
+
+MIN_TERM_CHARS = 3  # trigram 分词能索引的最短搜索词
+
+# snippet() 的高亮标记：先用控制字符占位，转义HTML后再替换为 <mark>
+_MARK_OPEN = "\x02"
+_MARK_CLOSE = "\x03"
+
+FTS_SCHEMA = [
+    "CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5("
+    "content, content='messages', content_rowid='id', tokenize='trigram')",
+    "CREATE TRIGGER IF NOT EXISTS messages_fts_ai AFTER INSERT ON messages BEGIN "
+    "INSERT INTO messages_fts(rowid, content) VALUES (new.id, new.content); END",
+    "CREATE TRIGGER IF NOT EXISTS messages_fts_ad AFTER DELETE ON messages BEGIN "
+    "INSERT INTO messages_fts(messages_fts, rowid, content) VALUES ('delete', old.id, old.content); END",
+    "CREATE TRIGGER IF NOT EXISTS messages_fts_au AFTER UPDATE OF content ON messages BEGIN "
+    "INSERT INTO messages_fts(messages_fts, rowid, content) VALUES ('delete', old.id, old.content); "
+    "INSERT INTO messages_fts(rowid, content) VALUES (new.id, new.content); END",
+]
+
+
+def install_message_search(conn):
+    """
+    创建全文索引与同步触发器 (已存在时跳过)；新建索引时为已有消息建立索引
+
+    返回:
+        bool: 是否可用 (SQLite 未编译 FTS5 或版本过旧不支持 trigram 时为False)
+    """
+    try:
+        existed = conn.execute(text(
+            "SELECT 1 FROM sqlite_master WHERE type='table' AND name='messages_fts'")).first() is not None
+        for statement in FTS_SCHEMA:
+            conn.execute(text(statement))
+        if not existed:
+            conn.execute(text("INSERT INTO messages_fts(messages_fts) VALUES ('rebuild')"))
+            print("✓ 数据库迁移: 已为已有消息建立全文索引 messages_fts")
+        return True
+    except Exception as e:
+        print(f"警告: 全文搜索不可用 (需要支持 FTS5 trigram 的 SQLite 3.34+): {e}")
+        return False
+
+
+def split_terms(query):
+    """按空白拆分搜索词 (去重，保持顺序)"""
+    terms = []
+    for term in (query or "").split():
+        if term not in terms:
+            terms.append(term)
+    return terms
+
+
+def _fts_phrase(term):
+    return '"' + term.replace('"', '""') + '"'
+
+
+def _like_pattern(term):
+    return "%" + re.sub(r"([\\%_])", r"\\\1", term) + "%"
+
+
+def _render_snippet(snippet):
+    return html.escape(snippet).replace(_MARK_OPEN, "<mark>").replace(_MARK_CLOSE, "</mark>")
+
+
+def _highlight(snippet, terms):
+    """LIKE 匹配得到的片段：转义后给搜索词加 <mark>"""
+    escaped = html.escape(snippet)
+    for term in sorted(terms, key=len, reverse=True):
+        escaped = escaped.replace(html.escape(term), f"<mark>{html.escape(term)}</mark>")
+    return escaped
+
+
+def _fts_hits(conn, session_id, long_terms, short_terms, max_hits, snippet_tokens):
+    params = {"query": " ".join(_fts_phrase(t) for t in long_terms), "session_id": session_id,
+              "max_hits": max_hits, "open": _MARK_OPEN, "close": _MARK_CLOSE, "tokens": snippet_tokens}
+    # 不足3个字的词只能在 FTS 命中的行上再做 LIKE 过滤
+    extra = ""
+    for i, term in enumerate(short_terms):
+        extra += f" AND m.content LIKE :short{i} ESCAPE '\\'"
+        params[f"short{i}"] = _like_pattern(term)
+    rows = conn.execute(text(
+        "SELECT m.id, m.conversation_id, m.seq, m.role, c.title, c.updated_at, "
+        "snippet(messages_fts, 0, :open, :close, '…', :tokens) AS snippet, bm25(messages_fts) AS score "
+        "FROM messages_fts "
+        "JOIN messages m ON m.id = messages_fts.rowid "
+        "JOIN conversations c ON c.id = m.conversation_id "
+        "WHERE messages_fts MATCH :query AND c.session_id = :session_id" + extra +
+        " ORDER BY score LIMIT :max_hits"), params).mappings().all()
+    return [dict(row, snippet=_render_snippet(row["snippet"]), score=round(-row["score"], 4)) for row in rows]
+
+
+def _like_hits(conn, session_id, terms, max_hits, snippet_chars):
+    params = {"session_id": session_id, "max_hits": max_hits, "first": terms[0],
+              "before": snippet_chars // 3, "length": snippet_chars}
+    conditions = ""
+    for i, term in enumerate(terms):
+        conditions += f" AND m.content LIKE :term{i} ESCAPE '\\'"
+        params[f"term{i}"] = _like_pattern(term)
+    # 片段在 SQL 中截取：第一个搜索词之前 1/3、之后 2/3
+    rows = conn.execute(text(
+        "SELECT m.id, m.conversation_id, m.seq, m.role, c.title, c.updated_at, "
+        "substr(m.content, max(1, instr(m.content, :first) - :before), :length) AS snippet "
+        "FROM conversations c JOIN messages m ON m.conversation_id = c.id "
+        "WHERE c.session_id = :session_id" + conditions +
+        " ORDER BY c.updated_at DESC, m.seq DESC LIMIT :max_hits"), params).mappings().all()
+    return [dict(row, snippet=_highlight(row["snippet"] or "", terms), score=None) for row in rows]
+
+
+def search_messages(conn, session_id, query, limit=20, snippets_per_conversation=3, max_hits=200,
+                    snippet_tokens=32):
+    """
+    在一个会话的全部对话中搜索消息内容
+
+    参数:
+        conn: SQLAlchemy 连接 (或 db.session)
+        limit: 返回的对话数上限
+        snippets_per_conversation: 每个对话返回的片段数上限
+        max_hits: 参与分组的匹配消息数上限 (按相关度取前若干条)
+        snippet_tokens: 片段长度 (trigram 分词下约等于字数)
+    返回:
+        dict: {"mode": "fts"|"like"|None, "conversations": [{conversation_id, title, updated_at, score, matches}]}
+              片段已转义HTML，匹配部分用 <mark> 标出；like 模式下 score 为None
+    """
+    terms = split_terms(query)
+    if not terms:
+        return {"mode": None, "conversations": []}
+
+    long_terms = [t for t in terms if len(t) >= MIN_TERM_CHARS]
+    short_terms = [t for t in terms if len(t) < MIN_TERM_CHARS]
+    if long_terms:
+        mode = "fts"
+        hits = _fts_hits(conn, session_id, long_terms, short_terms, max_hits, snippet_tokens)
+    else:
+        mode = "like"
+        hits = _like_hits(conn, session_id, terms, max_hits, snippet_tokens * 2)
+
+    grouped = {}
+    for hit in hits:
+        group = grouped.get(hit["conversation_id"])
+        if group is None:
+            if len(grouped) >= limit:
+                continue
+            updated_at = hit["updated_at"]
+            group = grouped[hit["conversation_id"]] = {
+                "conversation_id": hit["conversation_id"],
+                "title": hit["title"],
+                "updated_at": updated_at.isoformat() if hasattr(updated_at, "isoformat") else updated_at,
+                "score": hit["score"],
+                "matches": []
+            }
+        if len(group["matches"]) < snippets_per_conversation:
+            group["matches"].append({"message_id": hit["id"], "seq": hit["seq"], "role": hit["role"],
+                                     "snippet": hit["snippet"]})
+    return {"mode": mode, "conversations": list(grouped.values())}
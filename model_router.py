@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+"""
+文件名: model_router.py
+功  能: "auto" 模型的延迟感知路由 (供 llm.py 使用)。
+描  述:
+1. ModelStatsTracker 为每个上游模型记录指数加权移动平均 (EWMA)：首字时间 TTFT、生成速度 tokens/s、错误率。
+   llm.py 在每次流式调用结束时写入一条样本 (成功或失败；被取消的请求不计)；
+   Judge 模式的非流式调用同样记录成功/失败，并由总耗时估算生成速度。
+2. ModelRouter 按 "预计完成时间 / (1 - 错误率)" 为候选模型打分，选分数最低 (最快且最健康) 的模型：
+       预计完成时间 = TTFT + 预计回答token数 / 生成速度
+   尚无样本的模型先各尝试一次；之后另以小概率随机探索其他候选，使统计保持更新。
+3. 候选模型按模式分层：专业模式只在更高质量的子集中选择。
+"""
+
+import random
+import threading
+import time
+
+
+class ModelHealth:
+    """单个模型的 EWMA 统计"""
+
+    def __init__(self, prior_ttft, prior_tps):
+        self.ttft = prior_ttft
+        self.tps = prior_tps
+        self.error_rate = 0.0
+        self.successes = 0
+        self.errors = 0
+        self.last_seen = None
+
+    def to_dict(self):
+        return {
+            "ttft_ms": round(self.ttft * 1000, 1),
+            "tokens_per_sec": round(self.tps, 1),
+            "error_rate": round(self.error_rate, 4),
+            "successes": self.successes,
+            "errors": self.errors,
+            "last_seen": self.last_seen
+        }
+
+
+class ModelStatsTracker:
+    """按上游模型名记录 TTFT / 生成速度 / 错误率的 EWMA"""
+
+    def __init__(self, alpha=0.2, prior_ttft=2.0, prior_tps=30.0):
+        self.alpha = alpha
+        self.prior_ttft = prior_ttft
+        self.prior_tps = prior_tps
+        self._health = {}
+        self._lock = threading.Lock()
+
+    def _get(self, model_name):
+        health = self._health.get(model_name)
+        if health is None:
+            health = self._health[model_name] = ModelHealth(self.prior_ttft, self.prior_tps)
+        return health
+
+    def _ewma(self, old, new, first):
+        return new if first else old + self.alpha * (new - old)
+
+    def record_success(self, model_name, ttft, tokens=0, duration=0.0):
+        """
+        记录一次成功的流式调用
+
+        参数:
+            ttft: 首字时间 (秒)
+            tokens / duration: 首字之后生成的token数与耗时 (秒)，耗时过短时不更新生成速度
+        """
+        with self._lock:
+            health = self._get(model_name)
+            first = health.successes == 0
+            health.ttft = self._ewma(health.ttft, ttft, first)
+            if tokens and duration >= 0.05:
+                health.tps = self._ewma(health.tps, tokens / duration, first)
+            health.error_rate = self._ewma(health.error_rate, 0.0, False)
+            health.successes += 1
+            health.last_seen = time.time()
+
+    def record_completion(self, model_name, duration, tokens=0):
+        """
+        记录一次成功的非流式调用 (Judge 模式)：无法测得首字时间，不更新 TTFT；
+        生成速度按 "总耗时 - 当前 TTFT 估计" 估算，耗时过短时不更新
+        """
+        with self._lock:
+            health = self._get(model_name)
+            generation = duration - health.ttft
+            if tokens and generation >= 0.05:
+                health.tps = self._ewma(health.tps, tokens / generation, health.successes == 0)
+            health.error_rate = self._ewma(health.error_rate, 0.0, False)
+            health.successes += 1
+            health.last_seen = time.time()
+
+    def record_error(self, model_name):
+        """记录一次失败 (上游报错，或对冲时未能在截止时间内出字)"""
+        with self._lock:
+            health = self._get(model_name)
+            health.error_rate = self._ewma(health.error_rate, 1.0, False)
+            health.errors += 1
+            health.last_seen = time.time()
+
+    def get(self, model_name):
+        with self._lock:
+            health = self._health.get(model_name)
+            if health is None:
+                return ModelHealth(self.prior_ttft, self.prior_tps)
+            return health
+
+    def snapshot(self):
+        with self._lock:
+            return {name: health.to_dict() for name, health in self._health.items()}
+
+
+class ModelRouter:
+    """
+    为 "auto" 请求选择模型
+
+    参数:
+        tracker: ModelStatsTracker
+        tiers: {"normal": [model_id, ...], "professional": [...]}
+        model_name_of: 函数 model_id -> 上游模型名 (统计按上游模型名记录)
+        expected_tokens: 打分时假设的回答长度
+        explore: 随机探索其他候选的概率
+    """
+
+    def __init__(self, tracker, tiers, model_name_of, expected_tokens=400, explore=0.05):
+        self.tracker = tracker
+        self.tiers = tiers
+        self.model_name_of = model_name_of
+        self.expected_tokens = expected_tokens
+        self.explore = explore
+
+    def score(self, model_id):
+        """分数越低越好：预计完成时间按错误率放大"""
+        health = self.tracker.get(self.model_name_of(model_id))
+        latency = health.ttft + self.expected_tokens / max(health.tps, 0.1)
+        return latency / max(0.05, 1.0 - health.error_rate)
+
+    def candidates(self, professional=False):
+        return list(self.tiers.get("professional" if professional else "normal", []))
+
+    def choose(self, professional=False):
+        """返回本次请求使用的 model_id"""
+        ranked = sorted(self.candidates(professional), key=self.score)
+        if not ranked:
+            raise ValueError("auto 路由没有可用的候选模型")
+        # 冷启动：尚无任何样本的模型先各试一次，之后再按统计选择
+        for model_id in ranked:
+            health = self.tracker.get(self.model_name_of(model_id))
+            if health.successes == 0 and health.errors == 0:
+                return model_id
+        if len(ranked) > 1 and random.random() < self.explore:
+            return random.choice(ranked[1:])
+        return ranked[0]
+
+    def table(self):
+        """当前路由表：每种模式下按分数排序的候选模型及其统计"""
+        result = {}
+        for mode in self.tiers:
+            rows = []
+            for model_id in sorted(self.tiers[mode], key=self.score):
+                model_name = self.model_name_of(model_id)
+                rows.append({
+                    "model_id": model_id,
+                    "model_name": model_name,
+                    "score": round(self.score(model_id), 3),
+                    **self.tracker.get(model_name).to_dict()
+                })
+            result[mode] = {"selected": rows[0]["model_id"] if rows else None, "candidates": rows}
+        return result
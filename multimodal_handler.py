@@ -5,8 +5,11 @@ import json
 import hashlib
 import hmac
 import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 import config
+from media_cache import file_digest
+from image_preprocess import PreprocessStats, prepare_image, raw_image
 
 # ================= 配置区 =================
 # 统一从 config.py 读取
@@ -16,39 +19,132 @@ IMAGE_MODEL = config.IMAGE_MODEL
 
 TENCENT_SECRET_ID = config.TENCENT_SECRET_ID
 TENCENT_SECRET_KEY = config.TENCENT_SECRET_KEY
+ASR_ENGINE_TYPE = "16k_zh"
+OCR_PROMPT = "提取文字，严禁代码。"
 # ==========================================
 
-def process_multimodal_file(file_path):
-    if not os.path.exists(file_path):
-        return f"错误：文件 {file_path} 不存在"
+# 长图切块的并行识别线程池，以及预处理/OCR统计 (app.py 的 /ocr_stats)
+ocr_tile_executor = ThreadPoolExecutor(max_workers=config.OCR_TILE_WORKERS, thread_name_prefix='ocr-tile')
+ocr_stats = PreprocessStats()
+
+# 识别失败时返回的文本前缀 (这些结果不写入缓存)
+FAILURE_PREFIXES = ("错误", "系统级异常", "图片解析异常", "腾讯云识别报错", "响应解析失败", "不支持的格式")
+
 
+def is_recognition_failure(text):
+    return not text or text.startswith(FAILURE_PREFIXES)
+
+
+def recognition_engine(file_path):
+    """识别引擎标识 (服务 + 模型)，作为结果缓存键的一部分；不支持的格式返回None"""
     ext = os.path.splitext(file_path)[1].lower()
     if ext in ['.jpg', '.jpeg', '.png']:
-        return ocr_image_yunwu(file_path)
+        # 预处理参数不同，发给模型的图片不同，结果分别缓存
+        if config.IMAGE_PREPROCESS_ENABLED:
+            return (f"ocr:yunwu:{IMAGE_MODEL}:pre{config.IMAGE_MAX_LONG_EDGE}q{config.IMAGE_JPEG_QUALITY}"
+                    f"t{config.IMAGE_TILE_ASPECT:g}x{config.IMAGE_MAX_TILES}p{config.IMAGE_PASSTHROUGH_BYTES}")
+        return f"ocr:yunwu:{IMAGE_MODEL}"
     elif ext in ['.mp3', '.wav', '.m4a']:
-        return asr_audio_tencent(file_path)
-    return "不支持的格式"
+        return f"asr:tencent:{ASR_ENGINE_TYPE}"
+    return None
+
+
+def process_multimodal_file(file_path, cache=None):
+    """
+    识别图片或音频中的文字
+
+    参数:
+        cache: MediaResultCache；相同内容的文件用同一引擎识别过时直接返回缓存结果
+    """
+    if not os.path.exists(file_path):
+        return f"错误：文件 {file_path} 不存在"
+
+    engine = recognition_engine(file_path)
+    if engine is None:
+        return "不支持的格式"
+
+    digest = None
+    if cache is not None:
+        # 缓存出错 (如其他进程长时间持有写锁时的 database is locked) 按未命中处理，不影响识别
+        try:
+            digest = file_digest(file_path)
+            cached = cache.get(digest, engine)
+        except Exception as e:
+            print(f"识别结果缓存读取失败，按未命中处理: {e}")
+            cached = None
+        if cached is not None:
+            print(f"识别结果缓存命中: {engine}")
+            return cached
+
+    start = time.perf_counter()
+    if engine.startswith("ocr:"):
+        text = ocr_image_yunwu(file_path)
+    else:
+        text = asr_audio_tencent(file_path)
+
+    if cache is not None and digest is not None and not is_recognition_failure(text):
+        try:
+            cache.put(digest, engine, text, (time.perf_counter() - start) * 1000)
+        except Exception as e:
+            print(f"识别结果写入缓存失败，跳过: {e}")
+    return text
+
+def prepare_ocr_image(data):
+    """按配置预处理图片；关闭预处理或处理失败 (如文件损坏) 时发送原文件"""
+    if not config.IMAGE_PREPROCESS_ENABLED:
+        return raw_image(data)
+    try:
+        return prepare_image(data, max_long_edge=config.IMAGE_MAX_LONG_EDGE, jpeg_quality=config.IMAGE_JPEG_QUALITY,
+                             tile_aspect=config.IMAGE_TILE_ASPECT, max_tiles=config.IMAGE_MAX_TILES,
+                             passthrough_bytes=config.IMAGE_PASSTHROUGH_BYTES)
+    except Exception as e:
+        print(f"图片预处理失败，发送原文件: {e}")
+        return raw_image(data)
+
+
+def ocr_request(mime, data, prompt=OCR_PROMPT):
+    """调用视觉模型识别一张图片"""
+    base64_data = base64.b64encode(data).decode('utf-8')
+    headers = {"Authorization": f"Bearer {YUNWU_API_KEY}"}
+    payload = {
+        "model": IMAGE_MODEL,
+        "messages": [{
+            "role": "user",
+            "content": [
+                {"type": "text", "text": prompt},
+                {"type": "image_url", "image_url": {"url": f"data:{mime};base64,{base64_data}"}}
+            ]
+        }],
+        "temperature": 0.0
+    }
+    res = requests.post(f"{YUNWU_BASE_URL}/chat/completions", json=payload, headers=headers, timeout=60)
+    return res.json()['choices'][0]['message']['content']
+
 
 def ocr_image_yunwu(file_path):
-    """图片解析逻辑"""
+    """图片解析逻辑：先在本地预处理 (纠正方向、缩小、重新编码)，长图切块后并行识别再按顺序拼接"""
+    start = time.perf_counter()
+    prepared = None
     try:
         with open(file_path, "rb") as f:
-            base64_data = base64.b64encode(f.read()).decode('utf-8')
-        headers = {"Authorization": f"Bearer {YUNWU_API_KEY}"}
-        payload = {
-            "model": IMAGE_MODEL,
-            "messages": [{
-                "role": "user",
-                "content": [
-                    {"type": "text", "text": "提取文字，严禁代码。"},
-                    {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{base64_data}"}}
-                ]
-            }],
-            "temperature": 0.0
-        }
-        res = requests.post(f"{YUNWU_BASE_URL}/chat/completions", json=payload, headers=headers, timeout=60)
-        return res.json()['choices'][0]['message']['content']
+            prepared = prepare_ocr_image(f.read())
+        if prepared.tiles == 1:
+            text = ocr_request(*prepared.parts[0])
+        else:
+            futures = [
+                ocr_tile_executor.submit(ocr_request, mime, data,
+                                         f"这是一张长图从上到下的第{i + 1}/{prepared.tiles}部分。{OCR_PROMPT}")
+                for i, (mime, data) in enumerate(prepared.parts)
+            ]
+            text = "\n".join(future.result().strip() for future in futures)
+        elapsed_ms = (time.perf_counter() - start) * 1000
+        ocr_stats.record(prepared, elapsed_ms)
+        print(f"图片识别: {prepared.original_bytes} -> {prepared.output_bytes} 字节, {prepared.tiles} 块, "
+              f"预处理 {prepared.elapsed_ms:.0f}ms, 总耗时 {elapsed_ms:.0f}ms")
+        return text
     except:
+        if prepared is not None:
+            ocr_stats.record(prepared, (time.perf_counter() - start) * 1000, failed=True)
         return "图片解析异常"
 
 def asr_audio_tencent(file_path):
@@ -95,7 +191,7 @@ def asr_audio_tencent(file_path):
         params = {
             "ProjectId": 0,
             "SubServiceType": 2,
-            "EngSerViceType": "16k_zh", # 常见手机录音建议保持 16k_zh
+            "EngSerViceType": ASR_ENGINE_TYPE, # 常见手机录音建议保持 16k_zh
             "SourceType": 1,
             "VoiceFormat": real_format, 
             "Data": audio_b64,
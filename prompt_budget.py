@@ -0,0 +1,247 @@
+# -*- coding: utf-8 -*-
+"""
+文件名: prompt_budget.py
+功  能: 按token预算组装发送给LLM的提示词 (供 llm.py 使用)。
+描  述:
+1. 使用 tiktoken 计算token数；编码文件无法加载时 (如离线部署) 退回按字符估算。
+2. 提示词由五部分组成：系统提示词 (含早期对话摘要)、对话历史、当前检索案例、历史检索案例、用户本轮提问。
+   系统提示词、摘要与用户提问必须保留，其余部分超出预算时按优先级逐步裁剪：
+   - 先把案例的案情概要缩短为与提问最相关的几句话 (历史案例先于当前案例)；
+   - 再丢弃历史检索案例，把超长的用户提问 (如附件识别内容) 截断到预算的一半，丢弃最早的对话轮次；
+   - 仍超出时把案情缩短到一句话、只保留最相关的一个当前案例、丢弃全部对话历史；
+   - 最后才截断用户提问本身 (保留开头与结尾)。
+3. 返回最终消息列表以及本次请求的token数与裁剪记录。
+"""
+
+import re
+import threading
+
+# 每条消息的格式开销 (role 等)，以及回复起始的固定开销，参照 OpenAI 的计数方式
+TOKENS_PER_MESSAGE = 4
+TOKENS_PER_REPLY = 3
+
+SENTENCE_SPLIT = re.compile(r'(?<=[。！？；!?;\n])')
+TRUNCATION_MARK = "\n……(中间内容过长，已省略)……\n"
+SUMMARY_HEADER = "【早期对话摘要】(本次咨询中较早对话的摘要，其后为最近几轮完整对话)"
+
+
+def estimate_tokens(text):
+    """无 tiktoken 编码时的估算：中文等非ASCII字符按1.2个token，ASCII按4个字符1个token"""
+    non_ascii = sum(1 for ch in text if ord(ch) > 127)
+    return int(non_ascii * 1.2 + (len(text) - non_ascii) / 4) + 1
+
+
+class TokenCounter:
+    """token计数器，首次使用时加载 tiktoken 编码"""
+
+    def __init__(self, encoding_name="cl100k_base"):
+        self.encoding_name = encoding_name
+        self._encoding = None
+        self._loaded = False
+        self._lock = threading.Lock()
+
+    def _load(self):
+        with self._lock:
+            if self._loaded:
+                return
+            try:
+                import tiktoken
+                self._encoding = tiktoken.get_encoding(self.encoding_name)
+            except Exception as e:
+                print(f"tiktoken 编码 {self.encoding_name} 加载失败，改为按字符估算token数: {e}")
+            self._loaded = True
+
+    @property
+    def exact(self):
+        """是否为 tiktoken 精确计数"""
+        if not self._loaded:
+            self._load()
+        return self._encoding is not None
+
+    def count(self, text):
+        if not text:
+            return 0
+        if not self._loaded:
+            self._load()
+        if self._encoding is not None:
+            return len(self._encoding.encode(text, disallowed_special=()))
+        return estimate_tokens(text)
+
+    def truncate(self, text, max_tokens):
+        """将文本截断到不超过 max_tokens，保留开头约2/3与结尾约1/3"""
+        if self.count(text) <= max_tokens:
+            return text
+        keep = max(0, max_tokens - self.count(TRUNCATION_MARK))
+        if self.exact:
+            tokens = self._encoding.encode(text, disallowed_special=())
+            head, tail = keep * 2 // 3, keep - keep * 2 // 3
+            return (self._encoding.decode(tokens[:head]) + TRUNCATION_MARK
+                    + (self._encoding.decode(tokens[-tail:]) if tail else ""))
+
+        # 估算模式：按比例截取字符，再逐步收紧直到满足预算
+        chars = int(len(text) * keep / max(1, self.count(text)))
+        while True:
+            head, tail = chars * 2 // 3, chars - chars * 2 // 3
+            result = text[:head] + TRUNCATION_MARK + (text[-tail:] if tail else "")
+            if chars <= 0 or self.count(result) <= max_tokens:
+                return result
+            chars = int(chars * 0.9)
+
+
+def _bigrams(text):
+    return {text[i:i + 2] for i in range(len(text) - 1) if not text[i:i + 2].isspace()}
+
+
+def select_relevant_sentences(text, query, max_sentences):
+    """
+    从案情中挑出与提问最相关的若干句 (按字符二元组重合度打分)，保持原有顺序
+
+    返回:
+        str: 缩短后的文本；句子数不超过 max_sentences 时原样返回
+    """
+    sentences = []
+    for sentence in SENTENCE_SPLIT.split(text or ""):
+        if sentence.strip() and sentence.strip() not in sentences:
+            sentences.append(sentence.strip())
+    if len(sentences) <= max_sentences:
+        return text
+    query_grams = _bigrams(query or "")
+    ranked = sorted(range(len(sentences)),
+                    key=lambda i: (-len(_bigrams(sentences[i]) & query_grams), i))[:max_sentences]
+    return "".join(sentences[i] for i in sorted(ranked)) + "……"
+
+
+class PromptBudget:
+    """
+    按token预算组装提示词
+
+    参数:
+        budget: 提示词token上限
+        counter: TokenCounter
+        format_rag: 函数 (rag_data, historical_rag_data) -> 案例文本
+        wrap_user: 函数 (rag_text, user_question) -> 本轮用户消息内容
+        fact_sentences: 第一轮缩短案情时保留的句子数
+        question_share: 用户提问在其他部分仍超出预算时最多占用的预算比例
+    """
+
+    def __init__(self, budget, counter, format_rag, wrap_user, fact_sentences=3, question_share=0.5):
+        self.budget = budget
+        self.question_share = question_share
+        self.counter = counter
+        self.format_rag = format_rag
+        self.wrap_user = wrap_user
+        self.fact_sentences = fact_sentences
+
+    def _message_tokens(self, content):
+        return self.counter.count(content) + TOKENS_PER_MESSAGE
+
+    def build(self, system_prompt, chat_history, rag_data, historical_rag_data, user_question, summary=None):
+        """
+        组装提示词
+
+        summary 为早期对话的摘要，作为系统提示词之后的一条 system 消息发送
+
+        返回:
+            tuple: (messages, rag_text, report)
+            report = {"prompt_tokens", "budget", "trimmed": {裁剪步骤: 次数}, "over_budget"}
+        """
+        history = list(chat_history or [])
+        current_cases = [dict(item) for item in (rag_data or [])]
+        historical_cases = [dict(item) for item in (historical_rag_data or [])]
+        trimmed = {}
+
+        system_messages = [{"role": "system", "content": system_prompt}]
+        if summary:
+            system_messages.append({"role": "system", "content": f"{SUMMARY_HEADER}\n{summary}"})
+        system_tokens = sum(self._message_tokens(m["content"]) for m in system_messages)
+        history_tokens = [self._message_tokens(m.get("content", "")) for m in history]
+        state = {"question": user_question}
+
+        def user_part():
+            rag_text = self.format_rag(current_cases, historical_cases)
+            content = self.wrap_user(rag_text, state["question"])
+            return rag_text, content, self._message_tokens(content)
+
+        rag_text, user_content, user_tokens = user_part()
+
+        def total():
+            return system_tokens + sum(history_tokens) + user_tokens + TOKENS_PER_REPLY
+
+        def record(step):
+            trimmed[step] = trimmed.get(step, 0) + 1
+
+        def shorten_facts(cases, max_sentences):
+            changed = False
+            for case in cases:
+                short = select_relevant_sentences(case.get("fact", ""), user_question, max_sentences)
+                if short != case.get("fact", ""):
+                    case["fact"] = short
+                    changed = True
+            return changed
+
+        def drop_history_turn(keep_messages):
+            # 一轮 = user + assistant，从最早的开始丢弃
+            if len(history) <= keep_messages:
+                return False
+            count = 2 if len(history) - keep_messages >= 2 else 1
+            del history[:count]
+            del history_tokens[:count]
+            return True
+
+        def truncate_question(max_tokens):
+            if self.counter.count(state["question"]) <= max_tokens:
+                return False
+            state["question"] = self.counter.truncate(state["question"], max_tokens)
+            return True
+
+        def drop_case(cases, keep):
+            if len(cases) <= keep:
+                return False
+            cases.pop()
+            return True
+
+        # (步骤名, 执行一次裁剪的函数, 是否影响用户消息, 是否可重复执行)
+        steps = [
+            ("shorten_historical_facts", lambda: shorten_facts(historical_cases, self.fact_sentences), True, False),
+            ("shorten_current_facts", lambda: shorten_facts(current_cases, self.fact_sentences), True, False),
+            ("drop_historical_cases", lambda: drop_case(historical_cases, 0), True, True),
+            ("truncate_user_question", lambda: truncate_question(int(self.budget * self.question_share)), True, False),
+            ("drop_history_turns", lambda: drop_history_turn(2), False, True),
+            ("shorten_facts_to_one_sentence",
+             lambda: shorten_facts(historical_cases + current_cases, 1), True, False),
+            ("drop_current_cases", lambda: drop_case(current_cases, 1), True, True),
+            ("drop_all_history", lambda: drop_history_turn(0), False, True),
+        ]
+
+        for name, apply, affects_user, repeatable in steps:
+            while total() > self.budget and apply():
+                record(name)
+                if affects_user:
+                    rag_text, user_content, user_tokens = user_part()
+                if not repeatable:
+                    break
+            if total() <= self.budget:
+                break
+
+        # 最后手段：截断用户提问 (通常是超长的附件识别内容)
+        if total() > self.budget:
+            overflow = total() - self.budget
+            question_tokens = self.counter.count(state["question"])
+            if question_tokens > overflow:
+                state["question"] = self.counter.truncate(state["question"], question_tokens - overflow)
+                rag_text, user_content, user_tokens = user_part()
+                record("truncate_user_question")
+
+        messages = [
+            *system_messages,
+            *history,
+            {"role": "user", "content": user_content}
+        ]
+        report = {
+            "prompt_tokens": total(),
+            "budget": self.budget,
+            "trimmed": trimmed,
+            "over_budget": total() > self.budget,
+            "exact": self.counter.exact
+        }
+        return messages, rag_text, report
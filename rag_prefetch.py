@@ -0,0 +1,233 @@
+# -*- coding: utf-8 -*-
+"""
+文件名: rag_prefetch.py
+功  能: 用户输入时的RAG检索预取 (供 app.py 的 /prefetch_rag 与 /send_message 使用)。
+描  述:
+1. 前端在用户停止输入片刻后 (防抖) 把草稿发到 /prefetch_rag，后端提前完成查询编码与向量检索，
+   结果按会话保存，每个会话只保留最近几份草稿。
+2. 发送消息时先查找本会话的预取结果：规范化后文本相同为精确命中 (可复用查询向量)，
+   字符二元组重合度超过阈值为近似命中 (只复用检索结果)；预取仍在进行时等待其完成。
+3. 命中后丢弃本会话其余草稿；从未被使用就过期、被淘汰或丢弃的预取计为浪费。
+4. 统计命中/未命中次数、浪费比例，以及命中时省下的检索耗时 (即首字时间的缩短量)。
+5. 每个会话按令牌桶限速 (编码与检索占用CPU，接口不经过准入控制)，超出时不做检索；重复的草稿不消耗令牌。
+"""
+
+import re
+import threading
+import time
+from collections import OrderedDict
+
+from admission import TokenBucket
+
+_IGNORED_CHARS = re.compile(r'[\s，。！？、；：“”‘’（）,.!?;:\'"()]+')
+
+
+def normalize_query(text):
+    """去掉空白与标点后的查询文本，用于判断草稿与最终消息是否一致"""
+    return _IGNORED_CHARS.sub('', text or '')
+
+
+def _bigrams(text):
+    return {text[i:i + 2] for i in range(len(text) - 1)}
+
+
+def query_similarity(a, b):
+    """两段规范化文本的字符二元组 Jaccard 相似度"""
+    grams_a, grams_b = _bigrams(a), _bigrams(b)
+    if not grams_a or not grams_b:
+        return 1.0 if a == b else 0.0
+    return len(grams_a & grams_b) / len(grams_a | grams_b)
+
+
+class PrefetchEntry:
+    """一份草稿的预取结果"""
+
+    def __init__(self, query, k, min_score):
+        self.query = query
+        self.key = normalize_query(query)
+        self.k = k
+        self.min_score = min_score
+        self.query_vec = None
+        self.results = None
+        self.error = None
+        self.compute_ms = 0.0
+        self.created_at = time.time()
+        self.used = False
+        self.match = None  # 被采用时的匹配方式: "exact" / "near"
+        self._ready = threading.Event()
+
+    @property
+    def ready(self):
+        return self._ready.is_set()
+
+    def wait(self, timeout):
+        return self._ready.wait(timeout)
+
+
+class RagPrefetcher:
+    """
+    按会话保存的RAG检索预取
+
+    参数:
+        ttl_seconds: 预取结果的有效期
+        max_per_session: 每个会话保留的草稿数
+        max_sessions: 最多保留的会话数，超出时淘汰最久未使用的会话
+        near_threshold: 近似命中的二元组相似度阈值
+        wait_timeout: 发送时等待进行中预取的最长秒数
+        rate / burst: 每个会话的预取令牌补充速率 (个/秒) 与桶容量，rate<=0 时不限速
+    """
+
+    def __init__(self, ttl_seconds=60, max_per_session=3, max_sessions=2000, near_threshold=0.9, wait_timeout=2.0,
+                 rate=0.0, burst=4):
+        self.ttl_seconds = ttl_seconds
+        self.max_per_session = max_per_session
+        self.max_sessions = max_sessions
+        self.near_threshold = near_threshold
+        self.wait_timeout = wait_timeout
+        self.rate = rate
+        self.burst = burst
+        self._sessions = OrderedDict()  # session_key -> [PrefetchEntry]
+        self._buckets = OrderedDict()  # session_key -> TokenBucket (发送消息后仍保留，限速不被重置)
+        self._lock = threading.Lock()
+        self._stats = {
+            "prefetches": 0,
+            "duplicates": 0,
+            "errors": 0,
+            "throttled": 0,
+            "hits_exact": 0,
+            "hits_near": 0,
+            "misses": 0,
+            "wasted": 0,
+            "saved_ms_total": 0.0
+        }
+
+    def _discard(self, entries):
+        """丢弃一批条目，未被使用的计为浪费 (调用方持有锁)"""
+        for entry in entries:
+            if not entry.used and entry.error is None:
+                self._stats["wasted"] += 1
+
+    def _session_entries(self, session_key, now):
+        entries = self._sessions.get(session_key)
+        if entries is None:
+            return None
+        alive = [e for e in entries if now - e.created_at <= self.ttl_seconds]
+        self._discard([e for e in entries if e not in alive])
+        entries[:] = alive
+        self._sessions.move_to_end(session_key)
+        return entries
+
+    def _throttled(self, session_key):
+        """取出本会话的一个预取令牌，令牌不足时返回True (调用方持有锁)"""
+        if self.rate <= 0:
+            return False
+        bucket = self._buckets.get(session_key)
+        if bucket is None:
+            bucket = self._buckets[session_key] = TokenBucket(self.rate, self.burst)
+            while len(self._buckets) > self.max_sessions:
+                self._buckets.popitem(last=False)
+        else:
+            self._buckets.move_to_end(session_key)
+        return bucket.take() > 0
+
+    def prefetch(self, session_key, query, k, min_score, retrieve):
+        """
+        为草稿执行检索并保存结果 (在调用线程中同步执行)
+
+        参数:
+            retrieve: 函数 (query) -> (query_vec, results)
+
+        返回:
+            PrefetchEntry: 本次或已有的预取结果；本会话超出限速时返回None
+        """
+        key = normalize_query(query)
+        now = time.time()
+        with self._lock:
+            entries = self._session_entries(session_key, now)
+            if entries is None:
+                entries = self._sessions[session_key] = []
+                while len(self._sessions) > self.max_sessions:
+                    _, evicted = self._sessions.popitem(last=False)
+                    self._discard(evicted)
+            for entry in entries:
+                if entry.key == key and entry.k >= k and entry.min_score == min_score:
+                    self._stats["duplicates"] += 1
+                    return entry
+            if self._throttled(session_key):
+                self._stats["throttled"] += 1
+                return None
+
+            entry = PrefetchEntry(query, k, min_score)
+            entries.append(entry)
+            if len(entries) > self.max_per_session:
+                self._discard(entries[:-self.max_per_session])
+                del entries[:-self.max_per_session]
+            self._stats["prefetches"] += 1
+
+        start = time.perf_counter()
+        try:
+            entry.query_vec, entry.results = retrieve(query)
+        except Exception as e:
+            entry.error = e
+            with self._lock:
+                self._stats["errors"] += 1
+            print(f"RAG预取失败: {e}")
+        finally:
+            entry.compute_ms = (time.perf_counter() - start) * 1000
+            entry._ready.set()
+        return entry
+
+    def take(self, session_key, query, k, min_score):
+        """
+        发送消息时取出可复用的预取结果，并丢弃本会话的其余草稿
+
+        返回:
+            PrefetchEntry: 命中的预取结果 (match 为 "exact" 或 "near")；未命中返回None
+        """
+        key = normalize_query(query)
+        now = time.time()
+        with self._lock:
+            entries = self._session_entries(session_key, now) or []
+            usable = [e for e in entries if e.k >= k and e.min_score == min_score and e.error is None]
+            best, match = None, None
+            for entry in usable:
+                if entry.key == key:
+                    best, match = entry, "exact"
+                    break
+            if best is None and usable:
+                scored = max(usable, key=lambda e: query_similarity(e.key, key))
+                if query_similarity(scored.key, key) >= self.near_threshold:
+                    best, match = scored, "near"
+
+            if best is None:
+                self._stats["misses"] += 1
+                return None
+            best.used = True
+            best.match = match
+            self._discard([e for e in entries if e is not best])
+            self._sessions.pop(session_key, None)
+
+        # 预取仍在进行：等待其完成 (只省下已完成的那部分时间)
+        waited_from = time.perf_counter()
+        if not best.wait(self.wait_timeout) or best.error is not None:
+            with self._lock:
+                self._stats["misses"] += 1
+            return None
+        waited_ms = (time.perf_counter() - waited_from) * 1000
+
+        with self._lock:
+            self._stats["hits_exact" if match == "exact" else "hits_near"] += 1
+            self._stats["saved_ms_total"] += max(0.0, best.compute_ms - waited_ms)
+        return best
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            hits = stats["hits_exact"] + stats["hits_near"]
+            stats["saved_ms_total"] = round(stats["saved_ms_total"], 1)
+            stats["avg_saved_ms"] = round(self._stats["saved_ms_total"] / hits, 1) if hits else 0.0
+            stats["hit_rate"] = round(hits / (hits + stats["misses"]), 4) if hits + stats["misses"] else 0.0
+            # 浪费比例：已完成的预取中从未被采用的比例
+            stats["wasted_ratio"] = round(stats["wasted"] / stats["prefetches"], 4) if stats["prefetches"] else 0.0
+            stats["pending_sessions"] = len(self._sessions)
+            return stats
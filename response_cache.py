@@ -0,0 +1,194 @@
+# -*- coding: utf-8 -*-
+"""
+文件名: response_cache.py
+功  能: 单模型回答缓存 (供 llm.py 的 /predict 使用)。
+描  述:
+1. 以 "完整 messages_for_llm + 模型名" 的 SHA-256 作为缓存键。
+2. 内存层为按字节数限额的 LRU，磁盘层为本地 SQLite，重启后仍可命中。
+3. 所有条目带 TTL，过期即失效。
+4. 命中后可按固定大小切片，重放为与上游一致的流式事件。
+"""
+
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+
+def make_cache_key(model_name, messages):
+    """根据模型名和完整消息列表生成缓存键"""
+    raw = json.dumps({"model": model_name, "messages": messages},
+                     ensure_ascii=False, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+
+def parse_cache_control(value):
+    """
+    解析请求中的缓存控制标记
+
+    参数:
+        value: 字符串 (如 "no-cache, no-store")、列表或 None
+
+    返回:
+        tuple: (no_cache 跳过读取, no_store 跳过写入)
+    """
+    if not value:
+        return False, False
+    if isinstance(value, str):
+        flags = {v.strip().lower() for v in value.split(',')}
+    else:
+        flags = {str(v).strip().lower() for v in value}
+    no_store = 'no-store' in flags
+    no_cache = 'no-cache' in flags or no_store
+    return no_cache, no_store
+
+
+class ResponseCache:
+    """回答缓存：内存 LRU + SQLite 持久化"""
+
+    def __init__(self, db_path, max_memory_bytes=32 * 1024 * 1024, ttl_seconds=24 * 3600,
+                 max_disk_entries=10000):
+        self.db_path = db_path
+        self.max_memory_bytes = max_memory_bytes
+        self.ttl_seconds = ttl_seconds
+        self.max_disk_entries = max_disk_entries
+
+        self._memory = OrderedDict()  # key -> (created_at, model_used, answer)
+        self._memory_bytes = 0
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "memory_hits": 0, "disk_hits": 0, "misses": 0, "stores": 0, "bypassed": 0}
+
+        directory = os.path.dirname(os.path.abspath(db_path))
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS response_cache ("
+            " key TEXT PRIMARY KEY,"
+            " model_used TEXT NOT NULL,"
+            " answer TEXT NOT NULL,"
+            " created_at REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_response_cache_created ON response_cache(created_at)")
+        self._conn.commit()
+
+    # ------------------------------------------------------------------
+    # 内存层
+    # ------------------------------------------------------------------
+    def _memory_put(self, key, created_at, model_used, answer):
+        size = len(answer.encode('utf-8'))
+        if size > self.max_memory_bytes:
+            return
+        if key in self._memory:
+            self._memory_bytes -= len(self._memory.pop(key)[2].encode('utf-8'))
+        self._memory[key] = (created_at, model_used, answer)
+        self._memory_bytes += size
+        while self._memory_bytes > self.max_memory_bytes and self._memory:
+            _, (_, _, evicted) = self._memory.popitem(last=False)
+            self._memory_bytes -= len(evicted.encode('utf-8'))
+
+    def _memory_drop(self, key):
+        entry = self._memory.pop(key, None)
+        if entry:
+            self._memory_bytes -= len(entry[2].encode('utf-8'))
+
+    # ------------------------------------------------------------------
+    # 对外接口
+    # ------------------------------------------------------------------
+    def get(self, key):
+        """
+        查询缓存
+
+        返回:
+            dict: {"model_used", "answer"}，未命中或已过期时返回None
+        """
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry:
+                if now - entry[0] <= self.ttl_seconds:
+                    self._memory.move_to_end(key)
+                    self._stats["hits"] += 1
+                    self._stats["memory_hits"] += 1
+                    return {"model_used": entry[1], "answer": entry[2]}
+                self._memory_drop(key)
+
+            row = self._conn.execute(
+                "SELECT created_at, model_used, answer FROM response_cache WHERE key = ?", (key,)
+            ).fetchone()
+            if row and now - row[0] <= self.ttl_seconds:
+                self._memory_put(key, *row)
+                self._stats["hits"] += 1
+                self._stats["disk_hits"] += 1
+                return {"model_used": row[1], "answer": row[2]}
+            if row:
+                self._conn.execute("DELETE FROM response_cache WHERE key = ?", (key,))
+                self._conn.commit()
+
+            self._stats["misses"] += 1
+            return None
+
+    def put(self, key, model_used, answer):
+        """写入缓存（内存 + 磁盘），并清理过期/超量的磁盘条目"""
+        if not answer:
+            return
+        now = time.time()
+        with self._lock:
+            self._memory_put(key, now, model_used, answer)
+            self._conn.execute(
+                "INSERT OR REPLACE INTO response_cache (key, model_used, answer, created_at) VALUES (?, ?, ?, ?)",
+                (key, model_used, answer, now)
+            )
+            self._conn.execute("DELETE FROM response_cache WHERE created_at < ?", (now - self.ttl_seconds,))
+            self._conn.execute(
+                "DELETE FROM response_cache WHERE key IN ("
+                " SELECT key FROM response_cache ORDER BY created_at DESC LIMIT -1 OFFSET ?)",
+                (self.max_disk_entries,)
+            )
+            self._conn.commit()
+            self._stats["stores"] += 1
+
+    def record_bypass(self):
+        """记录一次被请求显式跳过的缓存查询"""
+        with self._lock:
+            self._stats["bypassed"] += 1
+
+    def clear(self):
+        """清空内存与磁盘缓存"""
+        with self._lock:
+            self._memory.clear()
+            self._memory_bytes = 0
+            self._conn.execute("DELETE FROM response_cache")
+            self._conn.commit()
+
+    def stats(self):
+        """返回命中率等统计信息"""
+        with self._lock:
+            lookups = self._stats["hits"] + self._stats["misses"]
+            disk_entries = self._conn.execute("SELECT COUNT(*) FROM response_cache").fetchone()[0]
+            return {
+                **self._stats,
+                "hit_rate": round(self._stats["hits"] / lookups, 4) if lookups else 0.0,
+                "memory_entries": len(self._memory),
+                "memory_bytes": self._memory_bytes,
+                "disk_entries": disk_entries
+            }
+
+
+def replay_events(model_used, answer, chunk_size=16, prompt_report=None):
+    """
+    将缓存的回答按固定大小切片，重放为与实时流一致的事件序列
+
+    参数:
+        prompt_report: 本次请求的提示词token统计；给出时 model_info 事件与实时流一样带 prompt_tokens
+    """
+    info = {"event": "model_info", "model_used": model_used}
+    if prompt_report is not None:
+        info["prompt_tokens"] = prompt_report["prompt_tokens"]
+    yield info
+    for i in range(0, len(answer), chunk_size):
+        yield {"event": "chunk", "chunk": answer[i:i + chunk_size]}
+    yield {"event": "end_of_stream"}
@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+"""
+文件名: retriever.py
+功  能: 法律案例检索器 (Milvus + 句向量模型)，供 app.py 与离线评测 eval_runner.py 使用。
+描  述:
+1. 连接本地 Milvus 数据库 (build_database.ipynb 生成的 legal_assistant.db)，加载 bge 嵌入模型。
+2. encode_query 编码查询，search_similar_cases 按余弦相似度检索并过滤低分结果，get_cases 按ID读取案例。
+3. 本模块导入时没有副作用 (不创建 Flask 应用、数据库连接或线程池)，离线工具可以单独导入。
+"""
+
+import torch
+from pymilvus import MilvusClient
+from sentence_transformers import SentenceTransformer
+
+import config
+
+
+class LegalCaseRetriever:
+    """法律案件检索器（Milvus 版）"""
+    model_loaded = False
+    def __init__(self, db_uri, model_path, collection_name="legal_cases"):
+        print("正在加载案件检索系统...")
+        self.collection_name = collection_name
+
+        # 连接本地 Milvus SQLite（由 build_database.ipynb 生成的 legal_assistant.db）
+        self.client = MilvusClient(db_uri)
+        if not self.client.has_collection(self.collection_name):
+            raise ValueError(f"Milvus 集合不存在: {self.collection_name}")
+
+        # 获取数据量，用于状态上报
+        stats = self.client.get_collection_stats(self.collection_name)
+        self.case_count = int(stats.get("row_count", 0))
+        print(f"✓ Milvus 已连接，集合包含 {self.case_count} 条记录")
+
+        # 加载嵌入模型
+        self.model = SentenceTransformer(model_path, trust_remote_code=True)
+        device = 'cuda' if torch.cuda.is_available() else 'cpu'
+        self.model.to(device)
+        print(f"✓ 嵌入模型已加载到: {device}")
+        print("案件检索系统初始化完成！")
+
+    def encode_query(self, query_text):
+        """将查询文本编码为归一化向量 (一维)"""
+        return self.model.encode([query_text], normalize_embeddings=True)[0]
+
+    @staticmethod
+    def format_case(entity):
+        """Milvus 记录 -> 提示词使用的案例格式"""
+        return {
+            "fact": entity.get("fact", ""),
+            "meta": {
+                "relevant_articles": entity.get("articles", []),
+                "accusation": entity.get("accusation", []),
+                "punish_of_money": entity.get("fine", "未知"),
+                "criminals": entity.get("criminals", []),
+                "term_of_imprisonment": entity.get("term", {})
+            }
+        }
+
+    def get_cases(self, case_ids):
+        """按ID从 Milvus 读取案例，返回 {case_id: 案例}"""
+        if not case_ids:
+            return {}
+        rows = self.client.get(
+            collection_name=self.collection_name,
+            ids=list(case_ids),
+            output_fields=["id", "fact", "summary", "accusation"]
+        )
+        return {row.get("id"): self.format_case(row) for row in rows}
+
+    def search_similar_cases(self, query_text, k=5, min_score=0.5, query_vec=None):
+        """使用 Milvus 检索相似案件（可传入已编码的 query_vec 以避免重复编码）"""
+        if query_vec is None:
+            query_vec = self.encode_query(query_text)
+
+        # Milvus 按距离/相似度排序，需与建库时的 metric_type 一致
+        search_res = self.client.search(
+            collection_name=self.collection_name,
+            data=query_vec.reshape(1, -1),
+            limit=k * 2,
+            output_fields=["id", "fact", "summary", "accusation"],
+            search_params={"metric_type": "COSINE"}
+        )
+
+        results = []
+        for hit in search_res[0]:
+            similarity = float(hit.get("distance", 0))
+            if similarity < min_score:
+                continue
+
+            entity = hit.get("entity", {})
+            formatted_case = self.format_case(entity)
+            results.append({
+                'case_id': entity.get('id'),
+                'similarity_score': similarity,
+                'formatted_case': formatted_case
+            })
+
+            # 调试输出：打印命中的案件关键信息
+            if config.RAG_DEBUG:
+                fact_preview = formatted_case["fact"][:120] + ("..." if len(formatted_case["fact"]) > 120 else "")
+                print(
+                    f"[RAG] hit id={entity.get('id', 'N/A')} sim={similarity:.4f} "
+                    f"accusation={formatted_case['meta'].get('accusation', [])} "
+                    f"articles={formatted_case['meta'].get('relevant_articles', [])} "
+                    f"fact='{fact_preview}'"
+                )
+
+            if len(results) >= k:
+                break
+
+        return results
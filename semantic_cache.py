@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+"""
+文件名: semantic_cache.py
+功  能: 基于问题向量的近似重复回答缓存 (供 app.py 首轮提问使用)。
+描  述:
+1. 按命名空间 (模型 + 普通/专业模式) 隔离，每个命名空间一个小型内存向量索引。
+2. 查询时计算与已缓存问题的余弦相似度 (向量已归一化，点积即可)。
+3. 仅当相似度超过严格阈值且 RAG 案例集合完全一致时才命中。
+4. 每个命名空间按条数上限做 LRU 淘汰，并带 TTL。
+"""
+
+import hashlib
+import threading
+import time
+
+import numpy as np
+
+
+def make_case_signature(case_ids):
+    """根据检索到的案例ID集合生成签名（与顺序无关）"""
+    joined = "|".join(sorted(str(cid) for cid in case_ids))
+    return hashlib.sha1(joined.encode('utf-8')).hexdigest()
+
+
+class _Namespace:
+    """单个命名空间的向量索引"""
+
+    def __init__(self):
+        self.entries = []  # [{question, vector, case_signature, model_used, answer, created_at, last_used}]
+        self.matrix = None  # 懒构建的 (n, dim) 矩阵
+
+    def rebuild(self):
+        self.matrix = np.vstack([e["vector"] for e in self.entries]) if self.entries else None
+
+
+class SemanticCache:
+    """语义近似缓存"""
+
+    def __init__(self, threshold=0.95, max_entries_per_namespace=500, ttl_seconds=24 * 3600):
+        self.threshold = threshold
+        self.max_entries = max_entries_per_namespace
+        self.ttl_seconds = ttl_seconds
+        self._namespaces = {}
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "misses": 0, "stores": 0, "evictions": 0}
+
+    @staticmethod
+    def _normalize(vector):
+        vec = np.asarray(vector, dtype=np.float32).reshape(-1)
+        norm = np.linalg.norm(vec)
+        return vec / norm if norm > 0 else vec
+
+    def _expire(self, ns, now):
+        alive = [e for e in ns.entries if now - e["created_at"] <= self.ttl_seconds]
+        if len(alive) != len(ns.entries):
+            ns.entries = alive
+            ns.matrix = None
+
+    def lookup(self, namespace, vector, case_signature):
+        """
+        查找语义近似的已缓存问题
+
+        返回:
+            dict: 命中的条目 (含 question/answer/model_used/similarity)，未命中返回None
+        """
+        vec = self._normalize(vector)
+        now = time.time()
+        with self._lock:
+            ns = self._namespaces.get(namespace)
+            if ns:
+                self._expire(ns, now)
+            if not ns or not ns.entries:
+                self._stats["misses"] += 1
+                return None
+            if ns.matrix is None:
+                ns.rebuild()
+
+            scores = ns.matrix @ vec
+            # 按相似度从高到低，找第一个案例集合一致的条目
+            for idx in np.argsort(-scores):
+                score = float(scores[idx])
+                if score < self.threshold:
+                    break
+                entry = ns.entries[idx]
+                if entry["case_signature"] == case_signature:
+                    entry["last_used"] = now
+                    self._stats["hits"] += 1
+                    return {
+                        "question": entry["question"],
+                        "answer": entry["answer"],
+                        "model_used": entry["model_used"],
+                        "similarity": score
+                    }
+
+            self._stats["misses"] += 1
+            return None
+
+    def add(self, namespace, vector, question, case_signature, model_used, answer):
+        """加入缓存，超出上限时淘汰最久未使用的条目"""
+        if not answer:
+            return
+        now = time.time()
+        with self._lock:
+            ns = self._namespaces.setdefault(namespace, _Namespace())
+            ns.entries.append({
+                "question": question,
+                "vector": self._normalize(vector),
+                "case_signature": case_signature,
+                "model_used": model_used,
+                "answer": answer,
+                "created_at": now,
+                "last_used": now
+            })
+            if len(ns.entries) > self.max_entries:
+                ns.entries.sort(key=lambda e: e["last_used"])
+                overflow = len(ns.entries) - self.max_entries
+                ns.entries = ns.entries[overflow:]
+                self._stats["evictions"] += overflow
+            ns.matrix = None
+            self._stats["stores"] += 1
+
+    def purge(self, namespace=None):
+        """清空指定命名空间（或全部），返回删除的条目数"""
+        with self._lock:
+            if namespace is None:
+                removed = sum(len(ns.entries) for ns in self._namespaces.values())
+                self._namespaces.clear()
+            else:
+                ns = self._namespaces.pop(namespace, None)
+                removed = len(ns.entries) if ns else 0
+            return removed
+
+    def stats(self):
+        """返回命中统计与各命名空间条目数"""
+        with self._lock:
+            lookups = self._stats["hits"] + self._stats["misses"]
+            return {
+                **self._stats,
+                "hit_rate": round(self._stats["hits"] / lookups, 4) if lookups else 0.0,
+                "namespaces": {name: len(ns.entries) for name, ns in self._namespaces.items()}
+            }
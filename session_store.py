@@ -0,0 +1,334 @@
+# -*- coding: utf-8 -*-
+"""
+文件名: session_store.py
+功  能: 服务器端会话存储 (替代 Flask-Session 的 filesystem 存储)，供 app.py 设置 app.session_interface。
+描  述:
+1. 浏览器 Cookie 中只保存 (签名后的) 会话ID，会话内容以 JSON 保存在存储中，带过期时间：
+   - MemorySessionStore: 进程内 LRU，适合单进程部署 (重启后会话丢失，超出容量时淘汰最久未使用的会话)；
+   - SQLiteSessionStore: 单个 SQLite 文件 (expires_at 上有索引)，多个工作进程可共用。
+2. 过期采用滑动窗口：读取时忽略已过期的会话；剩余有效期不足一半时只更新过期时间 (touch)，不重写内容。
+3. 请求结束时把会话序列化后与读取时的内容比较，没有变化就跳过写入 (即使视图函数赋了相同的值)；
+   新会话为空时不写入也不下发 Cookie，会话被清空时删除。
+4. 后台线程每隔 sweep_interval 秒删除已过期的会话，stats() 统计读写、跳过的写入与清理数量。
+"""
+
+import json
+import os
+import secrets
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timezone
+
+from flask.sessions import SessionInterface, SessionMixin
+from itsdangerous import BadSignature, Signer
+from werkzeug.datastructures import CallbackDict
+
+
+class MemorySessionStore:
+    """进程内 LRU 会话存储"""
+
+    def __init__(self, max_entries=10000):
+        self.max_entries = max(1, max_entries)
+        self._items = OrderedDict()  # sid -> (data, expires_at)
+        self._lock = threading.Lock()
+
+    def get(self, sid, now):
+        """返回 (data, expires_at)；不存在或已过期返回None"""
+        with self._lock:
+            item = self._items.get(sid)
+            if item is None:
+                return None
+            if item[1] <= now:
+                del self._items[sid]
+                return None
+            self._items.move_to_end(sid)
+            return item
+
+    def set(self, sid, data, expires_at):
+        with self._lock:
+            self._items[sid] = (data, expires_at)
+            self._items.move_to_end(sid)
+            while len(self._items) > self.max_entries:
+                self._items.popitem(last=False)
+
+    def touch(self, sid, expires_at):
+        with self._lock:
+            item = self._items.get(sid)
+            if item is not None:
+                self._items[sid] = (item[0], expires_at)
+
+    def delete(self, sid):
+        with self._lock:
+            self._items.pop(sid, None)
+
+    def sweep(self, now):
+        """删除已过期的会话，返回删除数"""
+        with self._lock:
+            expired = [sid for sid, (_, expires_at) in self._items.items() if expires_at <= now]
+            for sid in expired:
+                del self._items[sid]
+            return len(expired)
+
+    def count(self):
+        with self._lock:
+            return len(self._items)
+
+
+class SQLiteSessionStore:
+    """SQLite 会话存储 (每个线程一个连接，WAL 模式下多进程可同时读写)"""
+
+    def __init__(self, path, busy_timeout_ms=5000):
+        self.path = path
+        self.busy_timeout_ms = busy_timeout_ms
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        self._local = threading.local()
+        conn = self._conn()
+        conn.execute("CREATE TABLE IF NOT EXISTS sessions ("
+                     "id TEXT PRIMARY KEY, data TEXT NOT NULL, expires_at REAL NOT NULL)")
+        conn.execute("CREATE INDEX IF NOT EXISTS ix_sessions_expires_at ON sessions (expires_at)")
+
+    def _conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            # isolation_level=None: 每条语句自动提交，不持有事务
+            conn = sqlite3.connect(self.path, timeout=self.busy_timeout_ms / 1000, isolation_level=None,
+                                   check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def get(self, sid, now):
+        row = self._conn().execute("SELECT data, expires_at FROM sessions WHERE id = ? AND expires_at > ?",
+                                   (sid, now)).fetchone()
+        return tuple(row) if row else None
+
+    def set(self, sid, data, expires_at):
+        self._conn().execute("INSERT OR REPLACE INTO sessions (id, data, expires_at) VALUES (?, ?, ?)",
+                             (sid, data, expires_at))
+
+    def touch(self, sid, expires_at):
+        self._conn().execute("UPDATE sessions SET expires_at = ? WHERE id = ?", (expires_at, sid))
+
+    def delete(self, sid):
+        self._conn().execute("DELETE FROM sessions WHERE id = ?", (sid,))
+
+    def sweep(self, now):
+        return self._conn().execute("DELETE FROM sessions WHERE expires_at <= ?", (now,)).rowcount
+
+    def count(self):
+        return self._conn().execute("SELECT COUNT(*) FROM sessions").fetchone()[0]
+
+
+class StoredSession(CallbackDict, SessionMixin):
+    """从存储读取的会话；raw 为读取时的序列化内容 (新会话为None)，用于判断是否需要写回"""
+
+    def __init__(self, initial=None, sid=None, raw=None, expires_at=0.0):
+        def on_update(self):
+            self.modified = True
+            self.accessed = True
+
+        super().__init__(initial, on_update)
+        self.sid = sid
+        self.raw = raw
+        self.expires_at = expires_at
+        self.new = raw is None
+        self.modified = False
+        self.accessed = False
+
+    def __getitem__(self, key):
+        self.accessed = True
+        return super().__getitem__(key)
+
+    def get(self, key, default=None):
+        self.accessed = True
+        return super().get(key, default)
+
+
+def serialize_session(session):
+    return json.dumps(dict(session), ensure_ascii=False, sort_keys=True, separators=(",", ":"))
+
+
+class StoredSessionInterface(SessionInterface):
+    """
+    基于 MemorySessionStore / SQLiteSessionStore 的 Flask 会话接口
+
+    参数:
+        store: 会话存储
+        ttl_seconds: 会话有效期 (最后一次访问起算)
+        use_signer: 是否对 Cookie 中的会话ID签名 (使用 app.secret_key)
+        permanent: True 时 Cookie 带过期时间 (与会话有效期一致)，否则为浏览器关闭即失效的 Cookie
+        sweep_interval: 后台清理过期会话的间隔秒数 (<=0 不启动清理线程)
+    """
+
+    def __init__(self, store, ttl_seconds=30 * 24 * 3600, use_signer=True, permanent=False, sweep_interval=600):
+        self.store = store
+        self.ttl_seconds = ttl_seconds
+        self.use_signer = use_signer
+        self.permanent = permanent
+        self.sweep_interval = sweep_interval
+        self._lock = threading.Lock()
+        self._stats = {
+            "opened": 0,
+            "created": 0,
+            "misses": 0,
+            "writes": 0,
+            "skipped_writes": 0,
+            "touches": 0,
+            "deletes": 0,
+            "swept": 0,
+            "errors": 0,
+            "open_ms_total": 0.0,
+            "save_ms_total": 0.0
+        }
+        self._stop = threading.Event()
+        if sweep_interval > 0:
+            threading.Thread(target=self._sweep_loop, name="session-sweeper", daemon=True).start()
+
+    def _count(self, name, value=1):
+        with self._lock:
+            self._stats[name] += value
+
+    def _signer(self, app):
+        return Signer(app.secret_key, salt="flask-session", key_derivation="hmac")
+
+    def _sid_from_cookie(self, app, value):
+        if not value:
+            return None
+        if not self.use_signer:
+            return value
+        try:
+            return self._signer(app).unsign(value).decode("utf-8")
+        except BadSignature:
+            return None
+
+    def open_session(self, app, request):
+        start = time.perf_counter()
+        now = time.time()
+        sid = self._sid_from_cookie(app, request.cookies.get(self.get_cookie_name(app)))
+        session = None
+        if sid:
+            try:
+                item = self.store.get(sid, now)
+            except Exception as e:
+                item = None
+                self._count("errors")
+                print(f"读取会话失败: {e}")
+            if item is not None:
+                data, expires_at = item
+                try:
+                    session = StoredSession(json.loads(data), sid=sid, raw=data, expires_at=expires_at)
+                except json.JSONDecodeError:
+                    session = None
+            else:
+                self._count("misses")
+        if session is None:
+            # 新会话使用新的ID (不沿用 Cookie 中已失效的ID)
+            session = StoredSession(sid=secrets.token_urlsafe(32))
+        with self._lock:
+            self._stats["opened"] += 1
+            self._stats["open_ms_total"] += (time.perf_counter() - start) * 1000
+        return session
+
+    def save_session(self, app, session, response):
+        start = time.perf_counter()
+        name = self.get_cookie_name(app)
+        domain, path = self.get_cookie_domain(app), self.get_cookie_path(app)
+        if session.accessed:
+            response.vary.add("Cookie")
+
+        if not session:
+            # 新会话没有内容：不保存也不下发Cookie；已有会话被清空：删除
+            if not session.new:
+                self.store.delete(session.sid)
+                response.delete_cookie(name, domain=domain, path=path)
+                self._count("deletes")
+            return
+
+        now = time.time()
+        expires_at = now + self.ttl_seconds
+        raw = serialize_session(session)
+        try:
+            if raw != session.raw:
+                self.store.set(session.sid, raw, expires_at)
+                self._count("created" if session.new else "writes")
+            elif session.expires_at - now < self.ttl_seconds / 2:
+                self.store.touch(session.sid, expires_at)
+                self._count("touches")
+            else:
+                self._count("skipped_writes")
+                expires_at = session.expires_at
+        except Exception as e:
+            self._count("errors")
+            print(f"保存会话失败: {e}")
+            return
+
+        # Cookie 只在新建会话或延长永久会话的有效期时下发
+        permanent = self.permanent or session.permanent
+        if session.new or (permanent and expires_at != session.expires_at):
+            value = self._signer(app).sign(session.sid).decode("utf-8") if self.use_signer else session.sid
+            response.set_cookie(
+                name, value,
+                expires=datetime.fromtimestamp(expires_at, timezone.utc) if permanent else None,
+                httponly=self.get_cookie_httponly(app),
+                domain=domain,
+                path=path,
+                secure=self.get_cookie_secure(app),
+                samesite=self.get_cookie_samesite(app)
+            )
+        self._count("save_ms_total", (time.perf_counter() - start) * 1000)
+
+    def sweep(self):
+        """删除已过期的会话，返回删除数"""
+        removed = self.store.sweep(time.time())
+        self._count("swept", removed)
+        return removed
+
+    def _sweep_loop(self):
+        while not self._stop.wait(self.sweep_interval):
+            try:
+                removed = self.sweep()
+                if removed:
+                    print(f"已清理 {removed} 个过期会话")
+            except Exception as e:
+                print(f"清理过期会话失败: {e}")
+
+    def stop(self):
+        self._stop.set()
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+        open_total = stats.pop("open_ms_total")
+        save_total = stats.pop("save_ms_total")
+        saves = stats["created"] + stats["writes"] + stats["touches"] + stats["skipped_writes"]
+        stats.update({
+            "store": type(self.store).__name__,
+            "sessions": self.store.count(),
+            "ttl_seconds": self.ttl_seconds,
+            "avg_open_ms": round(open_total / stats["opened"], 3) if stats["opened"] else 0.0,
+            "avg_save_ms": round(save_total / saves, 3) if saves else 0.0,
+            "skipped_write_ratio": round(stats["skipped_writes"] / saves, 4) if saves else 0.0
+        })
+        return stats
+
+
+def create_session_interface(session_type, sqlite_path, ttl_seconds, use_signer=True, permanent=False,
+                             sweep_interval=600, memory_max_entries=10000):
+    """
+    按会话存储类型创建会话接口
+
+    参数:
+        session_type: "memory" 或 "sqlite"
+    """
+    if session_type == "memory":
+        store = MemorySessionStore(memory_max_entries)
+    elif session_type == "sqlite":
+        store = SQLiteSessionStore(sqlite_path)
+    else:
+        raise ValueError(f"未知的会话存储类型: {session_type}")
+    return StoredSessionInterface(store, ttl_seconds, use_signer=use_signer, permanent=permanent,
+                                  sweep_interval=sweep_interval)
@@ -0,0 +1,225 @@
+# -*- coding: utf-8 -*-
+"""
+文件名: stream_coalescer.py
+功  能: SSE 中继的分时合并 (coalescing) 阶段。
+描  述:
+1. 上游每个token增量都是一个事件，逐个转发会产生大量小帧，浏览器每帧都要重新渲染整条消息。
+2. 合并器把连续的 chunk 事件缓冲起来，满足以下任一条件时才作为一帧发出：
+   - 距上次发出已超过 flush_ms 毫秒；
+   - 缓冲内容超过 max_bytes 字节；
+   - 遇到非 chunk 事件 (model_info / error / end_of_stream 等)，先发出缓冲再转发该事件。
+3. 第一个 chunk 总是立即发出，不影响首字时间 (TTFT)。
+4. flush_ms <= 0 时不做合并，原样转发。
+5. 同步版本由读取线程消费上游、按时间片等待队列，与异步版本一样在上游停顿时准时发出缓冲。
+"""
+
+import asyncio
+import queue
+import threading
+import time
+
+
+class ChunkCoalescer:
+    """按时间片与字节数合并文本增量"""
+
+    def __init__(self, flush_ms=50, max_bytes=512, clock=time.monotonic):
+        self.flush_interval = flush_ms / 1000.0
+        self.max_bytes = max_bytes
+        self.clock = clock
+        self._parts = []
+        self._bytes = 0
+        self._last_flush = None  # 为None表示尚未发出过任何chunk
+
+    def push(self, text):
+        """加入一个增量，需要立即发出时返回合并后的文本，否则返回None"""
+        self._parts.append(text)
+        self._bytes += len(text.encode('utf-8'))
+        now = self.clock()
+        if (self._last_flush is None
+                or now - self._last_flush >= self.flush_interval
+                or self._bytes >= self.max_bytes):
+            return self.flush(now)
+        return None
+
+    def flush(self, now=None):
+        """取出缓冲中的全部文本 (无缓冲时返回None)"""
+        if not self._parts:
+            return None
+        text = "".join(self._parts)
+        self._parts = []
+        self._bytes = 0
+        self._last_flush = self.clock() if now is None else now
+        return text
+
+    def time_until_flush(self):
+        """距离下一次按时间片发出还剩多少秒 (无缓冲时返回None)"""
+        if not self._parts:
+            return None
+        return max(0.0, self._last_flush + self.flush_interval - self.clock())
+
+
+_END = object()
+
+
+class _ReaderError:
+    """读取线程中上游抛出的异常，交给消费端重新抛出"""
+
+    def __init__(self, error):
+        self.error = error
+
+
+def _read_events(events, buffer, stop):
+    """读取线程：把上游事件放入队列；下游关闭后在下一个事件到达时停止，并在本线程内关闭上游"""
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                buffer.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    try:
+        for event in events:
+            if not put(event):
+                break
+    except Exception as e:
+        put(_ReaderError(e))
+    finally:
+        if hasattr(events, "close"):
+            events.close()
+        put(_END)
+
+
+def coalesce_events_inline(events, flush_ms=50, max_bytes=512, clock=time.monotonic):
+    """
+    不启动读取线程的同步合并：缓冲中的尾部内容最迟在下一个上游事件到达时发出
+
+    时间只在事件到达时读取，可传入模拟时钟按固定节奏回放 (供 benchmarks/bench_coalescing.py 使用)。
+    """
+    if flush_ms <= 0:
+        yield from events
+        return
+
+    coalescer = ChunkCoalescer(flush_ms, max_bytes, clock)
+    for event in events:
+        if event.get("event") == "chunk":
+            text = coalescer.push(event.get("chunk", ""))
+            if text:
+                yield {"event": "chunk", "chunk": text}
+            continue
+
+        text = coalescer.flush()
+        if text:
+            yield {"event": "chunk", "chunk": text}
+        yield event
+
+    text = coalescer.flush()
+    if text:
+        yield {"event": "chunk", "chunk": text}
+
+
+def coalesce_events(events, flush_ms=50, max_bytes=512, close_timeout=1.0):
+    """
+    合并同步事件流中的 chunk 事件
+
+    上游由读取线程消费并放入有界队列，本生成器按时间片等待队列：
+    上游停顿时缓冲内容也会准时发出，而不是等到下一个上游事件到达。
+    下游关闭时最多等待 close_timeout 秒让读取线程结束 (调用方应先取消上游请求使读取立即返回)。
+    """
+    if flush_ms <= 0:
+        yield from events
+        return
+
+    coalescer = ChunkCoalescer(flush_ms, max_bytes)
+    buffer = queue.Queue(maxsize=256)
+    stop = threading.Event()
+    reader = threading.Thread(target=_read_events, args=(events, buffer, stop), name="stream-coalesce",
+                              daemon=True)
+    reader.start()
+    try:
+        while True:
+            try:
+                item = buffer.get(timeout=coalescer.time_until_flush())
+            except queue.Empty:
+                # 时间片到期而上游尚无新事件：先发出缓冲
+                yield {"event": "chunk", "chunk": coalescer.flush()}
+                continue
+
+            if item is _END:
+                break
+            if isinstance(item, _ReaderError):
+                text = coalescer.flush()
+                if text:
+                    yield {"event": "chunk", "chunk": text}
+                raise item.error
+
+            if item.get("event") == "chunk":
+                text = coalescer.push(item.get("chunk", ""))
+                if text:
+                    yield {"event": "chunk", "chunk": text}
+                continue
+
+            text = coalescer.flush()
+            if text:
+                yield {"event": "chunk", "chunk": text}
+            yield item
+    finally:
+        stop.set()
+        reader.join(close_timeout)
+
+    text = coalescer.flush()
+    if text:
+        yield {"event": "chunk", "chunk": text}
+
+
+async def coalesce_events_async(events, flush_ms=50, max_bytes=512):
+    """合并异步事件流中的 chunk 事件；上游停顿时缓冲内容也会按时间片准时发出"""
+    if flush_ms <= 0:
+        async for event in events:
+            yield event
+        return
+
+    coalescer = ChunkCoalescer(flush_ms, max_bytes)
+    iterator = events.__aiter__()
+    pending = None
+    try:
+        while True:
+            if pending is None:
+                pending = asyncio.ensure_future(iterator.__anext__())
+
+            done, _ = await asyncio.wait({pending}, timeout=coalescer.time_until_flush())
+            if not done:
+                # 时间片到期而上游尚无新事件：先发出缓冲
+                yield {"event": "chunk", "chunk": coalescer.flush()}
+                continue
+
+            task, pending = pending, None
+            try:
+                event = task.result()
+            except StopAsyncIteration:
+                break
+
+            if event.get("event") == "chunk":
+                text = coalescer.push(event.get("chunk", ""))
+                if text:
+                    yield {"event": "chunk", "chunk": text}
+                continue
+
+            text = coalescer.flush()
+            if text:
+                yield {"event": "chunk", "chunk": text}
+            yield event
+    finally:
+        # 下游提前关闭时取消尚在等待的上游读取，并等待其结束，之后上游生成器才能被关闭
+        if pending is not None:
+            pending.cancel()
+            try:
+                await pending
+            except (asyncio.CancelledError, Exception):
+                pass
+
+    text = coalescer.flush()
+    if text:
+        yield {"event": "chunk", "chunk": text}
@@ -0,0 +1,324 @@
+# -*- coding: utf-8 -*-
+"""
+文件名: transport.py
+功  能: app.py 调用 llm.py 后端的传输层抽象。
+描  述:
+1. HttpTransport: 通过 HTTP POST + SSE 调用独立部署的 llm.py (原有方式，适用于分离部署)。
+2. InProcessTransport: 两个服务运行在同一进程时，直接消费 llm.py 的事件生成器，
+   省去回环socket以及每个token的 SSE 序列化/反序列化。
+3. 两种传输方式产出的事件格式完全一致 (字典，含 "event" 字段)，app.py 无需区分。
+4. Async* 版本供 asgi_app.py 的异步服务使用，接口相同但为协程/异步生成器。
+5. stream() 接受可选的 CancelToken：取消时立即关闭与后端的连接/上游流；
+   cancel(request_id) 通知后端关闭对应请求的上游 LLM 流。
+6. summarize(payload) 请求后端把较早的对话轮次合并进对话摘要 (仅同步版本，在后台线程中调用)。
+7. coalesced 表示 stream() 产出的 chunk 是否已由后端按时间片合并 (HTTP 模式)，已合并时调用方不再合并第二次。
+"""
+
+import asyncio
+import json
+
+import requests
+
+import config
+
+
+class TransportError(Exception):
+    """后端调用失败 (网络错误或后端返回错误)"""
+
+    def __init__(self, message, status=500):
+        super().__init__(message)
+        self.status = status
+
+
+class TransportTimeout(TransportError):
+    """后端调用超时"""
+
+    def __init__(self, message):
+        super().__init__(message, status=504)
+
+
+class SseEventParser:
+    """逐行解析 /predict 的 SSE 输出，还原为事件字典"""
+
+    def __init__(self):
+        self.event_name = None
+
+    def feed(self, line):
+        """输入一行SSE文本，解析出完整事件时返回事件字典，否则返回None"""
+        if not line:
+            self.event_name = None
+            return None
+
+        if line.startswith("event: "):
+            self.event_name = line[len("event: "):].strip()
+            if self.event_name == "end_of_stream":
+                return {"event": "end_of_stream"}
+            return None
+
+        if not line.startswith("data: "):
+            return None
+        try:
+            data_json = json.loads(line.split("data: ", 1)[1])
+        except (json.JSONDecodeError, IndexError):
+            return None
+
+        if self.event_name == "model_info" or "model_used" in data_json:
+            return {**data_json, "event": "model_info", "model_used": data_json.get("model_used", "未知")}
+        if "chunk" in data_json:
+            return {"event": "chunk", "chunk": data_json.get("chunk", "")}
+        if self.event_name == "error" or "error" in data_json:
+            return {"event": "error", "error": data_json.get("error", "未知流错误")}
+        if self.event_name:
+            return {"event": self.event_name, **data_json}
+        return None
+
+
+def endpoint_url(api_url, name):
+    """由 /predict 地址推出后端其他接口的地址 (如 /cancel、/summarize)"""
+    base = api_url.rsplit('/predict', 1)[0] if api_url.endswith('/predict') else api_url.rstrip('/')
+    return f"{base}/{name}"
+
+
+class HttpTransport:
+    """通过 HTTP/SSE 调用 llm.py 的 /predict 接口"""
+
+    coalesced = True  # 后端 /predict 已按时间片合并帧，调用方无需再次合并
+
+    def __init__(self, api_url, stream_timeout=60, judge_timeout=120, cancel_timeout=5, summary_timeout=60):
+        self.api_url = api_url
+        self.cancel_url = endpoint_url(api_url, 'cancel')
+        self.summary_url = endpoint_url(api_url, 'summarize')
+        self.stream_timeout = stream_timeout
+        self.judge_timeout = judge_timeout
+        self.cancel_timeout = cancel_timeout
+        self.summary_timeout = summary_timeout
+        self.headers = {"Content-Type": "application/json"}
+
+    def cancel(self, request_id):
+        """通知后端取消请求 (关闭上游LLM流)，返回后端是否找到该请求"""
+        try:
+            response = requests.post(self.cancel_url, headers=self.headers, json={"request_id": request_id},
+                                     timeout=self.cancel_timeout)
+            return bool(response.ok and response.json().get("cancelled"))
+        except (requests.exceptions.RequestException, ValueError) as e:
+            print(f"通知后端取消请求失败: {e}")
+            return False
+
+    def judge(self, payload):
+        """Judge 模式：返回后端的完整JSON结果"""
+        try:
+            response = requests.post(self.api_url, headers=self.headers, json=payload, timeout=self.judge_timeout)
+        except requests.exceptions.Timeout:
+            raise TransportTimeout('请求超时 (Judge模式需要更长时间)')
+        except requests.exceptions.RequestException as e:
+            raise TransportError(f'网络请求错误: {str(e)}')
+
+        try:
+            result = response.json()
+        except ValueError:
+            raise TransportError(f'后端返回错误: HTTP {response.status_code}', response.status_code)
+        if not response.ok:
+            raise TransportError(f'后端返回错误: {result.get("error", "未知错误")}', response.status_code)
+        return result
+
+    def summarize(self, payload):
+        """生成对话摘要，返回 {"summary", "model_used"}"""
+        try:
+            response = requests.post(self.summary_url, headers=self.headers, json=payload,
+                                     timeout=self.summary_timeout)
+        except requests.exceptions.Timeout:
+            raise TransportTimeout('生成对话摘要超时')
+        except requests.exceptions.RequestException as e:
+            raise TransportError(f'网络请求错误: {str(e)}')
+
+        try:
+            result = response.json()
+        except ValueError:
+            raise TransportError(f'后端返回错误: HTTP {response.status_code}', response.status_code)
+        if not response.ok:
+            raise TransportError(f'后端返回错误: {result.get("error", "未知错误")}', response.status_code)
+        return result
+
+    def stream(self, payload, cancel_token=None):
+        """单模型模式：解析后端SSE，逐个产出事件字典"""
+        try:
+            with requests.post(self.api_url, headers=self.headers, json=payload, stream=True,
+                               timeout=self.stream_timeout) as response:
+                if response.status_code in (429, 503):
+                    raise TransportError(f'后端繁忙，请稍后再试 (HTTP {response.status_code})', response.status_code)
+                response.raise_for_status()
+                if cancel_token is not None:
+                    # 取消时通知后端关闭上游流，并断开本连接使阻塞的读取立即返回
+                    cancel_token.add_callback(lambda: self.cancel(payload.get('request_id')))
+                    cancel_token.add_callback(response.close)
+
+                parser = SseEventParser()
+                for line in response.iter_lines(decode_unicode=True):
+                    event = parser.feed(line)
+                    if event:
+                        yield event
+                        if event["event"] == "end_of_stream":
+                            return
+
+        except Exception as e:
+            # 取消时连接被主动断开，读取端抛出的异常不视为错误
+            if cancel_token is not None and cancel_token.cancelled:
+                return
+            if isinstance(e, requests.exceptions.Timeout):
+                raise TransportTimeout('后端响应超时')
+            if isinstance(e, requests.exceptions.RequestException):
+                raise TransportError(f'网络请求错误: {str(e)}')
+            raise
+
+
+class InProcessTransport:
+    """同进程直接调用 llm.py 的函数，不经过网络与序列化"""
+
+    coalesced = False  # 产出的是逐个token增量，由调用方合并
+
+    def __init__(self):
+        # 延迟导入：仅在启用同进程模式时才加载 llm.py (及其OpenAI客户端、回答缓存)
+        import llm
+        self._llm = llm
+
+    def judge(self, payload):
+        try:
+            return self._llm.run_judge(payload)
+        except self._llm.PredictError as e:
+            raise TransportError(f'后端返回错误: {e}', e.status)
+
+    def cancel(self, request_id):
+        return self._llm.cancellation_registry.cancel(request_id)
+
+    def summarize(self, payload):
+        try:
+            return self._llm.summarize_history(payload)
+        except self._llm.PredictError as e:
+            raise TransportError(f'后端返回错误: {e}', e.status)
+
+    def stream(self, payload, cancel_token=None):
+        try:
+            events = self._llm.open_stream(payload, cancel_token)
+        except self._llm.PredictError as e:
+            raise TransportError(f'后端返回错误: {e}', e.status)
+        return events
+
+
+class AsyncHttpTransport:
+    """HttpTransport 的异步版本 (httpx)，供 ASGI 服务使用，等待上游时不占用线程"""
+
+    coalesced = True  # 同 HttpTransport
+
+    def __init__(self, api_url, stream_timeout=60, judge_timeout=120, max_connections=1000):
+        import httpx
+        self._httpx = httpx
+        self.api_url = api_url
+        self.cancel_url = endpoint_url(api_url, 'cancel')
+        self.stream_timeout = stream_timeout
+        self.judge_timeout = judge_timeout
+        self.client = httpx.AsyncClient(
+            headers={"Content-Type": "application/json"},
+            limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections)
+        )
+
+    async def judge(self, payload):
+        try:
+            response = await self.client.post(self.api_url, json=payload, timeout=self.judge_timeout)
+        except self._httpx.TimeoutException:
+            raise TransportTimeout('请求超时 (Judge模式需要更长时间)')
+        except self._httpx.HTTPError as e:
+            raise TransportError(f'网络请求错误: {str(e)}')
+
+        try:
+            result = response.json()
+        except ValueError:
+            raise TransportError(f'后端返回错误: HTTP {response.status_code}', response.status_code)
+        if response.is_error:
+            raise TransportError(f'后端返回错误: {result.get("error", "未知错误")}', response.status_code)
+        return result
+
+    async def cancel(self, request_id):
+        try:
+            response = await self.client.post(self.cancel_url, json={"request_id": request_id}, timeout=5)
+            return bool(not response.is_error and response.json().get("cancelled"))
+        except (self._httpx.HTTPError, ValueError) as e:
+            print(f"通知后端取消请求失败: {e}")
+            return False
+
+    async def stream(self, payload, cancel_token=None):
+        try:
+            async with self.client.stream("POST", self.api_url, json=payload,
+                                          timeout=self.stream_timeout) as response:
+                if response.status_code in (429, 503):
+                    raise TransportError(f'后端繁忙，请稍后再试 (HTTP {response.status_code})', response.status_code)
+                response.raise_for_status()
+                if cancel_token is not None:
+                    # 取消可能来自其他线程，需切回事件循环执行
+                    loop = asyncio.get_running_loop()
+                    cancel_token.add_callback(lambda: asyncio.run_coroutine_threadsafe(
+                        self.cancel(payload.get('request_id')), loop))
+                    cancel_token.add_callback(lambda: asyncio.run_coroutine_threadsafe(response.aclose(), loop))
+
+                parser = SseEventParser()
+                async for line in response.aiter_lines():
+                    event = parser.feed(line)
+                    if event:
+                        yield event
+                        if event["event"] == "end_of_stream":
+                            return
+
+        except Exception as e:
+            if cancel_token is not None and cancel_token.cancelled:
+                return
+            if isinstance(e, self._httpx.TimeoutException):
+                raise TransportTimeout('后端响应超时')
+            if isinstance(e, self._httpx.HTTPError):
+                raise TransportError(f'网络请求错误: {str(e)}')
+            raise
+
+
+class AsyncInProcessTransport:
+    """InProcessTransport 的异步版本，直接消费 llm.py 的异步事件生成器"""
+
+    coalesced = False  # 同 InProcessTransport
+
+    def __init__(self):
+        import llm
+        self._llm = llm
+
+    async def judge(self, payload):
+        try:
+            return await self._llm.run_judge_async(payload)
+        except self._llm.PredictError as e:
+            raise TransportError(f'后端返回错误: {e}', e.status)
+
+    async def cancel(self, request_id):
+        return self._llm.cancellation_registry.cancel(request_id)
+
+    async def stream(self, payload, cancel_token=None):
+        try:
+            events = self._llm.open_stream_async(payload, cancel_token)
+        except self._llm.PredictError as e:
+            raise TransportError(f'后端返回错误: {e}', e.status)
+        async for event in events:
+            yield event
+
+
+def create_transport(mode=None, api_url=None):
+    """根据配置创建传输层实例 ("http" 或 "inprocess")"""
+    mode = (mode or config.BACKEND_TRANSPORT).lower()
+    if mode == "inprocess":
+        return InProcessTransport()
+    if mode == "http":
+        return HttpTransport(api_url or config.API_URL)
+    raise ValueError(f"未知的后端传输方式: '{mode}'")
+
+
+def create_async_transport(mode=None, api_url=None):
+    """根据配置创建异步传输层实例 ("http" 或 "inprocess")"""
+    mode = (mode or config.BACKEND_TRANSPORT).lower()
+    if mode == "inprocess":
+        return AsyncInProcessTransport()
+    if mode == "http":
+        return AsyncHttpTransport(api_url or config.API_URL)
+    raise ValueError(f"未知的后端传输方式: '{mode}'")
@@ -0,0 +1,210 @@
+# -*- coding: utf-8 -*-
+"""
+文件名: upload_jobs.py
+功  能: 上传文件的异步识别任务 (供 app.py 的 /upload_file、/upload_jobs 与 /send_message 使用)。
+描  述:
+1. /upload_file 保存文件后提交任务并立即返回任务ID，OCR/语音识别在有界线程池中并发执行，不再占用 Web 工作线程；
+   排队与识别中的任务数达到上限时拒绝提交 (由调用方返回 503)。
+2. 任务状态依次为 queued -> processing -> done / error，每次变化递增 version 并唤醒等待者：
+   前端可轮询单个任务，也可通过 changes() 实现的 SSE 进度流接收状态变化。
+3. 发送消息时附件只带任务ID，wait() 只等待仍未完成的任务；任务按会话隔离，完成后保留 ttl_seconds 秒。
+"""
+
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+FINAL_STATUSES = ("done", "error")
+
+
+class UploadJob:
+    """一个上传文件的识别任务"""
+
+    def __init__(self, session_key, filename, file_type):
+        self.job_id = uuid.uuid4().hex[:12]
+        self.session_key = session_key
+        self.filename = filename
+        self.file_type = file_type
+        self.status = "queued"
+        self.text = None
+        self.error = None
+        self.version = 0
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+
+    @property
+    def finished(self):
+        return self.status in FINAL_STATUSES
+
+    def snapshot(self):
+        """返回给前端的任务状态 (识别完成后带识别文本)"""
+        elapsed_until = self.finished_at or time.time()
+        return {
+            "job_id": self.job_id,
+            "filename": self.filename,
+            "file_type": self.file_type,
+            "status": self.status,
+            "text": self.text,
+            "error": self.error,
+            "version": self.version,
+            "elapsed_ms": round((elapsed_until - self.created_at) * 1000, 1)
+        }
+
+
+class UploadJobManager:
+    """
+    上传识别任务的线程池与状态表
+
+    参数:
+        process: 函数 (file_path) -> (text, error)，在工作线程中执行，负责识别并删除临时文件
+        max_workers: 并发识别的线程数
+        max_pending: 排队与识别中的任务数上限
+        ttl_seconds: 任务完成后结果的保留时间
+        max_jobs: 状态表中最多保留的任务数 (超出时淘汰最早完成的任务)
+    """
+
+    def __init__(self, process, max_workers=4, max_pending=32, ttl_seconds=1800, max_jobs=5000):
+        self.process = process
+        self.max_workers = max_workers
+        self.max_pending = max_pending
+        self.ttl_seconds = ttl_seconds
+        self.max_jobs = max_jobs
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='upload-job')
+        self._jobs = OrderedDict()  # job_id -> UploadJob (按提交顺序)
+        self._pending = 0
+        self._cond = threading.Condition()  # 默认使用可重入锁
+        self._stats = {
+            "submitted": 0,
+            "rejected": 0,
+            "succeeded": 0,
+            "failed": 0,
+            "expired": 0,
+            "queue_ms_total": 0.0,
+            "process_ms_total": 0.0
+        }
+
+    def _expire(self, now):
+        """删除过期或超出数量上限的已完成任务 (调用方持有锁)"""
+        for job_id in list(self._jobs):
+            job = self._jobs[job_id]
+            if not job.finished:
+                continue
+            if now - job.finished_at > self.ttl_seconds or len(self._jobs) > self.max_jobs:
+                del self._jobs[job_id]
+                self._stats["expired"] += 1
+
+    def submit(self, session_key, file_path, filename, file_type):
+        """
+        提交识别任务
+
+        返回:
+            UploadJob: 新任务；排队任务已满时返回None (文件由调用方删除)
+        """
+        with self._cond:
+            self._expire(time.time())
+            if self._pending >= self.max_pending:
+                self._stats["rejected"] += 1
+                return None
+            job = UploadJob(session_key, filename, file_type)
+            self._jobs[job.job_id] = job
+            self._pending += 1
+            self._stats["submitted"] += 1
+        self._executor.submit(self._run, job, file_path)
+        return job
+
+    def _update(self, job, **fields):
+        with self._cond:
+            for name, value in fields.items():
+                setattr(job, name, value)
+            job.version += 1
+            self._cond.notify_all()
+
+    def _run(self, job, file_path):
+        self._update(job, status="processing", started_at=time.time())
+        try:
+            text, error = self.process(file_path)
+        except Exception as e:
+            text, error = None, f"处理失败: {e}"
+        finished_at = time.time()
+        with self._cond:
+            self._pending -= 1
+            self._stats["failed" if error else "succeeded"] += 1
+            self._stats["queue_ms_total"] += (job.started_at - job.created_at) * 1000
+            self._stats["process_ms_total"] += (finished_at - job.started_at) * 1000
+            self._update(job, status="error" if error else "done", text=None if error else text, error=error,
+                         finished_at=finished_at)
+
+    def _owned(self, session_key, job_id):
+        job = self._jobs.get(job_id)
+        return job if job is not None and job.session_key == session_key else None
+
+    def get(self, session_key, job_id):
+        """返回本会话的任务状态；不存在、已过期或属于其他会话时返回None"""
+        with self._cond:
+            job = self._owned(session_key, job_id)
+            return job.snapshot() if job is not None else None
+
+    def wait(self, session_key, job_ids, timeout):
+        """
+        等待一组任务完成 (最多 timeout 秒)
+
+        返回:
+            dict: job_id -> 任务状态 (超时仍未完成的 status 为 queued/processing)；不存在的任务为None
+        """
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while True:
+                jobs = {job_id: self._owned(session_key, job_id) for job_id in job_ids}
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or all(job is None or job.finished for job in jobs.values()):
+                    return {job_id: job.snapshot() if job is not None else None for job_id, job in jobs.items()}
+                self._cond.wait(remaining)
+
+    def changes(self, session_key, job_ids, seen, timeout):
+        """
+        等待任一任务的状态发生变化 (用于 SSE 进度流)
+
+        参数:
+            seen: dict job_id -> 已发送的 version (调用方维护)
+        返回:
+            list: 状态有变化的任务；不存在的任务以 status "not_found" 返回一次；超时无变化返回空列表
+        """
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while True:
+                changed = []
+                for job_id in job_ids:
+                    job = self._owned(session_key, job_id)
+                    if job is None:
+                        if job_id not in seen:
+                            changed.append({"job_id": job_id, "status": "not_found", "version": -1})
+                    elif seen.get(job_id) != job.version:
+                        changed.append(job.snapshot())
+                remaining = deadline - time.monotonic()
+                if changed or remaining <= 0:
+                    return changed
+                self._cond.wait(remaining)
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False)
+
+    def stats(self):
+        with self._cond:
+            stats = dict(self._stats)
+            statuses = [job.status for job in self._jobs.values()]
+        finished = stats["succeeded"] + stats["failed"]
+        queue_total = stats.pop("queue_ms_total")
+        process_total = stats.pop("process_ms_total")
+        stats.update({
+            "max_workers": self.max_workers,
+            "max_pending": self.max_pending,
+            "queued": statuses.count("queued"),
+            "processing": statuses.count("processing"),
+            "retained": len(statuses),
+            "avg_queue_ms": round(queue_total / finished, 1) if finished else 0.0,
+            "avg_process_ms": round(process_total / finished, 1) if finished else 0.0
+        })
+        return stats
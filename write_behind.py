@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+"""
+文件名: write_behind.py
+功  能: 数据库写入的后台队列 (write-behind)，供 app.py 保存每轮对话使用。
+描  述:
+1. 请求线程只把一轮对话累积的写入 (工作单元) 放进队列就返回，流式回答不等待磁盘。
+2. 单个后台线程按到达顺序成批取出工作单元，交给 apply_batch 在一个事务中写入 (一批一次提交)。
+3. 每个工作单元带一个键 (会话ID)：读取该会话的数据前调用 wait_for(key)，等待其尚未写入的单元落盘，
+   保证用户看到的历史包含上一轮 (通常此时队列早已为空，不需要等待)。
+4. 关闭服务时 drain() 写完队列中剩余的单元后停止后台线程；disabled 时 submit() 直接在调用线程中写入。
+"""
+
+import queue
+import threading
+import time
+from collections import Counter
+
+
+class WriteBehindQueue:
+    """
+    后台批量写入队列
+
+    参数:
+        apply_batch: 函数 (items) -> None，在后台线程中把一批工作单元写入数据库 (一个事务)
+        max_batch: 每批最多写入的单元数
+        enabled: False 时不启动后台线程，submit() 同步写入
+    """
+
+    def __init__(self, apply_batch, max_batch=64, enabled=True):
+        self.apply_batch = apply_batch
+        self.max_batch = max(1, max_batch)
+        self.enabled = enabled
+        self._queue = queue.Queue()
+        self._pending = Counter()  # key -> 已提交但尚未写入的单元数
+        self._cond = threading.Condition()
+        self._closed = False
+        self._thread = None
+        self._stats = {
+            "submitted": 0,
+            "written": 0,
+            "batches": 0,
+            "max_batch_size": 0,
+            "max_queue_depth": 0,
+            "batch_ms_total": 0.0,
+            "read_waits": 0,
+            "read_wait_ms_total": 0.0
+        }
+        if enabled:
+            self._thread = threading.Thread(target=self._run, name="write-behind", daemon=True)
+            self._thread.start()
+
+    def submit(self, key, item):
+        """提交一个工作单元；队列已关闭或未启用时在调用线程中直接写入"""
+        with self._cond:
+            closed = self._closed or not self.enabled
+            if not closed:
+                self._pending[key] += 1
+                self._stats["submitted"] += 1
+                self._queue.put((key, item))
+                self._stats["max_queue_depth"] = max(self._stats["max_queue_depth"], self._queue.qsize())
+        if closed:
+            self.apply_batch([item])
+
+    def wait_for(self, key, timeout=5.0):
+        """
+        等待某个键尚未写入的单元全部落盘
+
+        返回:
+            bool: 是否已全部写入 (超时返回False)
+        """
+        with self._cond:
+            if not self._pending.get(key):
+                return True
+            start = time.perf_counter()
+            done = self._cond.wait_for(lambda: not self._pending.get(key), timeout)
+            self._stats["read_waits"] += 1
+            self._stats["read_wait_ms_total"] += (time.perf_counter() - start) * 1000
+            return done
+
+    def _take_batch(self):
+        batch = [self._queue.get()]
+        while len(batch) < self.max_batch:
+            try:
+                batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._take_batch()
+            items = [item for key, item in batch if item is not None]
+            start = time.perf_counter()
+            if items:
+                try:
+                    self.apply_batch(items)
+                except Exception as e:
+                    print(f"后台写入失败 ({len(items)} 个单元): {e}")
+            with self._cond:
+                for key, item in batch:
+                    if item is None:
+                        continue
+                    self._pending[key] -= 1
+                    if self._pending[key] <= 0:
+                        del self._pending[key]
+                if items:
+                    self._stats["written"] += len(items)
+                    self._stats["batches"] += 1
+                    self._stats["max_batch_size"] = max(self._stats["max_batch_size"], len(items))
+                    self._stats["batch_ms_total"] += (time.perf_counter() - start) * 1000
+                self._cond.notify_all()
+            if any(item is None for _, item in batch):
+                return
+
+    def drain(self, timeout=10.0):
+        """停止接收新的单元 (之后的提交改为同步写入)，写完队列中剩余的单元后停止后台线程"""
+        with self._cond:
+            if self._closed:
+                return True
+            self._closed = True
+            remaining = self._queue.qsize()
+        if self._thread is None:
+            return True
+        self._queue.put((None, None))  # 停止标记排在所有已提交单元之后
+        self._thread.join(timeout)
+        finished = not self._thread.is_alive()
+        print(f"后台写入队列已关闭 - 剩余 {remaining} 个单元{'已全部写入' if finished else '未能在超时前写完'}")
+        return finished
+
+    def stats(self):
+        with self._cond:
+            stats = dict(self._stats)
+            batch_total = stats.pop("batch_ms_total")
+            wait_total = stats.pop("read_wait_ms_total")
+            stats.update({
+                "enabled": self.enabled and not self._closed,
+                "queue_depth": self._queue.qsize(),
+                "pending_keys": len(self._pending),
+                "avg_batch_size": round(stats["written"] / stats["batches"], 2) if stats["batches"] else 0.0,
+                "avg_batch_ms": round(batch_total / stats["batches"], 2) if stats["batches"] else 0.0,
+                "avg_read_wait_ms": round(wait_total / stats["read_waits"], 2) if stats["read_waits"] else 0.0
+            })
+            return stats